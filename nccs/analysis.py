@@ -15,14 +15,46 @@ import pycountry
 from climada.engine import Impact
 from climada.util.config import CONFIG as CLIMADA_CONFIG
 
-from nccs.pipeline.direct.calc_yearset import combine_yearsets, yearset_from_imp
-from nccs.pipeline.direct.direct import get_sector_exposure, nccs_direct_impacts_simple
-from nccs.pipeline.indirect.indirect import dump_direct_to_csv, dump_supchain_to_csv, supply_chain_climada
+from nccs.pipeline.artifact_index import ArtifactIndex
+from nccs.pipeline.artifact_store import add_artifact_keys, restore_artifacts_from_df, store_artifact
+from nccs.pipeline.direct.calc_yearset import POISSON_HAZARDS, combine_yearsets, is_combination_up_to_date, \
+    prune_zero_events, read_event_totals, read_full_event_set, set_matrix_dtype, write_combined_inputs, \
+    write_event_totals, write_full_event_set, yearset_from_imp
+from nccs.pipeline.direct.direct import build_sector_impf_set, get_batchable_sectors, get_data_api_queries, \
+    get_hazard, get_s3_input_files, get_sector_cap_vector, get_sector_exposure, nccs_direct_impacts_batched, \
+    nccs_direct_impacts_simple
+from nccs.pipeline.direct.exposure_cache import DEFAULT_EXPOSURE_CACHE_MB, EXPOSURE_CACHE_MB_ENV, \
+    get_exposure_cache_budget, set_exposure_cache_budget
+from nccs.pipeline.direct.impf_registry import IMPF_REGISTRY_PATH_ENV, build_impf_registry, get_impf_registry_path, \
+    set_impf_registry_path
+from nccs.pipeline.direct.lazy_impact import LazyImpact
+from nccs.pipeline.direct.sampling_plan import apply_sampling_plan, get_sampling_plan
+from nccs.pipeline.indirect.indirect import (
+    dump_direct_to_csv,
+    dump_supchain_to_csv,
+    init_supply_chain_worker,
+    supply_chain_climada
+)
+from nccs.pipeline.prefetch import Prefetcher
+from nccs.pipeline.run_journal import RunJournal, get_task_id
+from nccs.pipeline.run_plan import config_to_dataframe
+from nccs.pipeline.scheduler import TaskGraph
+from nccs.pipeline.worker import DEFAULT_POLL_SECONDS, METRICS_PATH_KEY, QUEUE_CLOSED_KEY, WORKER_ENV_KEY, \
+    wait_for_queue
+from nccs.pipeline.telemetry import TaskMetrics, add_metrics_to_report, get_metrics_path, impact_size_metrics, \
+    set_metrics_path
+from nccs.pipeline.task_costs import estimate_direct_costs, estimate_yearset_costs, order_by_cost
 from nccs.utils import folder_naming
+from nccs.utils.atomic_files import atomic_path
+from nccs.utils.data_catalog import DATA_CATALOG_PATH_ENV, OFFLINE_DATA_ENV, build_data_catalog, get_catalog_key, \
+    get_data_catalog_path, get_default_data_catalog_path, is_offline, set_data_catalog
 from nccs.utils.s3client import download_from_s3_bucket, file_exists_on_s3_bucket, upload_to_s3_bucket
 
 LOGGER = logging.getLogger(__name__)
 
+# Analyses sharing these values use the same hazard
+HAZARD_GROUP_COLS = ['hazard', 'country', 'scenario', 'ref_year']
+
 
 def run_pipeline_from_config(
         config: dict,
@@ -85,6 +117,16 @@ def run_pipeline_from_config(
     with open(Path(indirect_output_dir, 'config.json'), 'w') as f:
         json.dump(config, f)
 
+    # Tasks append their timings, memory use and data sizes to a metrics file, read back into the report at the end
+    metrics_path = Path(indirect_output_dir, 'task_metrics.jsonl') if config.get('record_metrics', True) else None
+    set_metrics_path(metrics_path)
+
+    # Data from the CLIMADA API is loaded through a local catalog of downloaded files, which works offline
+    set_data_catalog(config.get('data_catalog_path') or get_default_data_catalog_path(), config.get('offline_data', False))
+
+    # Each process keeps the exposures it loads in memory, up to this budget, to reuse them across stages
+    set_exposure_cache_budget(config.get('exposure_cache_mb', DEFAULT_EXPOSURE_CACHE_MB))
+
     LOGGER.info(f"Direct output will be saved to {direct_output_dir}")
 
     ### --------------------------------- ###
@@ -101,13 +143,105 @@ def run_pipeline_from_config(
     os.makedirs(direct_output_dir_impact, exist_ok=True)
     os.makedirs(direct_output_dir_yearsets, exist_ok=True)
 
-    analysis_df['_direct_impact_already_exists'] = [exists_impact_file(p, config['use_s3']) for p in
-                                                    analysis_df['direct_impact_path']]
+    # Download and catalog all the API data the run needs up front, e.g. before moving it to an offline machine
+    if config.get('build_data_catalog', False):
+        queries = {}
+        for row in analysis_df[['hazard', 'sector', 'country', 'scenario', 'ref_year']].drop_duplicates().itertuples():
+            for data_type, properties in get_data_api_queries(row.hazard, row.sector, row.country, row.scenario,
+                                                              row.ref_year):
+                queries[get_catalog_key(data_type, properties)] = (data_type, properties)
+        build_data_catalog(queries.values())
+
+    # Reuse impacts and yearsets calculated with the same inputs by any earlier run
+    if config.get('use_artifact_store', False):
+        analysis_df = add_artifact_keys(analysis_df, config)
+        if not config['force_recalculation']:
+            n_restored_impacts, n_restored_yearsets = restore_artifacts_from_df(analysis_df)
+            LOGGER.info(
+                f'Restored {n_restored_impacts} direct impacts and {n_restored_yearsets} yearsets from the '
+                f'artifact store'
+            )
+
+    # Answer existence checks from one scan of the output directories (and one listing of the S3 bucket)
+    artifact_index = ArtifactIndex([direct_output_dir_impact, direct_output_dir_yearsets], use_s3=config['use_s3'])
+
+    # Record the progress of each task so that a run that is killed can be resumed from where it stopped
+    journal = None
+    if config.get('use_run_journal', True):
+        journal = RunJournal(
+            Path(indirect_output_dir, 'run_journal.sqlite'), shared=config.get('use_worker_queue', False)
+        )
+        # With a worker queue, tasks still running belong to workers and are reclaimed when their leases run out
+        n_reset = 0 if config.get('use_worker_queue', False) else journal.reset_running()
+        if n_reset > 0:
+            LOGGER.info(f'Resuming: {n_reset} tasks were left running by an earlier run')
+        journal.add_tasks(
+            [(get_task_id('direct', p), 'direct', p) for p in analysis_df['direct_impact_path']] +
+            [(get_task_id('yearset', p), 'yearset', p) for p in analysis_df['yearset_path']]
+        )
+
+    # Outputs of tasks that an earlier run started and didn't finish may be incomplete, so they count as missing
+    analysis_df['_direct_impact_already_exists'] = _get_finished(
+        analysis_df['direct_impact_path'], 'direct', artifact_index, journal
+    )
     analysis_df['_direct_impact_calculate'] = True if config['force_recalculation'] else ~analysis_df[
         '_direct_impact_already_exists']
     n_direct_calculations = np.sum(analysis_df['_direct_impact_calculate'])
     n_direct_exists = np.sum(analysis_df['_direct_impact_already_exists'])
 
+    # Build the impact function sets of all the direct impacts to calculate once, for every process to look up
+    impf_registry_path = None
+    if config.get('use_impf_registry', True) and analysis_df['_direct_impact_calculate'].any():
+        impf_registry_path = Path(direct_output_dir, 'impf_registry.pkl')
+        df_calculate = analysis_df[analysis_df['_direct_impact_calculate']]
+        impf_keys = [
+            (hazard, sector, iso3, config['business_interruption'], config['calibrated'],
+             config.get('use_sector_bi_scaling', True))
+            for hazard, sector, iso3 in zip(df_calculate['hazard'], df_calculate['sector'],
+                                            df_calculate['country_iso3alpha'])
+        ]
+        n_impf_sets = build_impf_registry(impf_keys, build_sector_impf_set, impf_registry_path)
+        LOGGER.info(f'Built {n_impf_sets} impact function sets')
+    set_impf_registry_path(impf_registry_path)
+
+    # Download the hazard and exposure files of the direct impacts to calculate while the first ones run
+    prefetcher = None
+    if config.get('prefetch_inputs', True) and config['do_direct'] and analysis_df['_direct_impact_calculate'].any():
+        prefetcher = start_input_prefetch(analysis_df[analysis_df['_direct_impact_calculate']], config)
+
+    analysis_df_filename = f'calculations_report_{time_now.strftime("%Y-%m-%d_%H%M")}.csv'
+    analysis_df_path = Path(indirect_output_dir, analysis_df_filename)
+
+    if config.get('use_task_graph', False):
+        # Run every stage as a single dependency graph instead of stage by stage
+        LOGGER.info('\n\nRUNNING THE PIPELINE AS A TASK GRAPH')
+        _ = _check_config_valid_for_indirect_aggregations(config)
+        analysis_df = run_pipeline_task_graph(
+            analysis_df, config, direct_output_dir, indirect_output_dir, artifact_index, journal
+        )
+        if prefetcher is not None:
+            prefetcher.wait()
+        analysis_df = add_metrics_to_report(analysis_df, metrics_path)
+        analysis_df.to_csv(analysis_df_path)
+        LOGGER.info("\n\nDone!\nTo show the Dashboard run:\nbokeh serve dashboard.py --show")
+        return
+
+    if config.get('use_worker_queue', False):
+        # Queue the tasks for worker processes, possibly on other machines, and combine and report their results
+        if journal is None:
+            raise ValueError('use_worker_queue needs the run journal. Set use_run_journal: True in your config')
+        LOGGER.info('\n\nRUNNING THE PIPELINE WITH A WORKER QUEUE')
+        analysis_df = run_pipeline_worker_queue(
+            analysis_df, config, direct_output_dir, indirect_output_dir, artifact_index, journal
+        )
+        if prefetcher is not None:
+            prefetcher.wait()
+        analysis_df = add_metrics_to_report(analysis_df, metrics_path)
+        analysis_df.to_csv(analysis_df_path)
+        LOGGER.info(f'Task states recorded in the run journal: {journal.summary()}')
+        LOGGER.info("\n\nDone!\nTo show the Dashboard run:\nbokeh serve dashboard.py --show")
+        return
+
     if config['do_direct']:
         LOGGER.info('\n\nRUNNING DIRECT IMPACT CALCULATIONS')
         LOGGER.info(
@@ -116,22 +250,27 @@ def run_pipeline_from_config(
         )
 
         if config['do_parallel']:
-            chunk_size = int(np.ceil(analysis_df.shape[0] / config['ncpus']))
-            df_chunked = [analysis_df[i:i + chunk_size] for i in range(0, analysis_df.shape[0], chunk_size)]
-            calc_partial = partial(calculate_direct_impacts_from_df, config=config)
+            # Queue only the analyses that need calculating, largest first. Each worker pulls the next task when
+            # it finishes the last one, so no worker is left idle while another works through a chunk of big ones
+            df_calculate = analysis_df[analysis_df['_direct_impact_calculate']]
+            df_queue = order_by_cost(df_calculate, estimate_direct_costs(df_calculate), by=HAZARD_GROUP_COLS)
+            calc_partial = partial(calculate_direct_impacts_from_df, config=config, journal=journal)
             with pa.multiprocessing.ProcessPool(config['ncpus']) as pool:
-                pool.map(calc_partial, df_chunked)
+                _ = list(pool.uimap(calc_partial, df_queue))
         else:
-            calculate_direct_impacts_from_df(analysis_df, config)
+            calculate_direct_impacts_from_df(analysis_df, config, journal)
+        if prefetcher is not None:
+            prefetcher.wait()
+        artifact_index.refresh(analysis_df.loc[analysis_df['_direct_impact_calculate'], 'direct_impact_path'])
     else:
         LOGGER.info("Skipping direct impact calculations. Set do_direct: True in your config to change this")
 
-    analysis_df['_direct_impact_exists'] = [exists_impact_file(p, config['use_s3']) for p in
-                                            analysis_df['direct_impact_path']]
+    analysis_df['_direct_impact_exists'] = _get_finished(
+        analysis_df['direct_impact_path'], 'direct', artifact_index, journal
+    )
 
-    analysis_df_filename = f'calculations_report_{time_now.strftime("%Y-%m-%d_%H%M")}.csv'
-    analysis_df_path = Path(indirect_output_dir, analysis_df_filename)
-    analysis_df.to_csv(analysis_df_path)
+    if journal is None:
+        analysis_df.to_csv(analysis_df_path)
 
     ### ------------------- ###
     ### SAMPLE IMPACT YEARS ###
@@ -142,8 +281,7 @@ def run_pipeline_from_config(
     yearset_output_dir = Path(direct_output_dir, "yearsets")
     os.makedirs(yearset_output_dir, exist_ok=True)
 
-    analysis_df['_yearset_already_exists'] = [exists_impact_file(p, config['use_s3']) for p in
-                                              analysis_df['yearset_path']]
+    analysis_df['_yearset_already_exists'] = _get_finished(analysis_df['yearset_path'], 'yearset', artifact_index, journal)
     analysis_df['_yearset_calculate'] = (True if config['force_recalculation'] else ~analysis_df[
         '_yearset_already_exists']) * analysis_df['_direct_impact_exists']
     n_yearset_calculations = np.sum(analysis_df['_yearset_calculate'])
@@ -159,21 +297,78 @@ def run_pipeline_from_config(
         )
 
         if config['do_parallel']:
-            chunk_size = int(np.ceil(analysis_df.shape[0] / config['ncpus']))
-            df_chunked = [analysis_df[i:i + chunk_size] for i in range(0, analysis_df.shape[0], chunk_size)]
-            calc_partial = partial(calculate_yearsets_from_df, config=config)
+            df_calculate = analysis_df[analysis_df['_yearset_calculate']]
+            df_queue = order_by_cost(df_calculate, estimate_yearset_costs(df_calculate))
+            calc_partial = partial(calculate_yearsets_from_df, config=config, journal=journal)
             with pa.multiprocessing.ProcessPool(config['ncpus']) as pool:
-                pool.map(calc_partial, df_chunked)
+                _ = list(pool.uimap(calc_partial, df_queue))
         else:
-            calculate_yearsets_from_df(analysis_df, config)
+            calculate_yearsets_from_df(analysis_df, config, journal)
+        artifact_index.refresh(analysis_df.loc[analysis_df['_yearset_calculate'], 'yearset_path'])
     else:
         LOGGER.info("Skipping yearset calculations. Set do_yearsets: True in your config to change this")
 
-    analysis_df['_yearset_exists'] = [exists_impact_file(p, config['use_s3']) for p in analysis_df['yearset_path']]
-    analysis_df.to_csv(analysis_df_path)
+    analysis_df['_yearset_exists'] = _get_finished(analysis_df['yearset_path'], 'yearset', artifact_index, journal)
+    if journal is None:
+        analysis_df.to_csv(analysis_df_path)
 
     # Next: combine yearsets by hazard to create multihazard yearsets
+    analysis_df = combine_yearsets_from_df(analysis_df, config, journal)
 
+    ### ----------------------------------- ###
+    ### CALCULATE INDIRECT ECONOMIC IMPACTS ###
+    ### ----------------------------------- ###
+
+    # Generate supply chain impacts from the yearsets
+    # Create a folder to output the data
+    # indirect_output_dir = Path(indirect_output_dir, "results")
+    LOGGER.info("\n\nMODELLING SUPPLY CHAINS")
+    os.makedirs(indirect_output_dir, exist_ok=True)
+
+    if config['force_recalculation']:
+        analysis_df['_indirect_exists'] = False
+    else:
+        # Supply chains whose outputs exist and, with a journal, that an earlier run of this config completed
+        analysis_df['_indirect_exists'] = _get_indirect_finished(
+            analysis_df, config, indirect_output_dir, journal
+        ).all(axis=1)
+    analysis_df['_indirect_calculate'] = analysis_df['_yearset_exists'] & ~analysis_df['_indirect_exists']
+
+    n_supchain_calculations = np.sum(analysis_df['_indirect_calculate'])
+    LOGGER.info(f'There are {n_supchain_calculations} out of {analysis_df.shape[0]} supply chains to calculate')
+
+    # Run the Supply Chain for each country and sector and output the data needed to csv
+    if config['do_indirect']:
+        for io_a in config['io_approach']:
+            calculate_indirect_impacts_from_df(
+                analysis_df, io_a, config, direct_output_dir, indirect_output_dir, journal
+            )
+    else:
+        LOGGER.info("Skipping supply chain calculations. Set do_indirect: True in your config to change this")
+
+    analysis_df = add_metrics_to_report(analysis_df, metrics_path)
+    analysis_df.to_csv(analysis_df_path)
+    if journal is not None:
+        LOGGER.info(f'Task states recorded in the run journal: {journal.summary()}')
+
+    LOGGER.info("\n\nDone!\nTo show the Dashboard run:\nbokeh serve dashboard.py --show")
+    LOGGER.info("Don't forget to update the current run title within the dashboard.py script: RUN_TITLE")
+
+
+def combine_yearsets_from_df(analysis_df, config, journal=None):
+    """Combine the crop yearsets of each scenario and country into
+    agriculture yearsets and, if do_multihazard is set, the yearsets of all
+    hazards for each scenario, sector and country into multihazard yearsets.
+    Combinations are recorded in the journal, if there is one, and skipped
+    when their output was made from the current input yearsets, unless
+    force_recalculation is set.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The analysis dataframe with the crop rows replaced by agriculture rows
+        and the multihazard rows added
+    """
     # Combine the yearsets for each agriculture crop type to one agriculture yearset
     analysis_df_crop = analysis_df[analysis_df['hazard'].str.contains('relative_crop_yield')]
     analysis_df_no_crop = analysis_df[~analysis_df['hazard'].str.contains('relative_crop_yield')]
@@ -181,8 +376,9 @@ def run_pipeline_from_config(
         LOGGER.info("\n\nCOMBINING CRP CROP YIELD YEARSETS")
         grouping_cols = ['i_scenario', 'country']
         df_aggregated_yearsets = analysis_df_crop \
-            .groupby(grouping_cols)[grouping_cols + ['scenario', 'ref_year', 'yearset_path']] \
-            .apply(df_create_combined_hazard_yearsets_agriculture) \
+            .groupby(grouping_cols, observed=True)[grouping_cols + ['scenario', 'ref_year', 'yearset_path']] \
+            .apply(df_create_combined_hazard_yearsets_agriculture, force=config['force_recalculation'],
+                   journal=journal) \
             .reset_index()
         analysis_df = pd.concat([analysis_df_no_crop, df_aggregated_yearsets]).reset_index()
 
@@ -191,8 +387,8 @@ def run_pipeline_from_config(
     if config['do_multihazard']:
         LOGGER.info("\n\nCOMBINING HAZARDS TO MULTIHAZARD YEARSETS")
         df_aggregated_yearsets = analysis_df \
-            .groupby(grouping_cols)[grouping_cols + ['hazard', 'scenario', 'ref_year', 'yearset_path']] \
-            .apply(df_create_combined_hazard_yearsets) \
+            .groupby(grouping_cols, observed=True)[grouping_cols + ['hazard', 'scenario', 'ref_year', 'yearset_path']] \
+            .apply(df_create_combined_hazard_yearsets, force=config['force_recalculation'], journal=journal) \
             .reset_index()
 
         analysis_df = pd.concat(
@@ -201,124 +397,514 @@ def run_pipeline_from_config(
         # but don't forget to call it!
     else:
         LOGGER.info("Skipping multihazard impact calculations. Set do_multihazard: True in your config to change this")
+    return analysis_df
 
-    ### ----------------------------------- ###
-    ### CALCULATE INDIRECT ECONOMIC IMPACTS ###
-    ### ----------------------------------- ###
 
-    # Generate supply chain impacts from the yearsets
-    # Create a folder to output the data
-    # indirect_output_dir = Path(indirect_output_dir, "results")
-    LOGGER.info("\n\nMODELLING SUPPLY CHAINS")
-    os.makedirs(indirect_output_dir, exist_ok=True)
+def run_pipeline_task_graph(
+        analysis_df, config, direct_output_dir, indirect_output_dir, artifact_index=None, journal=None):
+    """Run the direct, yearset, combination and indirect stages as one
+    dependency graph.
 
-    analysis_df['_indirect_exists'] = False  # TODO: update this to check for existing output
-    analysis_df['_indirect_calculate'] = analysis_df['_yearset_exists']
+    Each row of the analysis dataframe moves to its next stage as soon as its
+    inputs exist, and the crop and multihazard combinations only wait for the
+    yearsets in their own group, so no stage waits for the slowest analysis
+    of the previous stage.
 
-    n_supchain_calculations = np.sum(analysis_df['_indirect_calculate'])
-    LOGGER.info(f'There are {n_supchain_calculations} out of {analysis_df.shape[0]} supply chains to calculate')
+    Parameters
+    ----------
+    analysis_df : pandas.DataFrame
+        Dataframe created by config_to_dataframe, with the
+        _direct_impact_calculate column set
+    config : dict
+        The run configuration
+    direct_output_dir : str or os.PathLike
+        Location of direct impact outputs
+    indirect_output_dir : str or os.PathLike
+        Location of indirect impact outputs
+    artifact_index : ArtifactIndex, optional
+        Index of the existing output files, used to plan which tasks are
+        needed and to report which outputs exist at the end of the run. If not
+        given, the output directories are scanned.
+    journal : RunJournal, optional
+        Journal to record the state of each direct impact, yearset and supply
+        chain calculation in
 
-    # Run the Supply Chain for each country and sector and output the data needed to csv
-    if config['do_indirect']:
-        for io_a in config['io_approach']:
-            # For now we're not parallelising this: looks like there's not much time gained. But should time it
-            # properly.
-            calculate_indirect_impacts_from_df(analysis_df, io_a, config, direct_output_dir, indirect_output_dir)
-    else:
-        LOGGER.info("Skipping supply chain calculations. Set do_indirect: True in your config to change this")
+    Returns
+    -------
+    pandas.DataFrame
+        The analysis dataframe after crop and multihazard combination, with
+        _direct_impact_exists, _yearset_exists and _indirect_exists columns
+    """
+    graph = TaskGraph()
+    is_crop = analysis_df['hazard'].str.contains('relative_crop_yield')
+    # Start the largest analyses first so that they don't hold up the end of the run
+    costs = estimate_direct_costs(analysis_df)
+    if artifact_index is None:
+        artifact_index = ArtifactIndex(
+            [Path(direct_output_dir, "impact_raw"), Path(direct_output_dir, "yearsets")], use_s3=config['use_s3']
+        )
 
-    analysis_df.to_csv(analysis_df_path)
+    # Direct impacts are calculated together for all the sectors that share a hazard
+    direct_producers = {}
+    if config['do_direct']:
+        df_calculate = analysis_df[analysis_df['_direct_impact_calculate']]
+        for j, (_, df_group) in enumerate(df_calculate.groupby(HAZARD_GROUP_COLS, sort=False, observed=True)):
+            name = f'direct/{j}'
+            graph.add_task(name, calculate_direct_impacts_for_hazard, df_group, config, journal,
+                           priority=costs[df_group.index].sum())
+            direct_producers.update({i: name for i in df_group.index})
+
+    # Which tasks are needed is decided here from the index, so the tasks don't check for their files again
+    direct_finished = _get_finished(analysis_df['direct_impact_path'], 'direct', artifact_index, journal)
+    yearset_finished = _get_finished(analysis_df['yearset_path'], 'yearset', artifact_index, journal)
+
+    # Name of the task that produces each row's yearset, and whether the yearset will be available
+    yearset_producers = {}
+    yearset_available = {}
+    for (i, row), direct_done, yearset_done in zip(analysis_df.iterrows(), direct_finished, yearset_finished):
+        name = f'yearset/{i}'
+        if config['do_yearsets'] and (config['force_recalculation'] or not yearset_done):
+            if i in direct_producers or direct_done:
+                graph.add_task(
+                    name, _yearset_graph_task, row.to_dict(), config, journal,
+                    deps=[direct_producers[i]] if i in direct_producers else [], priority=costs[i]
+                )
+            else:
+                LOGGER.info(f'No direct impact data available. Skipping yearset: {row["yearset_path"]}')
+        yearset_producers[i] = name
+        yearset_available[i] = name in graph or yearset_done
 
-    LOGGER.info("\n\nDone!\nTo show the Dashboard run:\nbokeh serve dashboard.py --show")
-    LOGGER.info("Don't forget to update the current run title within the dashboard.py script: RUN_TITLE")
+    # Combine the yearsets for each agriculture crop type to one agriculture yearset
+    rows = [row.to_dict() for _, row in analysis_df[~is_crop].iterrows()]
+    producers = [yearset_producers[i] for i in analysis_df[~is_crop].index]
+    available = [yearset_available[i] for i in analysis_df[~is_crop].index]
+    grouping_cols = ['i_scenario', 'country']
+    for group_values, df_group in analysis_df[is_crop].groupby(grouping_cols, observed=True):
+        spec = get_combined_agriculture_yearset_spec(df_group)
+        spec.update(dict(zip(grouping_cols, group_values)))
+        name = f'combine_crops/{"/".join(str(v) for v in group_values)}'
+        graph.add_task(
+            name, _combine_journaled, journal, combine_agriculture_yearsets, list(df_group['yearset_path']),
+            spec['yearset_path'], force=config['force_recalculation'],
+            deps=[yearset_producers[i] for i in df_group.index], allow_failed_deps=True
+        )
+        rows.append(spec)
+        producers.append(name)
+        available.append(True)
 
+    # Combine hazards to multihazard yearsets
+    if config['do_multihazard']:
+        df_rows = pd.DataFrame(rows)
+        grouping_cols = ['i_scenario', 'sector', 'country']
+        for group_values, df_group in df_rows.groupby(grouping_cols):
+            spec = get_combined_hazard_yearset_spec(df_group)
+            spec.update(dict(zip(grouping_cols, group_values)))
+            name = f'combine_hazards/{"/".join(str(v) for v in group_values)}'
+            graph.add_task(
+                name, _combine_journaled, journal, combine_hazard_yearsets, list(df_group['yearset_path']),
+                spec['yearset_path'], spec['sector'], spec['country'], force=config['force_recalculation'],
+                deps=[producers[j] for j in df_group.index], allow_failed_deps=True
+            )
+            rows.append(spec)
+            producers.append(name)
+            available.append(True)
+
+    if config['do_indirect']:
+        n_skipped = len(available) - sum(available)
+        if n_skipped > 0:
+            LOGGER.info(f'No yearset data available for {n_skipped} analyses. Skipping their supply chain calculations')
+        indirect_finished = _get_indirect_finished(pd.DataFrame(rows), config, indirect_output_dir, journal)
+        for j, (row, producer) in enumerate(zip(rows, producers)):
+            if not available[j]:
+                continue
+            for io_a in config['io_approach']:
+                if indirect_finished.loc[j, io_a] and not config['force_recalculation']:
+                    continue
+                graph.add_task(
+                    f'indirect/{io_a}/{j}', _indirect_graph_task, row, io_a, config, direct_output_dir,
+                    indirect_output_dir, journal, deps=[producer]
+                )
+
+    LOGGER.info(f'The task graph has {len(graph)} tasks')
+    _ = graph.run(ncpus=config['ncpus'] if config['do_parallel'] else 1)
+
+    df = pd.DataFrame(rows)
+    artifact_index.refresh(df['direct_impact_path'])
+    artifact_index.refresh(df['yearset_path'])
+    df['_direct_impact_exists'] = [
+        artifact_index.exists(p) if isinstance(p, (str, os.PathLike)) else np.nan
+        for p in df['direct_impact_path']
+    ]
+    df['_yearset_exists'] = artifact_index.exists_many(df['yearset_path'])
+    df['_indirect_exists'] = _get_indirect_finished(df, config, indirect_output_dir, journal).all(axis=1)
+    return df
 
-def config_to_dataframe(
-        config: dict,
-        direct_output_dir: typing.Union[str, os.PathLike],
-        indirect_output_dir: typing.Union[str, os.PathLike]):
-    """Convert a run config to a dataframe of required model runs. 
-    Note: these don't include model runs that combine hazards, sectors and 
-    countries, which are created after this first set is run.
+
+def run_pipeline_worker_queue(analysis_df, config, direct_output_dir, indirect_output_dir, artifact_index, journal):
+    """Run the pipeline as the coordinator of a worker queue.
+
+    The direct impact, yearset and supply chain tasks are queued in the run
+    journal, to be claimed by workers started with
+    `python -m nccs.pipeline.worker <journal path>` on any machine sharing
+    the output filesystem. Once they're done the coordinator combines the
+    crop and multihazard yearsets, queues their supply chain tasks, and
+    when those are done closes the queue so the workers exit.
 
     Parameters
     ----------
+    analysis_df : pandas.DataFrame
+        Dataframe created by config_to_dataframe, with the
+        _direct_impact_calculate column set
     config : dict
-        A config object. See run_configurations/ for the format
+        The run configuration
     direct_output_dir : str or os.PathLike
-        Location to save direct impact modelling outputs
+        Location of direct impact outputs
     indirect_output_dir : str or os.PathLike
-        Location to save supply chain impact modelling outputs
-        
+        Location of indirect impact outputs
+    artifact_index : ArtifactIndex
+        Index of the existing output files
+    journal : RunJournal
+        The run journal, on a filesystem shared with the workers
+
     Returns
     -------
     pandas.DataFrame
-        A dataframe with one row for each simulation that will be run in the 
-        supply chain modelling, and the parameters required to run the 
-        simulations.
+        The analysis dataframe after crop and multihazard combination, with
+        _direct_impact_exists, _yearset_exists and _indirect_exists columns
     """
-    df = pd.DataFrame(
-        [
-            {
-                'hazard': run['hazard'],
-                'sector': sector,
-                'country': country,
-                'scenario': scenario['scenario'],
-                'i_scenario': i,
-                'ref_year': scenario['ref_year'],
-            }
-            for run in config['runs']
-            for i, scenario in enumerate(run['scenario_years'])
-            for country in run['countries']
-            for sector in run['sectors']
-        ]
+    journal.set_meta(QUEUE_CLOSED_KEY, False)
+    journal.set_meta(METRICS_PATH_KEY, get_metrics_path())
+    journal.set_meta(WORKER_ENV_KEY, {
+        IMPF_REGISTRY_PATH_ENV: get_impf_registry_path(),
+        EXPOSURE_CACHE_MB_ENV: get_exposure_cache_budget() / 1024 ** 2,
+        DATA_CATALOG_PATH_ENV: get_data_catalog_path(),
+        OFFLINE_DATA_ENV: '1' if is_offline() else None,
+    })
+    costs = estimate_direct_costs(analysis_df)
+    tasks = []
+
+    direct_producers = {}
+    if config['do_direct']:
+        df_calculate = analysis_df[analysis_df['_direct_impact_calculate']]
+        for _, df_group in df_calculate.groupby(HAZARD_GROUP_COLS, sort=False, observed=True):
+            r = df_group.iloc[0]
+            task_id = get_task_id('direct_hazard', '_'.join(str(r[k]) for k in HAZARD_GROUP_COLS))
+            tasks.append({
+                'task_id': task_id,
+                'stage': 'direct_hazard',
+                'func': 'nccs.analysis:_direct_queue_task',
+                'args': [df_group.to_dict('records'), config, journal.path],
+                'priority': costs[df_group.index].sum()
+            })
+            direct_producers.update({i: task_id for i in df_group.index})
+
+    # Which tasks are needed is decided here from the index, so the workers don't check for their files again
+    direct_finished = _get_finished(analysis_df['direct_impact_path'], 'direct', artifact_index, journal)
+    yearset_finished = _get_finished(analysis_df['yearset_path'], 'yearset', artifact_index, journal)
+    yearset_producers = {}
+    for (i, row), direct_done, yearset_done in zip(analysis_df.iterrows(), direct_finished, yearset_finished):
+        if not config['do_yearsets'] or (yearset_done and not config['force_recalculation']):
+            continue
+        if i not in direct_producers and not direct_done:
+            LOGGER.info(f'No direct impact data available. Skipping yearset: {row["yearset_path"]}')
+            continue
+        task_id = get_task_id('yearset', row['yearset_path'])
+        tasks.append({
+            'task_id': task_id,
+            'stage': 'yearset',
+            'output_path': row['yearset_path'],
+            'func': 'nccs.analysis:calculate_yearset',
+            'args': [row.to_dict(), config],
+            'deps': [direct_producers[i]] if i in direct_producers else [],
+            'priority': costs[i]
+        })
+        yearset_producers[i] = task_id
+
+    # Supply chains of the rows that aren't combined can start as soon as their yearsets exist
+    is_crop = analysis_df['hazard'].str.contains('relative_crop_yield')
+    yearset_available = pd.Series(yearset_finished, index=analysis_df.index) | analysis_df.index.isin(
+        list(yearset_producers)
+    )
+    tasks.extend(_get_indirect_queue_tasks(
+        analysis_df[~is_crop & yearset_available], config, direct_output_dir, indirect_output_dir, journal,
+        yearset_producers
+    ))
+    journal.enqueue(tasks)
+    LOGGER.info(f'Queued {len(tasks)} tasks. Start workers with:\npython -m nccs.pipeline.worker {journal.path}')
+    wait_for_queue(journal, DEFAULT_POLL_SECONDS)
+
+    artifact_index.refresh(analysis_df['direct_impact_path'])
+    artifact_index.refresh(analysis_df['yearset_path'])
+    analysis_df['_direct_impact_exists'] = _get_finished(
+        analysis_df['direct_impact_path'], 'direct', artifact_index, journal
     )
-    # unfold the agriculture sector into the different crop types
-    for crop_type in ["whe", "mai", "ric", "soy"]:
-        df_crop_yield = df[df['hazard'] == 'relative_crop_yield'].copy()
-        df_crop_yield['sector'] = df_crop_yield['sector'].apply(lambda x: f'{x}_{crop_type}')
-        df_crop_yield['hazard'] = df_crop_yield['hazard'].apply(lambda x: f'{x}_{crop_type}')
-        df = pd.concat([df, df_crop_yield])
-    df = df.reset_index(drop=True)
-    # Drop the original agriculture rows
-    df = df[df['hazard'] != 'relative_crop_yield']
+    analysis_df['_yearset_exists'] = _get_finished(analysis_df['yearset_path'], 'yearset', artifact_index, journal)
+
+    # Combine yearsets here, then queue the supply chains of the combined yearsets
+    single_yearset_paths = set(analysis_df.loc[~is_crop, 'yearset_path'])
+    df = combine_yearsets_from_df(analysis_df, config, journal)
+    is_combined = [
+        isinstance(p, (str, os.PathLike)) and os.fspath(p) not in single_yearset_paths for p in df['yearset_path']
+    ]
+    df_combined = df[pd.Series(is_combined, index=df.index) & df['_yearset_exists'].fillna(False).astype(bool)]
+    tasks = _get_indirect_queue_tasks(df_combined, config, direct_output_dir, indirect_output_dir, journal, {})
+    journal.enqueue(tasks)
+    LOGGER.info(f'Queued {len(tasks)} supply chain tasks for combined yearsets')
+    wait_for_queue(journal, DEFAULT_POLL_SECONDS)
+    journal.set_meta(QUEUE_CLOSED_KEY, True)
+
+    df['_indirect_exists'] = _get_indirect_finished(df, config, indirect_output_dir, journal).all(axis=1)
+    return df
+
 
+def _get_indirect_queue_tasks(df, config, direct_output_dir, indirect_output_dir, journal, yearset_producers):
+    """Queue tasks for the supply chains of each row of df that the journal
+    doesn't have as done or whose output is missing"""
+    if not config['do_indirect']:
+        return []
+    finished = _get_indirect_finished(df, config, indirect_output_dir, journal)
+    tasks = []
     for i, row in df.iterrows():
-        direct_impact_filename = folder_naming.get_direct_namestring(
-            prefix="impact_raw",
-            extension="hdf5",
-            haz_type=row['hazard'],
-            sector=row['sector'],
-            country_iso3alpha=row['country'],
-            scenario=row['scenario'],
-            ref_year=row['ref_year']
-        )
-        direct_impact_path = Path(direct_output_dir, "impact_raw", direct_impact_filename)
-        df.loc[i, 'direct_impact_path'] = direct_impact_path
+        for io_a in config['io_approach']:
+            if finished.loc[i, io_a] and not config['force_recalculation']:
+                continue
+            output_path = get_indirect_output_path(row, io_a, indirect_output_dir)
+            task_id = get_task_id(f'indirect_{io_a}', output_path)
+            tasks.append({
+                'task_id': task_id,
+                'stage': f'indirect_{io_a}',
+                'output_path': output_path,
+                'func': 'nccs.analysis:_indirect_graph_task',
+                'args': [row.to_dict(), io_a, config, os.fspath(direct_output_dir), os.fspath(indirect_output_dir)],
+                'deps': [yearset_producers[i]] if i in yearset_producers else []
+            })
+    return tasks
 
-        yearset_filename = folder_naming.get_direct_namestring(
-            prefix='yearset',
-            extension='hdf5',
-            haz_type=row['hazard'],
-            sector=row['sector'],
-            scenario=row['scenario'],
-            ref_year=row['ref_year'],
-            country_iso3alpha=row['country']
-        )
-        yearset_path = Path(direct_output_dir, "yearsets", yearset_filename)
-        df.loc[i, 'yearset_path'] = yearset_path
 
-    return df
+def _metrics_labels(calc):
+    return {k: calc[k] for k in ['hazard', 'sector', 'country', 'scenario', 'ref_year'] if k in calc}
 
 
-def calculate_direct_impacts_from_df(df, config):
-    for _, calc in df.iterrows():
-        # TODO subset the df before this check is made. Risk of some parallel processes having no work to do
-        if not calc['_direct_impact_calculate']:
+def _direct_queue_task(rows, config, journal_path):
+    calculate_direct_impacts_for_hazard(pd.DataFrame(rows), config, RunJournal(journal_path, shared=True))
+
+
+# The graph and queue only add these tasks when the planning found their inputs available and their outputs
+# missing or unfinished, so they don't check for files again
+def _yearset_graph_task(calc, config, journal=None):
+    _run_journaled(journal, get_task_id('yearset', calc['yearset_path']), calculate_yearset, calc, config, force=True)
+
+
+def _indirect_graph_task(row, io_a, config, direct_output_dir, indirect_output_dir, journal=None):
+    _run_journaled(
+        journal, get_task_id(f'indirect_{io_a}', get_indirect_output_path(row, io_a, indirect_output_dir)),
+        calculate_indirect_impact, row, io_a, config, direct_output_dir, indirect_output_dir, force=True
+    )
+
+
+def _run_journaled(journal, task_id, func, *args, force=False, **kwargs):
+    """Run func(*args, **kwargs), recording it in the journal as task_id if
+    there is one. Tasks the journal has as done are skipped unless force is
+    set, e.g. because the caller found their output missing."""
+    if journal is None:
+        return func(*args, **kwargs)
+    return journal.run(task_id, func, *args, force=force, **kwargs)
+
+
+def _combine_journaled(journal, func, yearset_paths, combined_path, *args, force=False):
+    """Combine yearsets with func, recording it in the journal as a combine
+    task if there is one. func itself skips combinations whose output is up to
+    date with their inputs unless force is set, which is more precise than the
+    journal, so the journal always lets it run."""
+    return _run_journaled(
+        journal, get_task_id('combine', combined_path), partial(func, force=force), yearset_paths, combined_path,
+        *args, force=True
+    )
+
+
+def _get_finished(paths, stage, artifact_index, journal=None):
+    """Whether each output of a stage exists and, if there is a run journal,
+    wasn't written by a task that started and didn't finish
+
+    Returns
+    -------
+    list of bool
+    """
+    interrupted = set() if journal is None else journal.get_interrupted(stage)
+    return [
+        exists and get_task_id(stage, p) not in interrupted
+        for p, exists in zip(paths, artifact_index.exists_many(paths))
+    ]
+
+
+def _get_indirect_finished(df, config, indirect_output_dir, journal=None):
+    """Whether each supply chain output of each row of df exists and, if
+    there is a run journal, was written by a task it has as done. The output
+    directory is listed once instead of checking each file, and outputs the
+    journal has as done but that were deleted since are reported missing.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Of bool, with the index of df and a column for each io_approach
+    """
+    index = ArtifactIndex([indirect_output_dir])
+    done = None if journal is None else journal.get_done_with_output()
+    finished = {}
+    for io_a in config['io_approach']:
+        finished[io_a] = []
+        for _, row in df.iterrows():
+            if not isinstance(row['yearset_path'], (str, os.PathLike)):
+                finished[io_a].append(False)
+                continue
+            output_path = get_indirect_output_path(row, io_a, indirect_output_dir)
+            finished[io_a].append(index.exists(output_path) and (
+                done is None or get_task_id(f'indirect_{io_a}', output_path) in done
+            ))
+    return pd.DataFrame(finished, index=df.index, columns=config['io_approach'], dtype=bool)
+
+
+def start_input_prefetch(df, config):
+    """Start downloading the S3 input files of the analyses in df in the
+    background, those of the most expensive analyses (which run first) first.
+
+    Returns
+    -------
+    nccs.pipeline.prefetch.Prefetcher
+    """
+    files = []
+    for df_group in order_by_cost(df, estimate_direct_costs(df), by=HAZARD_GROUP_COLS):
+        for row in df_group[['hazard', 'sector', 'country', 'scenario', 'ref_year']].itertuples():
+            files.extend(get_s3_input_files(row.hazard, row.sector, row.country, row.scenario, row.ref_year))
+    prefetcher = Prefetcher(
+        files,
+        max_workers=config.get('prefetch_workers', 4),
+        max_mb_per_s=config.get('prefetch_max_mb_per_s', None)
+    )
+    return prefetcher.start()
+
+
+def calculate_direct_impacts_from_df(df, config, journal=None):
+    """Calculate the direct impacts flagged in _direct_impact_calculate.
+
+    Rows are grouped by hazard, country, scenario and reference year so that
+    each hazard is loaded once and used for all the sectors that need it.
+    """
+    df_calculate = df[df['_direct_impact_calculate']]
+    for _, df_group in df_calculate.groupby(HAZARD_GROUP_COLS, sort=False, observed=True):
+        try:
+            calculate_direct_impacts_for_hazard(df_group, config, journal)
+        except Exception:
+            # The failures are logged where they happen. The stage goes on with the other hazards
             continue
 
+
+def calculate_direct_impacts_for_hazard(df, config, journal=None):
+    """Calculate the direct impacts for rows of an analysis dataframe that
+    share a hazard, country, scenario and reference year, loading the hazard
+    only once.
+
+    Raises
+    ------
+    Exception
+        If the hazard can't be loaded, or, once the other sectors are done,
+        if any sector's impact failed, so that task runners record the task
+        as failed
+    """
+    r = df.iloc[0]
+    hazard_dict = {k: r[k] for k in HAZARD_GROUP_COLS}
+    try:
+        with TaskMetrics('load_hazard', **hazard_dict) as metrics:
+            haz = get_hazard(r['hazard'], r['country_iso3alpha'], r['scenario'], r['ref_year'])
+            metrics.record(n_events=haz.size)
+    except Exception:
+        LOGGER.error(f"Error loading the hazard for {hazard_dict}. Skipping {df.shape[0]} direct impacts:",
+                     exc_info=True)
+        raise
+
+    impacts = {}
+    if config.get('batch_direct_sectors', True) and df['sector'].nunique() > 1:
+        impacts = calculate_batched_direct_impacts(df, config, haz)
+
+    errors = []
+    for _, calc in df.iterrows():
         logging_dict = {k: calc[k] for k in ['hazard', 'sector', 'country', 'scenario', 'ref_year']}
         try:
+            # Only rows found missing or unfinished are flagged for calculation
+            _run_journaled(
+                journal, get_task_id('direct', calc['direct_impact_path']), calculate_direct_impact, calc, config,
+                haz=haz, imp=impacts.pop(calc['sector'], None), force=True
+            )
+        except Exception as e:
+            LOGGER.error(f"Error calculating direct impacts for {logging_dict}:", exc_info=True)
+            errors.append(e)
+    if errors:
+        raise RuntimeError(
+            f'{len(errors)} of {df.shape[0]} direct impacts failed for {hazard_dict}. First error: {errors[0]!r}'
+        ) from errors[0]
+
+
+def calculate_batched_direct_impacts(df, config, haz):
+    """Calculate the direct impacts of all the sectors in rows of an analysis
+    dataframe that share a hazard, country, scenario and reference year in one
+    impact calculation.
+
+    Only sectors that share impact functions are batched (see
+    get_batchable_sectors).
+
+    Returns
+    -------
+    dict
+        Impact of each batched sector. Sectors not batched, or all sectors if
+        the batched calculation failed, are calculated one by one.
+    """
+    r = df.iloc[0]
+    sectors = get_batchable_sectors(
+        haz_type=r['hazard'],
+        sectors=list(pd.unique(df['sector'])),
+        country=r['country'],
+        business_interruption=config['business_interruption'],
+        calibrated=config['calibrated'],
+        use_sector_bi_scaling=config['use_sector_bi_scaling']
+    )
+    if len(sectors) < 2:
+        return {}
+    with TaskMetrics('direct_batch', hazard=r['hazard'], country=r['country'], scenario=r['scenario'],
+                     ref_year=r['ref_year'], n_sectors=len(sectors)) as metrics:
+        try:
+            impacts = nccs_direct_impacts_batched(
+                haz_type=r['hazard'],
+                sectors=sectors,
+                country=r['country'],
+                scenario=r['scenario'],
+                ref_year=r['ref_year'],
+                business_interruption=config['business_interruption'],
+                calibrated=config['calibrated'],
+                use_sector_bi_scaling=config['use_sector_bi_scaling'],
+                haz=haz,
+                cache_centroids=config.get('cache_centroid_assignments', True),
+                chunk_size=config.get('direct_chunk_size'),
+                n_chunk_workers=config.get('direct_chunk_workers', 1)
+            )
+        except (ValueError, MemoryError) as e:
+            # Sectors whose exposures or impact functions can't be stacked, or a stacked exposure too big for memory
+            LOGGER.warning(f"Batched direct impacts failed for {r['hazard']}, {r['country']}, {r['scenario']}, "
+                           f"{r['ref_year']}. Calculating sectors one by one", exc_info=True)
+            metrics.record(fallback=True, error=repr(e))
+            return {}
+        metrics.record(fallback=False, n_events=haz.size,
+                       n_exposure_points=sum(len(imp.coord_exp) for imp in impacts.values()))
+    return impacts
+
+
+def calculate_direct_impact(calc, config, haz=None, imp=None):
+    """Calculate and write the direct impact for one row of an analysis
+    dataframe created by config_to_dataframe. If the row's hazard is already
+    loaded it can be passed as haz, and if its impact is already calculated
+    (see calculate_batched_direct_impacts) as imp."""
+    with TaskMetrics('direct', calc['direct_impact_path'], batched=imp is not None,
+                     **_metrics_labels(calc)) as metrics:
+        if imp is None:
             imp = nccs_direct_impacts_simple(
                 haz_type=calc['hazard'],
                 sector=calc['sector'],
@@ -327,32 +913,62 @@ def calculate_direct_impacts_from_df(df, config):
                 ref_year=calc['ref_year'],
                 business_interruption=config['business_interruption'],
                 calibrated=config['calibrated'],
-                use_sector_bi_scaling=config['use_sector_bi_scaling']
+                use_sector_bi_scaling=config['use_sector_bi_scaling'],
+                haz=haz,
+                cache_centroids=config.get('cache_centroid_assignments', True),
+                chunk_size=config.get('direct_chunk_size'),
+                n_chunk_workers=config.get('direct_chunk_workers', 1)
             )
-            write_impact_to_file(imp, calc['direct_impact_path'], config['use_s3'])
-        except Exception as e:
-            LOGGER.error(f"Error calculating direct impacts for {logging_dict}:", exc_info=True)
+        set_matrix_dtype(imp, config.get('impact_dtype', 'float64'))
+        event_totals, event_set = None, None
+        if config.get('prune_zero_events', False):
+            n_events = len(imp.event_id)
+            event_set = (imp.event_id, imp.frequency)
+            imp, event_totals = prune_zero_events(imp)
+            metrics.record(n_events_pruned=n_events - len(imp.event_id))
+        write_impact_to_file(
+            imp, calc['direct_impact_path'], config['use_s3'], event_totals=event_totals, event_set=event_set
+        )
+        metrics.record(**impact_size_metrics(imp))
+    if config.get('use_artifact_store', False):
+        store_artifact(calc['direct_impact_path'], calc['direct_impact_key'], 'impact_raw')
 
 
-def calculate_yearsets_from_df(df, config):
+def calculate_yearsets_from_df(df, config, journal=None):
     for _, calc in df.iterrows():
         if not calc['_yearset_calculate']:
             continue
         logging_dict = {k: calc[k] for k in ['hazard', 'sector', 'country', 'scenario', 'ref_year']}
-        LOGGER.info(f'Generating yearsets for {logging_dict}')
         try:
-            imp_yearset = create_single_yearset(
-                calc,
-                n_sim_years=config['n_sim_years'],
-                seed=config['seed'],
-            )
-            write_impact_to_file(imp_yearset, calc['yearset_path'], config['use_s3'])
+            # Only rows found missing or unfinished are flagged for calculation
+            _run_journaled(journal, get_task_id('yearset', calc['yearset_path']), calculate_yearset, calc, config,
+                           force=True)
         except Exception as e:
             LOGGER.error(f"Error calculating an indirect yearset for {logging_dict}", exc_info=True)
 
 
+def calculate_yearset(calc, config):
+    """Generate and write the yearset for one row of an analysis dataframe
+    created by config_to_dataframe. The row's direct impact must exist."""
+    logging_dict = {k: calc[k] for k in ['hazard', 'sector', 'country', 'scenario', 'ref_year']}
+    LOGGER.info(f'Generating yearsets for {logging_dict}')
+    with TaskMetrics('yearset', calc['yearset_path'], **_metrics_labels(calc)) as metrics:
+        imp_yearset = create_single_yearset(
+            calc,
+            n_sim_years=config['n_sim_years'],
+            seed=config['seed'],
+            share_sampling_plans=config.get('share_sampling_plans', True)
+        )
+        write_impact_to_file(imp_yearset, calc['yearset_path'], config['use_s3'])
+        metrics.record(**impact_size_metrics(imp_yearset))
+    if config.get('use_artifact_store', False):
+        store_artifact(calc['yearset_path'], calc['yearset_key'], 'yearsets')
+
+
 def df_create_combined_hazard_yearsets(
-        df: pd.DataFrame
+        df: pd.DataFrame,
+        force: bool = False,
+        journal: RunJournal = None
 ):
     """For each grouping of scenario, country and sector, combine hazard yearsets 
 
@@ -360,6 +976,10 @@ def df_create_combined_hazard_yearsets(
     ----------
     df : pandas.DataFrame
         Dataframe containing analyses metadata created by config_to_dataframe
+    force : bool
+        Combine the yearsets even if the combined yearset is up to date
+    journal : nccs.pipeline.run_journal.RunJournal, optional
+        Journal to record the combination in
 
     Returns
     -------
@@ -372,10 +992,22 @@ def df_create_combined_hazard_yearsets(
     This function adapts pymrio.tools.iomath.calc_x to compute
     value added (v).
     """
+    out = get_combined_hazard_yearset_spec(df)
+    LOGGER.info(df.iloc[0].to_dict())
+    out['_yearset_exists'] = bool(_combine_journaled(
+        journal, combine_hazard_yearsets, list(df['yearset_path']), out['yearset_path'], df.iloc[0]['sector'],
+        df.iloc[0]['country'], force=force
+    ))
+    if not out['_yearset_exists']:
+        del out['yearset_path']
+    return pd.Series(out)
+
 
+def get_combined_hazard_yearset_spec(df: pd.DataFrame):
+    """Metadata, including the output path, of the multihazard yearset
+    combining the yearsets of one scenario, country and sector."""
     r = df.iloc[0].to_dict()
     yearset_output_dir = os.path.dirname(r['yearset_path'])
-    LOGGER.info(r)
     combined_filename = folder_naming.get_direct_namestring(
         prefix='yearset',
         extension='hdf5',
@@ -385,35 +1017,55 @@ def df_create_combined_hazard_yearsets(
         ref_year=r['ref_year'],
         country_iso3alpha=r['country']
     )
-    combined_path = Path(yearset_output_dir, combined_filename)
-
-    impact_list = [get_impact_from_file(f) for f in df['yearset_path'] if os.path.exists(f)]
-
-    out = {
+    return {
         'hazard': 'COMBINED',
         'scenario': r['scenario'],
         'ref_year': r['ref_year'],
+        'yearset_path': Path(yearset_output_dir, combined_filename)
     }
 
-    if len(impact_list) > 0:
+
+def combine_hazard_yearsets(yearset_paths, combined_path, sector, country, force=False):
+    """Combine the existing yearsets from a list of paths into a multihazard
+    yearset, capped at the sector exposure. Skipped if the combined yearset
+    was made from the current versions of the same yearsets, unless force is
+    set.
+
+    Returns
+    -------
+    bool
+        Whether any yearsets were found and the combined yearset is written
+    """
+    with TaskMetrics('combine', combined_path, hazard='COMBINED', sector=sector, country=country) as metrics:
+        paths = [f for f in yearset_paths if os.path.exists(f)]
+        if len(paths) == 0:
+            metrics.fail('No yearsets to combine')
+            return False
+        if not force and is_combination_up_to_date(combined_path, paths):
+            LOGGER.info(f'Combined yearset {combined_path} is up to date with its yearsets. Skipping')
+            return True
         combined = combine_yearsets(
-            impact_list=impact_list,
-            cap_exposure=get_sector_exposure(r['sector'], r['country'])
+            impact_list=iter_impacts_from_files(paths),
+            cap_exposure=get_sector_cap_vector(sector, country)
         )
         # TODO drop the impact matrix to save RAM/HD space once SupplyChain is updated and doesn't need it
+        write_combined_yearset(combined, combined_path, paths)
+        metrics.record(n_inputs=len(paths), **impact_size_metrics(combined))
+    return True
 
-        combined.write_hdf5(combined_path)
-        out['yearset_path'] = combined_path
-        out['_yearset_exists'] = True
-        # out['annual_impacts'] = combined.at_event
-    else:
-        out['_yearset_exists'] = False
 
-    return pd.Series(out)
+def write_combined_yearset(combined, combined_path, yearset_paths):
+    """Write a combined yearset, with the yearset files it was made from, so
+    that the file is either absent or complete"""
+    with atomic_path(combined_path) as tmp_path:
+        combined.write_hdf5(tmp_path)
+        write_combined_inputs(tmp_path, yearset_paths)
 
 
 def df_create_combined_hazard_yearsets_agriculture(
-        df: pd.DataFrame
+        df: pd.DataFrame,
+        force: bool = False,
+        journal: RunJournal = None
 ):
     """For each grouping of scenario, country and sector, combine hazard yearsets
 
@@ -421,6 +1073,10 @@ def df_create_combined_hazard_yearsets_agriculture(
     ----------
     df : pandas.DataFrame
         Dataframe containing analyses metadata created by config_to_dataframe
+    force : bool
+        Combine the yearsets even if the combined yearset is up to date
+    journal : nccs.pipeline.run_journal.RunJournal, optional
+        Journal to record the combination in
 
     Returns
     -------
@@ -433,10 +1089,21 @@ def df_create_combined_hazard_yearsets_agriculture(
     This function adapts pymrio.tools.iomath.calc_x to compute
     value added (v).
     """
+    out = get_combined_agriculture_yearset_spec(df)
+    LOGGER.info(df.iloc[0].to_dict())
+    out['_yearset_exists'] = bool(_combine_journaled(
+        journal, combine_agriculture_yearsets, list(df['yearset_path']), out['yearset_path'], force=force
+    ))
+    if not out['_yearset_exists']:
+        del out['yearset_path']
+    return pd.Series(out)
+
 
+def get_combined_agriculture_yearset_spec(df: pd.DataFrame):
+    """Metadata, including the output path, of the agriculture yearset
+    combining the crop yearsets of one scenario and country."""
     r = df.iloc[0].to_dict()
     yearset_output_dir = os.path.dirname(r['yearset_path'])
-    LOGGER.info(r)
     combined_filename = folder_naming.get_direct_namestring(
         prefix='yearset',
         extension='hdf5',
@@ -446,35 +1113,46 @@ def df_create_combined_hazard_yearsets_agriculture(
         ref_year=r['ref_year'],
         country_iso3alpha=r['country']
     )
-    combined_path = Path(yearset_output_dir, combined_filename)
-
-    impact_list = [get_impact_from_file(f) for f in df['yearset_path'] if os.path.exists(f)]
-
-    out = {
+    return {
         'hazard': 'relative_crop_yield',
         'scenario': r['scenario'],
         'ref_year': r['ref_year'],
-        'sector': 'agriculture'
+        'sector': 'agriculture',
+        'yearset_path': Path(yearset_output_dir, combined_filename)
     }
 
-    if len(impact_list) > 0:
+
+def combine_agriculture_yearsets(yearset_paths, combined_path, force=False):
+    """Sum the existing crop yearsets from a list of paths into one
+    agriculture yearset. Skipped if the combined yearset was made from the
+    current versions of the same yearsets, unless force is set.
+
+    Returns
+    -------
+    bool
+        Whether any yearsets were found and the combined yearset is written
+    """
+    with TaskMetrics('combine', combined_path, hazard='relative_crop_yield', sector='agriculture') as metrics:
+        paths = [f for f in yearset_paths if os.path.exists(f)]
+        if len(paths) == 0:
+            metrics.fail('No yearsets to combine')
+            return False
+        if not force and is_combination_up_to_date(combined_path, paths):
+            LOGGER.info(f'Combined yearset {combined_path} is up to date with its yearsets. Skipping')
+            return True
         combined = combine_yearsets(
-            impact_list=impact_list
+            impact_list=iter_impacts_from_files(paths)
         )
-        combined.write_hdf5(combined_path)
-        out['yearset_path'] = combined_path
-        out['_yearset_exists'] = True
-        # out['annual_impacts'] = combined.at_event
-    else:
-        out['_yearset_exists'] = False
-
-    return pd.Series(out)
+        write_combined_yearset(combined, combined_path, paths)
+        metrics.record(n_inputs=len(paths), **impact_size_metrics(combined))
+    return True
 
 
 def create_single_yearset(
         analysis_spec: pd.DataFrame,
         n_sim_years: int,
         seed: int,
+        share_sampling_plans: bool = False,
 ):
     """Take the metadata for an analysis and create an impact yearset if it 
     doesn't already exist. These are created as files and a `yearset_path` added
@@ -482,44 +1160,96 @@ def create_single_yearset(
 
     Parameters
     ----------
-    analysis_spec : pd.Series
+    analysis_spec : pd.Series or dict
         A row of a dataframe created by config_to_dataframe
     n_sim_years : int
         Number of years to create for each output yearset
     seed : int
         The random number seed to use in each yearset's sampling
+    share_sampling_plans : bool
+        Sample the years from a plan shared by all impacts over the same event
+        set (see nccs.pipeline.direct.sampling_plan), stored next to the
+        yearset. All sectors of a hazard group then have the same years.
+        Poisson-sampled impacts with pruned zero-impact events always use a
+        plan of their full event set.
     """
-    row = analysis_spec.copy().to_dict()
-    imp = get_impact_from_file(row['direct_impact_path'])
-
-    poisson_hazards = ['tropical_cyclone', 'sea_level_rise']
-    poisson = row['hazard'] in poisson_hazards
-
-    # TODO we don't actually want to generate a yearset if we're looking at observed events
-    imp_yearset = yearset_from_imp(
-        imp,
-        n_sim_years,
-        poisson=poisson,
-        cap_exposure=get_sector_exposure(row['sector'], row['country']),
-        seed=seed
-    )
+    row = dict(analysis_spec)
+    poisson = row['hazard'] in POISSON_HAZARDS
+
+    samp_vec = None
+    event_totals = read_event_totals(row['direct_impact_path'])
+    # Poisson sampling of a pruned impact must follow a plan over its full event set to match the unpruned impact
+    use_plan = share_sampling_plans or (poisson and len(event_totals) > 0)
+    event_set = read_full_event_set(row['direct_impact_path']) if use_plan else None
+
+    # Only the sampled rows of the impact matrix are read from the file
+    with get_impact_from_file(row['direct_impact_path'], lazy=True) as lazy_imp:
+        if event_set is not None:
+            plan_dir = Path(os.path.dirname(row['yearset_path']), 'sampling_plans')
+            plan = get_sampling_plan(*event_set, n_sim_years, poisson, seed, plan_dir=plan_dir)
+            samp_vec = apply_sampling_plan(plan, event_set[0], lazy_imp.event_id)
+        # TODO we don't actually want to generate a yearset if we're looking at observed events
+        imp_yearset = yearset_from_imp(
+            lazy_imp.to_impact(imp_mat=False),
+            n_sim_years,
+            poisson=poisson,
+            cap_exposure=get_sector_cap_vector(row['sector'], row['country']),
+            seed=seed,
+            imp_mat=lazy_imp.imp_mat,
+            samp_vec=samp_vec,
+            **event_totals
+        )
     # TODO drop the impact matrix to save RAM/HD space once SupplyChain is updated and doesn't need it
     return imp_yearset
 
 
-def calculate_indirect_impacts_from_df(df, io_a, config, direct_output_dir, indirect_output_dir):
+def calculate_indirect_impacts_from_df(df, io_a, config, direct_output_dir, indirect_output_dir, journal=None):
     # TODO consider some sort of grouping so that we don't need to load sector exposures each time...
-    # No need to parallelise this: it already seems to max out the CPUs
-    for i, row in df.iterrows():
-        logging_dict = {k: row[k] for k in ['hazard', 'sector', 'country', 'scenario', 'ref_year']}
+    rows = [(i, row) for i, row in df.iterrows() if row['_indirect_calculate']]
+    n_skipped = df.shape[0] - len(rows)
+    if n_skipped > 0:
+        LOGGER.info(f'No yearset data available for {n_skipped} analyses. Skipping their supply chain calculations')
+
+    calc_partial = partial(
+        _calculate_indirect_impact_logged,
+        io_a=io_a,
+        config=config,
+        direct_output_dir=direct_output_dir,
+        indirect_output_dir=indirect_output_dir,
+        journal=journal
+    )
+    if config['do_parallel']:
+        # Each worker loads the MRIO table once when it starts and reuses it for all the rows it is given
+        with pa.multiprocessing.ProcessPool(config['ncpus'], initializer=init_supply_chain_worker) as pool:
+            results = list(pool.uimap(calc_partial, rows))
+    else:
+        results = [calc_partial(row) for row in rows]
 
-        if not row['_indirect_calculate']:
-            LOGGER.info('No yearset data available. Skipping supply chain calculation')
-            continue
+    for i, exists in results:
+        if exists:
+            df.loc[i, '_indirect_exists'] = True
 
-        # TODO put this in a function: it's used in the supply_chain_climada method too
-        country_iso3alpha = pycountry.countries.get(name=row['country']).alpha_3
-        supchain_indirect_output_path = f"{indirect_output_dir}/" \
+
+def _calculate_indirect_impact_logged(i_row, io_a, config, direct_output_dir, indirect_output_dir, journal=None):
+    i, row = i_row
+    logging_dict = {k: row[k] for k in ['hazard', 'sector', 'country', 'scenario', 'ref_year']}
+    try:
+        task_id = get_task_id(f'indirect_{io_a}', get_indirect_output_path(row, io_a, indirect_output_dir))
+        # Rows are only flagged when one of their outputs was found missing or unfinished, and the journal may still
+        # have a deleted output as done. An output that does exist is skipped by calculate_indirect_impact itself
+        return i, bool(_run_journaled(
+            journal, task_id, calculate_indirect_impact, row, io_a, config, direct_output_dir, indirect_output_dir,
+            force=True
+        ))
+    except Exception as e:
+        LOGGER.error(f"Error calculating indirect impacts for {logging_dict}:", exc_info=True)
+        return i, False
+
+
+def get_indirect_output_path(row, io_a, indirect_output_dir):
+    # TODO put this in a function: it's used in the supply_chain_climada method too
+    country_iso3alpha = pycountry.countries.get(name=row['country']).alpha_3
+    return f"{indirect_output_dir}/" \
            f"indirect_impacts" \
            f"_{row['hazard']}" \
            f"_{row['sector'].replace(' ', '_')[:15]}" \
@@ -529,55 +1259,70 @@ def calculate_indirect_impacts_from_df(df, io_a, config, direct_output_dir, indi
            f"_{country_iso3alpha}" \
            f".csv"
 
-        if os.path.exists(supchain_indirect_output_path):
-            LOGGER.info(f'Output already exists, skipping calculation: {supchain_indirect_output_path}')
-            continue
 
-        try:
-            LOGGER.info(f"Calculating indirect {io_a} supply chain for {logging_dict}...")
-            imp = Impact.from_hdf5(row['yearset_path'])
+def calculate_indirect_impact(row, io_a, config, direct_output_dir, indirect_output_dir):
+    """Model the supply chain for one row of an analysis dataframe and write
+    the direct and indirect results to csv.
+
+    Returns
+    -------
+    bool
+        Whether the indirect output exists after the calculation
+    """
+    logging_dict = {k: row[k] for k in ['hazard', 'sector', 'country', 'scenario', 'ref_year']}
+    supchain_indirect_output_path = get_indirect_output_path(row, io_a, indirect_output_dir)
 
-            if not imp.at_event.any():
+    if os.path.exists(supchain_indirect_output_path):
+        LOGGER.info(f'Output already exists, skipping calculation: {supchain_indirect_output_path}')
+        return True
+
+    LOGGER.info(f"Calculating indirect {io_a} supply chain for {logging_dict}...")
+    with TaskMetrics(f'indirect_{io_a}', supchain_indirect_output_path, input_path=row['yearset_path'],
+                     io_approach=io_a, **_metrics_labels(row)) as metrics:
+        # Check for impacts before loading the whole yearset
+        with get_impact_from_file(row['yearset_path'], lazy=True) as lazy_imp:
+            metrics.record(n_events=lazy_imp.n_events, nnz=lazy_imp.imp_mat.nnz)
+            if not lazy_imp.at_event.any():
                 # TODO return an object with zero losses so that there's data
                 LOGGER.info("No non-zero impacts. Skipping")
-                continue
-            supchain = supply_chain_climada(
-                get_sector_exposure(sector=row['sector'], country=row['country']),
-                imp,
-                impacted_sector=row['sector'],
-                io_approach=io_a
-            )
-            # save direct impacts to a csv
-            # TODO: also save to S3
-            dump_direct_to_csv(
-                supchain=supchain,
-                haz_type=row['hazard'],
-                sector=row['sector'],
-                scenario=row['scenario'],
-                ref_year=row['ref_year'],
-                country=row['country'],
-                n_sim=config['n_sim_years'],
-                return_period=100,
-                output_dir=direct_output_dir
-            )
-            # save indirect impacts to a csv
-            # TODO: also save to S3
-            dump_supchain_to_csv(
-                supchain=supchain,
-                haz_type=row['hazard'],
-                sector=row['sector'],
-                scenario=row['scenario'],
-                ref_year=row['ref_year'],
-                country=row['country'],
-                n_sim=config['n_sim_years'],
-                return_period=100,
-                io_approach=io_a,
-                output_dir=indirect_output_dir
-            )
-            df.loc[i, '_indirect_exists'] = True
-
-        except Exception as e:
-            LOGGER.error(f"Error calculating indirect impacts for {logging_dict}:", exc_info=True)
+                return False
+            imp = lazy_imp.to_impact()
+        exp = get_sector_exposure(sector=row['sector'], country=row['country'])
+        metrics.record(n_exposure_points=exp.gdf.shape[0])
+        supchain = supply_chain_climada(
+            exp,
+            imp,
+            impacted_sector=row['sector'],
+            io_approach=io_a
+        )
+        # save direct impacts to a csv
+        # TODO: also save to S3
+        dump_direct_to_csv(
+            supchain=supchain,
+            haz_type=row['hazard'],
+            sector=row['sector'],
+            scenario=row['scenario'],
+            ref_year=row['ref_year'],
+            country=row['country'],
+            n_sim=config['n_sim_years'],
+            return_period=100,
+            output_dir=direct_output_dir
+        )
+        # save indirect impacts to a csv
+        # TODO: also save to S3
+        dump_supchain_to_csv(
+            supchain=supchain,
+            haz_type=row['hazard'],
+            sector=row['sector'],
+            scenario=row['scenario'],
+            ref_year=row['ref_year'],
+            country=row['country'],
+            n_sim=config['n_sim_years'],
+            return_period=100,
+            io_approach=io_a,
+            output_dir=indirect_output_dir
+        )
+    return True
 
 
 def exists_impact_file(filepath: str, use_s3: bool = False):
@@ -604,7 +1349,7 @@ def exists_impact_file(filepath: str, use_s3: bool = False):
     return False
 
 
-def get_impact_from_file(filepath: str, use_s3: bool = False):
+def get_impact_from_file(filepath: str, use_s3: bool = False, lazy: bool = False):
     """Load an impact object from a filepath, checking the corresponding 
     location on the S3 bucket if requested if the file is not present locally.
 
@@ -614,26 +1359,47 @@ def get_impact_from_file(filepath: str, use_s3: bool = False):
         Path to requested file
     use_s3 : bool
         If True, check for a file with this name on the s3 bucket as well 
+    lazy : bool
+        If True, return a LazyImpact that reads datasets as they are used and
+        memory-maps the impact matrix
 
     Returns
     -------
-    climada.engine.impact.Impact
+    climada.engine.impact.Impact or nccs.pipeline.direct.lazy_impact.LazyImpact
         CLIMADA Impact object loaded from the filepath
     """
+    read = LazyImpact if lazy else Impact.from_hdf5
     if os.path.exists(filepath):
-        return Impact.from_hdf5(filepath)
+        return read(filepath)
     if use_s3:
         filename = os.path.basename(filepath)
         download_from_s3_bucket(s3_filename=filename, output_path=filepath)
-        return Impact.from_hdf5(filepath)
+        return read(filepath)
     raise FileExistsError(f"Could not find an impact object at {filepath}")
 
 
-def write_impact_to_file(imp, filepath: str, use_s3: bool = False):
-    imp.write_hdf5(filepath)
-    if use_s3:
-        filename = os.path.basename(filepath)
-        upload_to_s3_bucket(filename)
+def iter_impacts_from_files(filepaths, use_s3: bool = False):
+    """Open impact files one at a time as LazyImpacts, closing each when the
+    next is requested. For folding many yearsets together without holding
+    them all open (see combine_yearsets)."""
+    for filepath in filepaths:
+        with get_impact_from_file(filepath, use_s3=use_s3, lazy=True) as imp:
+            yield imp
+
+
+def write_impact_to_file(imp, filepath: str, use_s3: bool = False, event_totals: dict = None, event_set=None):
+    # The file is completed, and uploaded, under a temporary name and then renamed over filepath, so readers never
+    # see a partial file. The rename also leaves alone any artifact store entry the old file was hard linked to.
+    with atomic_path(filepath) as tmp_path:
+        imp.write_hdf5(tmp_path)
+        # Impacts with their zero-impact events dropped record the size of the full event set, and the event set
+        # itself
+        if event_totals is not None:
+            write_event_totals(tmp_path, event_totals)
+        if event_set is not None and len(event_set[0]) != len(imp.event_id):
+            write_full_event_set(tmp_path, *event_set)
+        if use_s3:
+            upload_to_s3_bucket(tmp_path, os.path.basename(filepath))
 
 
 def _check_config_valid_for_indirect_aggregations(config):
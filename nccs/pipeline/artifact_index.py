@@ -0,0 +1,82 @@
+"""
+An in-memory index of which impact and yearset files exist.
+
+Planning a run checks the existence of every direct impact and yearset in it,
+several times. Instead of a stat (and, with S3, a HEAD request) per file per
+check, the index is built from one scan of each local output directory and
+one paginated listing of the S3 bucket. Checks are then answered from memory,
+and the index is updated for just the files a stage has (re)written.
+"""
+
+import logging
+import os
+
+from nccs.utils.s3client import list_s3_bucket_keys
+
+LOGGER = logging.getLogger(__name__)
+
+# Impacts and yearsets are uploaded to the root of the bucket under their file name (see write_impact_to_file), so
+# these are the prefixes that cover them
+S3_ARTIFACT_PREFIXES = ('impact_raw_', 'yearset_')
+
+
+def _normpath(path):
+    return os.path.normpath(os.path.abspath(os.fspath(path)))
+
+
+class ArtifactIndex:
+    """The set of output files present locally and, optionally, on S3.
+
+    Local files are matched by their full path, files on S3 by their file name
+    (the same key get_impact_from_file downloads).
+
+    Examples
+    --------
+        >>> index = ArtifactIndex([impact_dir, yearset_dir], use_s3=True)
+        >>> df['_direct_impact_exists'] = index.exists_many(df['direct_impact_path'])
+        >>> ...  # calculate the missing impacts
+        >>> index.refresh(df_calculated['direct_impact_path'])
+    """
+
+    def __init__(self, local_dirs=(), use_s3=False, s3_prefixes=S3_ARTIFACT_PREFIXES):
+        self.use_s3 = use_s3
+        self.local_paths = set()
+        self.s3_filenames = set()
+        for d in local_dirs:
+            self.scan_dir(d)
+        if use_s3:
+            for prefix in s3_prefixes:
+                self.s3_filenames.update(os.path.basename(key) for key in list_s3_bucket_keys(prefix))
+        LOGGER.debug(
+            f'Indexed {len(self.local_paths)} local files and {len(self.s3_filenames)} files on S3'
+        )
+
+    def scan_dir(self, directory):
+        """Add the files in a local directory (not recursively) to the index"""
+        if not os.path.isdir(directory):
+            return
+        with os.scandir(directory) as entries:
+            self.local_paths.update(_normpath(entry.path) for entry in entries if entry.is_file())
+
+    def exists(self, path):
+        """Whether the file at path exists locally or, if use_s3 is set, on S3"""
+        if _normpath(path) in self.local_paths:
+            return True
+        return self.use_s3 and os.path.basename(os.fspath(path)) in self.s3_filenames
+
+    def exists_many(self, paths):
+        """exists() for each path in an iterable, as a list of bool"""
+        return [self.exists(p) for p in paths]
+
+    def refresh(self, paths):
+        """Update the index for files that may have been written or removed
+        since it was built, e.g. the outputs of a stage that just finished.
+        Only the local filesystem is checked."""
+        for p in paths:
+            if not isinstance(p, (str, os.PathLike)):
+                continue
+            path = _normpath(p)
+            if os.path.exists(path):
+                self.local_paths.add(path)
+            else:
+                self.local_paths.discard(path)
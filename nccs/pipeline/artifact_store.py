@@ -0,0 +1,284 @@
+"""
+A content-addressed store for direct impacts and yearsets, shared between runs.
+
+Each artifact is keyed by a hash of the inputs that determine it: where the
+hazard and exposure come from and which version of them is published there,
+the impact function parameters and the resource files they're built from, and
+for yearsets the sampling parameters. Inputs are versioned by their S3 ETag,
+or the uuid and version of their CLIMADA API dataset, so data re-published
+under the same name gets new keys. Artifacts whose inputs can't be versioned
+(e.g. offline, before they are downloaded) are neither restored nor stored.
+A run that asks for an artifact that any earlier run has already calculated
+can copy it from the store instead of recalculating it.
+
+The store is laid out as <store_dir>/<kind>/<key[:2]>/<key>.hdf5 where kind is
+'impact_raw' or 'yearsets'.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+from functools import cache
+from pathlib import Path
+
+import pandas as pd
+import pycountry
+
+from nccs.pipeline.direct import stormeurope
+from nccs.pipeline.direct.calc_yearset import POISSON_HAZARDS
+from nccs.pipeline.direct.direct import get_hazard_source, get_local_exposure_path, get_local_hazard_path, \
+    get_sector_exposure_source
+from nccs.pipeline.direct.impf_registry import get_impf_resources_fingerprint
+from nccs.utils.atomic_files import atomic_path
+from nccs.utils.data_catalog import get_dataset_fingerprint, get_litpop_properties
+from nccs.utils.folder_naming import get_artifact_store_dir
+from nccs.utils.s3client import get_s3_object_fingerprint
+
+LOGGER = logging.getLogger(__name__)
+
+# Bump this when a code change alters the contents of impacts or yearsets so that old artifacts are not reused
+ARTIFACT_STORE_VERSION = 1
+
+
+def _hash_dict(d):
+    return hashlib.sha256(json.dumps(d, sort_keys=True, default=str).encode()).hexdigest()
+
+
+@cache
+def _s3_fingerprint(s3_path, local_path):
+    """The ETag and size of a file on S3. If S3 can't be reached, the size and
+    modification time of the local copy, or None without one."""
+    try:
+        return get_s3_object_fingerprint(s3_path)
+    except Exception as e:
+        if not os.path.exists(local_path):
+            LOGGER.warning(f'Could not version {s3_path}: {e}')
+            return None
+        LOGGER.warning(f'Could not version {s3_path} on S3 ({e}). Using its local copy {local_path}')
+        stat = os.stat(local_path)
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+@cache
+def _api_fingerprint(data_type, properties_json):
+    try:
+        return get_dataset_fingerprint(data_type, json.loads(properties_json))
+    except Exception as e:
+        LOGGER.warning(f'Could not version the API dataset {data_type} {properties_json}: {e}')
+        return None
+
+
+def _api_queries_fingerprint(data_type, properties):
+    properties = properties if isinstance(properties, list) else [properties]
+    fingerprints = [_api_fingerprint(data_type, json.dumps(p, sort_keys=True)) for p in properties]
+    return None if None in fingerprints else fingerprints
+
+
+def get_hazard_fingerprint(source):
+    """The version of the hazard data a source from get_hazard_source loads,
+    or None if it can't be found out"""
+    if source['origin'] == 's3':
+        return _s3_fingerprint(source['s3_path'], get_local_hazard_path(source['s3_path']))
+    if source['origin'] in ['api', 'crop']:
+        return _api_queries_fingerprint(source['data_type'], source['properties'])
+    if source['origin'] == 'storm_europe':
+        if source['scenario'] == 'observed':
+            return _api_queries_fingerprint(stormeurope.ERA5_DATA_TYPE, stormeurope.ERA5_PROPERTIES)
+        return _s3_fingerprint(*stormeurope.get_s3_hazard_file(source['scenario'], source['country_iso3alpha']))
+    raise ValueError(f'Unknown hazard origin {source["origin"]}')
+
+
+def get_exposure_fingerprint(source, country):
+    """The version of the exposure data a source from
+    get_sector_exposure_source loads, or None if it can't be found out"""
+    if source['origin'] == 's3':
+        return _s3_fingerprint(source['s3_path'], get_local_exposure_path(source['s3_path']))
+    if source['data_type'] == 'litpop':
+        return _api_queries_fingerprint('litpop', get_litpop_properties(country))
+    return _api_queries_fingerprint(source['data_type'], source['properties'])
+
+
+def get_direct_impact_key(
+        haz_type,
+        sector,
+        country,
+        scenario,
+        ref_year,
+        business_interruption=True,
+        calibrated=True,
+        use_sector_bi_scaling=True,
+        prune_zero_events=False,
+        impact_dtype='float64'):
+    """Key for a direct impact, from the inputs of nccs_direct_impacts_simple,
+    whether its zero-impact events are dropped and the precision of its
+    impact matrix.
+
+    Returns
+    -------
+    str or None
+        Hex digest identifying the impact, or None if the version of its
+        hazard or exposure data can't be found out
+    """
+    country_iso3alpha = pycountry.countries.get(name=country).alpha_3
+    hazard_source = get_hazard_source(haz_type, country_iso3alpha, scenario, ref_year)
+    exposure_source = get_sector_exposure_source(sector, country)
+    inputs = {
+        'hazard': None if hazard_source is None else get_hazard_fingerprint(hazard_source),
+        'exposure': get_exposure_fingerprint(exposure_source, country)
+    }
+    if None in inputs.values():
+        return None
+    key = {
+        'version': ARTIFACT_STORE_VERSION,
+        'kind': 'impact_raw',
+        'hazard': hazard_source,
+        'exposure': exposure_source,
+        'inputs': inputs,
+        'impf': {
+            'haz_type': haz_type,
+            'sector': sector,
+            'country_iso3alpha': country_iso3alpha,
+            'business_interruption': business_interruption,
+            'calibrated': calibrated,
+            'use_sector_bi_scaling': use_sector_bi_scaling,
+            'resources': get_impf_resources_fingerprint()
+        }
+    }
+    # Only added when they differ from the defaults, so that keys of earlier impacts are unchanged
+    if prune_zero_events:
+        key['prune_zero_events'] = True
+    if impact_dtype != 'float64':
+        key['impact_dtype'] = impact_dtype
+    return _hash_dict(key)
+
+
+def get_yearset_key(direct_impact_key, n_sim_years, seed, poisson, cap_exposure_source=None,
+                    share_sampling_plans=False):
+    """Key for a yearset, from the key of the impact it samples and the
+    sampling parameters of create_single_yearset.
+
+    Returns
+    -------
+    str or None
+        Hex digest identifying the yearset, or None if the impact has no key
+    """
+    if direct_impact_key is None:
+        return None
+    key = {
+        'version': ARTIFACT_STORE_VERSION,
+        'kind': 'yearsets',
+        'impact': direct_impact_key,
+        'n_sim_years': n_sim_years,
+        'seed': seed,
+        'poisson': poisson,
+        'cap_exposure': cap_exposure_source
+    }
+    # Only added when set, so that the keys of yearsets sampled per impact stay the same
+    if share_sampling_plans:
+        key['share_sampling_plans'] = True
+    return _hash_dict(key)
+
+
+def add_artifact_keys(df: pd.DataFrame, config: dict):
+    """Add 'direct_impact_key' and 'yearset_key' columns to a dataframe
+    created by config_to_dataframe.
+
+    Keys are computed once per unique combination of inputs. Rows whose
+    inputs can't be versioned get None keys.
+    """
+    key_cols = ['hazard', 'sector', 'country', 'scenario', 'ref_year']
+    unique_rows = df[key_cols].drop_duplicates()
+    keys = {}
+    for row in unique_rows.itertuples(index=False):
+        impact_key = get_direct_impact_key(
+            haz_type=row.hazard,
+            sector=row.sector,
+            country=row.country,
+            scenario=row.scenario,
+            ref_year=row.ref_year,
+            business_interruption=config['business_interruption'],
+            calibrated=config['calibrated'],
+            use_sector_bi_scaling=config['use_sector_bi_scaling'],
+            prune_zero_events=config.get('prune_zero_events', False),
+            impact_dtype=config.get('impact_dtype', 'float64')
+        )
+        yearset_key = get_yearset_key(
+            impact_key,
+            n_sim_years=config['n_sim_years'],
+            seed=config['seed'],
+            poisson=row.hazard in POISSON_HAZARDS,
+            cap_exposure_source=get_sector_exposure_source(row.sector, row.country),
+            share_sampling_plans=config.get('share_sampling_plans', True)
+        )
+        keys[tuple(row)] = (impact_key, yearset_key)
+
+    row_keys = [keys[tuple(row)] for row in df[key_cols].itertuples(index=False)]
+    df['direct_impact_key'] = [k[0] for k in row_keys]
+    df['yearset_key'] = [k[1] for k in row_keys]
+    return df
+
+
+def get_artifact_path(key, kind, store_dir=None):
+    """Location of an artifact in the store (whether or not it exists)."""
+    if store_dir is None:
+        store_dir = get_artifact_store_dir()
+    return Path(store_dir, kind, key[:2], f'{key}.hdf5')
+
+
+def _link_or_copy(src, dst):
+    """Hard link src to dst, copying if the two aren't on the same filesystem.
+    The destination only appears once it is complete."""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    with atomic_path(dst) as tmp:
+        try:
+            os.link(src, tmp)
+        except OSError:
+            shutil.copyfile(src, tmp)
+
+
+def restore_artifact(key, kind, target_path, store_dir=None):
+    """Place a stored artifact at target_path if the store has one.
+
+    Returns
+    -------
+    bool
+        Whether the artifact was found in the store. Always False for a None
+        key.
+    """
+    if key is None:
+        return False
+    stored_path = get_artifact_path(key, kind, store_dir)
+    if not os.path.exists(stored_path):
+        return False
+    _link_or_copy(stored_path, target_path)
+    return True
+
+
+def store_artifact(filepath, key, kind, store_dir=None):
+    """Add a calculated artifact to the store. Existing entries are replaced.
+    Artifacts with a None key aren't stored."""
+    if key is None:
+        return None
+    stored_path = get_artifact_path(key, kind, store_dir)
+    _link_or_copy(filepath, stored_path)
+    return stored_path
+
+
+def restore_artifacts_from_df(df: pd.DataFrame, store_dir=None):
+    """For each row of an analysis dataframe whose impact or yearset file is
+    missing, copy it from the store if a matching artifact exists.
+
+    Returns
+    -------
+    tuple of int
+        Number of direct impacts and yearsets restored
+    """
+    n_impacts, n_yearsets = 0, 0
+    for row in df.itertuples():
+        if not os.path.exists(row.direct_impact_path):
+            n_impacts += restore_artifact(row.direct_impact_key, 'impact_raw', row.direct_impact_path, store_dir)
+        if not os.path.exists(row.yearset_path):
+            n_yearsets += restore_artifact(row.yearset_key, 'yearsets', row.yearset_path, store_dir)
+    return n_impacts, n_yearsets
@@ -4,11 +4,12 @@ import numpy as np
 import pandas as pd
 from climada.entity import ImpactFunc
 from climada.entity import ImpactFuncSet
-from climada.util.api_client import Client
 from climada_petals.entity.impact_funcs.relative_cropyield import ImpfRelativeCropyield
 from climada_petals.entity.impact_funcs.river_flood import RIVER_FLOOD_REGIONS_CSV
 from pycountry import countries
 
+from nccs.utils.data_catalog import get_api_exposures, get_api_hazard
+
 CropType = typing.Literal[
     "whe",
     "mai",
@@ -32,15 +33,17 @@ def split_agriculture_sector(label):
     return sector, crop_type
 
 
+def get_exposure_properties(crop_type: CropType = "whe", irr: IrrigationType = "firr"):
+    """ Properties used to query the CLIMADA API for a crop production exposure. """
+    return {
+        "irrigation_status": irr,
+        "crop": crop_type,
+        "unit": "USD"
+    }
+
+
 def get_exposure(crop_type: CropType = "whe", scenario="histsoc", irr: IrrigationType = "firr"):
-    client = Client()
-    return client.get_exposures(
-        "crop_production", properties={
-            "irrigation_status": irr,
-            "crop": crop_type,
-            "unit": "USD"
-        }
-    )
+    return get_api_exposures("crop_production", get_exposure_properties(crop_type, irr))
 
 
 def get_impf_set(crop_type: typing.Union[CropType, None] = None):
@@ -171,6 +174,20 @@ def get_impf_set_rf(country_iso3alpha, haz_type="RF"):
 
 
 
+def get_hazard_properties(
+        year_range,
+        scenario: typing.Literal["historical", "rcp60"] = "historical",
+        crop_type: CropType = "whe",
+        irr: IrrigationType = "firr"):
+    """ Properties used to query the CLIMADA API for a relative crop yield hazard. """
+    return {
+        'climate_scenario': scenario,
+        'crop': crop_type,
+        'irrigation_status': irr,
+        'year_range': year_range
+    }
+
+
 def get_hazard(
         country,
         year_range,
@@ -179,16 +196,7 @@ def get_hazard(
         irr: IrrigationType = "firr"):
     # TODO how to map the year to the years in this model
     # TODO What about the firr and noirr?
-    client = Client()
-    hazard = client.get_hazard(
-        "relative_cropyield",
-        properties={
-            'climate_scenario': scenario,
-            'crop': crop_type,
-            'irrigation_status': irr,
-            'year_range': year_range
-        }
-    )
+    hazard = get_api_hazard("relative_cropyield", get_hazard_properties(year_range, scenario, crop_type, irr))
     if hasattr(hazard.centroids, 'gdf') and np.all(
             hazard.centroids.region_id == 1
     ):  # if the region ids exist but are all 1 (happens in newer climada)
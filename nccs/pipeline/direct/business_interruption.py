@@ -1,5 +1,6 @@
 import logging
 import os
+from functools import cache
 from pathlib import Path
 
 import numpy as np
@@ -50,9 +51,19 @@ SECTOR_MAPPING = {
 }
 
 
+@cache
+def _read_bi_table(path):
+    return pd.read_csv(path).set_index(['Industry Type'])
+
+
+@cache
+def _read_bi_scaling():
+    return pd.read_csv(SECTOR_BI_WET_SCALE_PATH)
+
+
 def get_sector_bi_dry(sector, country_iso3alpha, use_sector_bi_scaling=True):
     bi_sector = SECTOR_MAPPING[sector]
-    bi = pd.read_csv(SECTOR_BI_DRY_PATH).set_index(['Industry Type']).loc[bi_sector]
+    bi = _read_bi_table(SECTOR_BI_DRY_PATH).loc[bi_sector]
 
     if use_sector_bi_scaling:
         factor = get_country_sector_scaling(country_iso3alpha)
@@ -78,7 +89,7 @@ def get_sector_bi_dry(sector, country_iso3alpha, use_sector_bi_scaling=True):
 
 def get_sector_bi_wet(sector, country_iso3alpha, use_sector_bi_scaling=True):
     bi_sector = SECTOR_MAPPING[sector]
-    bi = pd.read_csv(SECTOR_BI_WET_PATH).set_index(['Industry Type']).loc[bi_sector]
+    bi = _read_bi_table(SECTOR_BI_WET_PATH).loc[bi_sector]
 
     if use_sector_bi_scaling:
         factor = get_country_sector_scaling(country_iso3alpha)
@@ -106,7 +117,7 @@ def get_sector_bi_wet(sector, country_iso3alpha, use_sector_bi_scaling=True):
 def get_country_sector_scaling(country_iso3alpha):
     country = pycountry.countries.get(alpha_3=country_iso3alpha).name
     # get the factor from the csv
-    country_scale = (pd.read_csv(SECTOR_BI_WET_SCALE_PATH)[(lambda df: (df['country'] == country))])
+    country_scale = (_read_bi_scaling()[(lambda df: (df['country'] == country))])
     factor = country_scale.iloc[0]['normalized_NA'] if not country_scale.empty else None
     return factor
 
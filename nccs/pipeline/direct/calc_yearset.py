@@ -1,18 +1,157 @@
 import numpy as np
 import copy
+import h5py
+import json
 import logging
+import os
+import weakref
 from scipy import sparse
-from functools import reduce
 
 from climada.entity import Exposures
-from climada.engine import Impact, ImpactCalc
+from climada.engine import Impact
 from climada.util import yearsets
 
 LOGGER = logging.getLogger(__name__)
 
+# Hazards whose event sets are sampled with a Poisson process. Others are sampled one event per year.
+POISSON_HAZARDS = ['tropical_cyclone', 'sea_level_rise']
 
-def yearset_from_imp(imp, n_sim_years, poisson=True, cap_exposure=None, seed=None):
-    if poisson:
+
+# HDF5 attributes recording the size of the event set an impact file was pruned from
+N_EVENTS_TOTAL_ATTR = 'nccs_n_events_total'
+FREQUENCY_TOTAL_ATTR = 'nccs_frequency_total'
+# HDF5 datasets with the event ids and frequencies of the full event set of a pruned impact
+EVENT_ID_TOTAL_DATASET = 'nccs_event_id_total'
+FREQUENCY_BY_EVENT_TOTAL_DATASET = 'nccs_frequency_by_event_total'
+# HDF5 attribute recording the yearset files a combined yearset was made from
+COMBINED_INPUTS_ATTR = 'nccs_combined_inputs'
+
+# Cap vectors of the exposures impacts were capped at, by exposure object (see get_cap_vector)
+_CAP_VECTORS = weakref.WeakKeyDictionary()
+
+
+def prune_zero_events(imp):
+    """Drop the events with no impact from an impact.
+
+    The kept events keep their event ids and frequencies. The number of events
+    and the total frequency of the full event set are returned so that
+    yearset_from_imp can sample the pruned impact as it would the full one.
+
+    Returns
+    -------
+    tuple
+        The pruned impact, and a dict with 'n_events_total' and
+        'frequency_total'
+    """
+    totals = {'n_events_total': len(imp.event_id), 'frequency_total': float(np.sum(imp.frequency))}
+    keep = np.asarray(imp.at_event) != 0
+    # An impact with no events can't be written or sampled, so impacts without any damage are kept whole
+    if keep.all() or not keep.any():
+        return imp, totals
+    return imp.select(event_ids=np.asarray(imp.event_id)[keep]), totals
+
+
+def write_event_totals(filepath, totals):
+    """Record the event set totals of a pruned impact in its HDF5 file"""
+    with h5py.File(filepath, 'a') as f:
+        f.attrs[N_EVENTS_TOTAL_ATTR] = totals['n_events_total']
+        f.attrs[FREQUENCY_TOTAL_ATTR] = totals['frequency_total']
+
+
+def read_event_totals(filepath):
+    """The event set totals recorded in an impact's HDF5 file, as keyword
+    arguments for yearset_from_imp. Empty if the impact wasn't pruned."""
+    with h5py.File(filepath, 'r') as f:
+        if N_EVENTS_TOTAL_ATTR not in f.attrs:
+            return {}
+        return {
+            'n_events_total': int(f.attrs[N_EVENTS_TOTAL_ATTR]),
+            'frequency_total': float(f.attrs[FREQUENCY_TOTAL_ATTR])
+        }
+
+
+def write_full_event_set(filepath, event_id, frequency):
+    """Record the event ids and frequencies of the full event set of a pruned
+    impact in its HDF5 file, for sampling plans shared with other sectors"""
+    with h5py.File(filepath, 'a') as f:
+        for name, values in [(EVENT_ID_TOTAL_DATASET, event_id), (FREQUENCY_BY_EVENT_TOTAL_DATASET, frequency)]:
+            if name in f:
+                del f[name]
+            f.create_dataset(name, data=np.asarray(values))
+
+
+def get_yearsets_fingerprint(yearset_paths):
+    """Identify the versions of a list of yearset files by their paths, sizes
+    and modification times"""
+    return json.dumps([[os.fspath(p), os.path.getsize(p), os.stat(p).st_mtime_ns] for p in yearset_paths])
+
+
+def write_combined_inputs(filepath, yearset_paths):
+    """Record the yearset files a combined yearset was made from in its HDF5
+    file"""
+    with h5py.File(filepath, 'a') as f:
+        f.attrs[COMBINED_INPUTS_ATTR] = get_yearsets_fingerprint(yearset_paths)
+
+
+def is_combination_up_to_date(filepath, yearset_paths):
+    """Whether a combined yearset file exists and was made from the current
+    versions of exactly these yearset files"""
+    if not os.path.exists(filepath):
+        return False
+    with h5py.File(filepath, 'r') as f:
+        return f.attrs.get(COMBINED_INPUTS_ATTR) == get_yearsets_fingerprint(yearset_paths)
+
+
+def read_full_event_set(filepath):
+    """The event ids and frequencies of the full event set of an impact file,
+    or None if the impact was pruned without recording them"""
+    with h5py.File(filepath, 'r') as f:
+        if EVENT_ID_TOTAL_DATASET in f:
+            return f[EVENT_ID_TOTAL_DATASET][:], f[FREQUENCY_BY_EVENT_TOTAL_DATASET][:]
+        if N_EVENTS_TOTAL_ATTR in f.attrs and int(f.attrs[N_EVENTS_TOTAL_ATTR]) != f['event_id'].shape[0]:
+            return None
+        return f['event_id'][:], f['frequency'][:]
+
+
+def yearset_from_imp(imp, n_sim_years, poisson=True, cap_exposure=None, seed=None, n_events_total=None,
+                     frequency_total=None, imp_mat=None, samp_vec=None):
+    """Sample a yearset from an impact.
+
+    Parameters
+    ----------
+    samp_vec : list of numpy.ndarray, optional
+        The rows of the impact's events in each year, e.g. from a sampling plan
+        shared with other sectors (see nccs.pipeline.direct.sampling_plan).
+        Years are sampled if not given.
+    imp_mat : scipy.sparse.csr_matrix, optional
+        The impact matrix to sample rows from, if it isn't imp.imp_mat: e.g.
+        a memory-mapped matrix from a LazyImpact, with imp loaded without its
+        matrix
+    n_events_total, frequency_total : optional
+        If the impact's zero-impact events were dropped (see
+        prune_zero_events), the number of events and total frequency of the
+        full event set. Years are sampled with the same distribution as from
+        the full event set. Poisson sampling can't be reproduced from the kept
+        events alone: CLIMADA draws each year's events from the whole event
+        set with the seed, so pruned impacts must be given a samp_vec from a
+        sampling plan of the full event set (see
+        nccs.pipeline.direct.sampling_plan.apply_sampling_plan).
+    """
+    if poisson and samp_vec is None and n_events_total is not None and n_events_total != len(imp.event_id):
+        raise ValueError(
+            'Impacts with pruned zero-impact events can only be Poisson sampled with a sampling vector from their '
+            'full event set'
+        )
+    if samp_vec is not None:
+        if len(samp_vec) != n_sim_years:
+            raise ValueError(f'The sampling vector has {len(samp_vec)} years, not {n_sim_years}')
+        yimp = yearsets.impact_yearset_from_sampling_vect(
+            imp,
+            sampled_years=list(range(1, n_sim_years + 1)),
+            sampling_vect=samp_vec,
+            correction_fac=False
+        )
+    elif poisson:
         lam = np.sum(imp.frequency)
         LOGGER.info('Correcting TC event frequencies: once these have been updated by Samuel this can be removed')
         lam = lam * 25 / 26
@@ -24,7 +163,13 @@ def yearset_from_imp(imp, n_sim_years, poisson=True, cap_exposure=None, seed=Non
             seed=seed
         )
     else:
-        samp_vec = np.array([np.array([x]) for x in np.random.randint(len(imp.at_event), size=n_sim_years)])
+        if n_events_total is None:
+            samp_vec = np.array([np.array([x]) for x in np.random.randint(len(imp.at_event), size=n_sim_years)])
+        else:
+            # One event per year, drawn from the full event set: draws past the kept events are years with one of
+            # the dropped, zero-impact events
+            draws = np.random.randint(n_events_total, size=n_sim_years)
+            samp_vec = [np.array([x]) if x < len(imp.at_event) else np.array([], dtype=int) for x in draws]
         yimp = yearsets.impact_yearset_from_sampling_vect(
             imp,
             sampled_years = list(range(1, n_sim_years + 1)),
@@ -36,13 +181,11 @@ def yearset_from_imp(imp, n_sim_years, poisson=True, cap_exposure=None, seed=Non
     yimp.event_name = [str(y) for y in range(1, n_sim_years + 1)]
 
     # TODO extend CLIMADA's yearsets class with this: it should generate this matrix automatically!
-    yimp.imp_mat = sparse.csr_matrix(
-        np.vstack(
-            [imp.imp_mat[samp_vec[i]].sum(0)
-             for i in range(len(samp_vec))
-             ]
-        )
-    )
+    if imp_mat is None:
+        imp_mat = imp.imp_mat
+    # Each year's row is the sum of its events' rows. Years are summed in float64 and stored with the precision of
+    # the sampled matrix
+    yimp.imp_mat = sampled_impact_matrix(sampling_matrix(samp_vec, imp_mat.shape[0]), imp_mat)
 
     # TODO extend CLIMADA's yearsets (or possibly Impact) class with this too!
     if cap_exposure is not None:
@@ -51,14 +194,89 @@ def yearset_from_imp(imp, n_sim_years, poisson=True, cap_exposure=None, seed=Non
     return yimp
 
 
+def sampling_matrix(samp_vec, n_events):
+    """The sparse (n_years x n_events) matrix counting how often each event
+    was sampled in each year.
+
+    Parameters
+    ----------
+    samp_vec : list of numpy.ndarray
+        The positions of the events sampled in each year, as returned by
+        CLIMADA's yearset sampling
+    n_events : int
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+    """
+    indptr = np.zeros(len(samp_vec) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(events) for events in samp_vec])
+    indices = np.concatenate([np.asarray(events, dtype=np.int64).ravel() for events in samp_vec] + [
+        np.array([], dtype=np.int64)])
+    counts = sparse.csr_matrix(
+        (np.ones(indices.shape[0]), indices, indptr),
+        shape=(len(samp_vec), n_events)
+    )
+    # Events sampled more than once in a year become one entry with their count
+    counts.sum_duplicates()
+    return counts
+
+
+def sampled_impact_matrix(counts, imp_mat):
+    """The impact matrix of sampled years: counts @ imp_mat, as a sparse
+    product that never densifies rows of the exposure's width.
+
+    Only the sampled rows of imp_mat are read, so it can be memory-mapped (see
+    LazyImpact). The sums are accumulated in float64 and returned with
+    imp_mat's dtype.
+    """
+    # Select the sampled rows before casting, so that a memory-mapped float32 matrix isn't copied whole to float64
+    rows = np.unique(counts.indices)
+    ymat = (counts[:, rows] @ sparse.csr_matrix(imp_mat[rows], dtype=np.float64)).tocsr()
+    ymat.eliminate_zeros()
+    ymat.sort_indices()
+    return ymat.astype(imp_mat.dtype, copy=False)
+
+
+def impact_aggregates(imp_mat, frequency):
+    """The impact per event, expected annual impact per exposure point and
+    average annual impact of an impact matrix.
+
+    Sums are accumulated in float64, also for float32 matrices.
+
+    Returns
+    -------
+    tuple
+        at_event, eai_exp and aai_agg
+    """
+    at_event = np.asarray(imp_mat.sum(axis=1, dtype=np.float64)).ravel()
+    eai_exp = np.asarray(imp_mat.T.dot(np.asarray(frequency, dtype=np.float64))).ravel()
+    return at_event, eai_exp, float(np.sum(eai_exp))
+
+
+def set_matrix_dtype(imp, dtype):
+    """Store an impact's matrix with another precision, e.g. float32 to halve
+    its memory use and file size. Aggregates are not changed."""
+    if dtype is not None and imp.imp_mat.dtype != np.dtype(dtype):
+        imp.imp_mat = imp.imp_mat.astype(dtype)
+    return imp
+
+
 # Adapted from Zélie's code:
 # https://github.com/CLIMADA-project/climada_papers/blob/main/202403_multi_hazard_risk_assessment/python_scripts/multi_risk.py
 def combine_yearsets(impact_list, how='sum', occur_together=False, cap_exposure=None):
     """
     Parameters
     ----------
-    impact_list : list  or dict of impacts
+    impact_list : list, dict or iterable of impacts
+        The impacts are folded into the combination one at a time, so this can
+        be a generator that loads each impact (e.g. a LazyImpact) when it is
+        needed and closes it when the next one is requested. Only the
+        combination so far and the current impact are held in memory.
     how : how to combine the impacts, options are 'sum', 'max' or 'min'
+    occur_together : bool
+        Only keep impacts at the events and exposure points where every impact
+        has one
     exp : If the exposures are given, the impacts are caped at their value. If a single value is given, all impacts are capped to this value.
 
     Returns
@@ -79,57 +297,106 @@ def combine_yearsets(impact_list, how='sum', occur_together=False, cap_exposure=
     else:
         raise ValueError(f"'{how}' is not a valid method. The implemented methods are sum, max or min")
 
-    imp_mat = reduce(f, [imp.imp_mat for imp in impact_list])
+    imp_mat, presence, meta, n_impacts = None, None, None, 0
+    for imp in impact_list:
+        if imp_mat is None:
+            # Copy what's needed of the first impact, which may be closed once the next one is requested
+            meta = {attr: copy.copy(getattr(imp, attr)) for attr in
+                    ['event_id', 'event_name', 'date', 'frequency_unit', 'coord_exp', 'crs', 'tot_value', 'unit']}
+            # Copied too: it may be read-only (see LazyImpact)
+            imp_mat = sparse.csr_matrix(imp.imp_mat, copy=True)
+        else:
+            imp_mat = f(imp_mat, imp.imp_mat).tocsr()
+        if occur_together:
+            # Count, at each event and exposure point, the impacts that have a non-zero value there
+            presence = _presence(imp.imp_mat) if presence is None else presence + _presence(imp.imp_mat)
+        n_impacts += 1
+
+    if imp_mat is None:
+        raise ValueError('No impacts to combine')
 
     if occur_together:
-        mask_list = [np.abs(impact.imp_mat.A[imp_mat.nonzero()]) == 0 for impact in impact_list]
-        for mask in mask_list:
-            imp_mat.data[mask] = 0
+        imp_mat = imp_mat.multiply(presence >= n_impacts).tocsr()
         imp_mat.eliminate_zeros()
 
-    imp0 = impact_list[0]
-    freq = np.ones(len(imp0.event_id)) / len(imp0.event_id)
-    eai_exp = ImpactCalc.eai_exp_from_mat(imp_mat, freq)
-    at_event = ImpactCalc.at_event_from_mat(imp_mat)
-    aai_agg = ImpactCalc.aai_agg_from_eai_exp(eai_exp)
+    freq = np.ones(len(meta['event_id'])) / len(meta['event_id'])
+    at_event, eai_exp, aai_agg = impact_aggregates(imp_mat, freq)
 
     imp_combined = Impact(
-        event_id=imp0.event_id,
-        event_name=imp0.event_name,
-        date=imp0.date,
+        event_id=meta['event_id'],
+        event_name=meta['event_name'],
+        date=meta['date'],
         frequency=freq,
-        frequency_unit=imp0.frequency_unit,
-        coord_exp=imp0.coord_exp,
-        crs=imp0.crs,
+        frequency_unit=meta['frequency_unit'],
+        coord_exp=meta['coord_exp'],
+        crs=meta['crs'],
         eai_exp=eai_exp,
         at_event=at_event,
-        tot_value=imp0.tot_value,
+        tot_value=meta['tot_value'],
         aai_agg=aai_agg,
-        unit=imp0.unit,
+        unit=meta['unit'],
         imp_mat=imp_mat,
         haz_type='COMBINED'
     )
+    # The cap is applied once, to the combination
     if cap_exposure is not None:
         imp_combined = cap_impact(imp_combined, cap_exposure)
     return imp_combined
 
 
+def _presence(imp_mat):
+    """A sparse matrix of ones where an impact matrix is non-zero"""
+    presence = sparse.csr_matrix(
+        ((imp_mat.data != 0).astype(np.int32), imp_mat.indices, imp_mat.indptr),
+        shape=imp_mat.shape,
+        copy=True
+    )
+    presence.eliminate_zeros()
+    return presence
+
+
+def get_cap_vector(exp):
+    """An exposure's values as a contiguous, read-only float64 array indexed
+    like the columns of its impact matrices.
+
+    Computed once per Exposures object and dropped with it, so capping the
+    yearsets of a cached exposure (see get_sector_cap_vector) never touches its
+    GeoDataFrame again.
+    """
+    cap = _CAP_VECTORS.get(exp)
+    if cap is None:
+        cap = np.ascontiguousarray(exp.gdf['value'].to_numpy(), dtype=np.float64)
+        cap.setflags(write=False)
+        _CAP_VECTORS[exp] = cap
+    return cap
+
+
 # TODO add this to CLIMADA in either Impact or Yearsets
 # TODO then get yearsets.impact_yearset to use it!
 def cap_impact(imp, cap_exposure):
+    """Cap each value of an impact matrix at the exposure value of its point.
+
+    Parameters
+    ----------
+    imp : climada.engine.Impact
+    cap_exposure : climada.entity.Exposures, numpy.ndarray or float
+        The exposure, its values by point (see get_cap_vector), or a single
+        cap for all points
+    """
     imp_mat = imp.imp_mat
     shape = imp_mat.shape
-    m1 = imp_mat.data
     if isinstance(cap_exposure, Exposures):
-        m2 = cap_exposure.gdf.reset_index().value[imp_mat.nonzero()[1]]
-    else:
-        m2 = cap_exposure
+        cap_exposure = get_cap_vector(cap_exposure)
+    # The caps of the stored values, which are in the same order as the column indices
+    cap = cap_exposure if np.ndim(cap_exposure) == 0 else np.asarray(cap_exposure)[imp_mat.indices]
 
-    imp_mat = sparse.csr_matrix((np.minimum(m1, m2), imp_mat.indices, imp_mat.indptr), shape=shape)
+    # Keep the precision of float matrices (the exposure values are float64). Integer matrices become float, as
+    # the caps needn't be whole numbers
+    dtype = imp_mat.dtype if np.issubdtype(imp_mat.dtype, np.floating) else np.float64
+    capped = np.minimum(imp_mat.data, cap).astype(dtype, copy=False)
+    imp_mat = sparse.csr_matrix((capped, imp_mat.indices, imp_mat.indptr), shape=shape)
     imp_mat.eliminate_zeros()
 
     imp.imp_mat = imp_mat
-    imp.at_event = ImpactCalc.at_event_from_mat(imp_mat)
-    imp.eai_exp = ImpactCalc.eai_exp_from_mat(imp_mat, freq=imp.frequency)
-    imp.aai_agg = ImpactCalc.aai_agg_from_eai_exp(imp.eai_exp)
+    imp.at_event, imp.eai_exp, imp.aai_agg = impact_aggregates(imp_mat, imp.frequency)
     return imp
\ No newline at end of file
@@ -0,0 +1,158 @@
+"""
+Impact calculations over very large exposures in chunks.
+
+ImpactCalc holds the intermediate results for the whole exposure while it
+builds the impact matrix, which for LitPop exposures of the largest countries
+(millions of points) can need more memory than a machine has. Here the
+exposure is split into spatially contiguous chunks, each chunk's impact is
+calculated separately, optionally in parallel threads, and the chunks' impact
+matrices are joined column-wise into one Impact as they are finished.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+from climada.engine import Impact
+from climada.engine.impact_calc import ImpactCalc
+from climada.entity import Exposures
+from climada.entity.exposures.base import INDICATOR_CENTR
+from scipy import sparse
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_chunks(centr, chunk_size):
+    """Split exposure points into chunks of at most chunk_size points that
+    are close together, by ordering them by their hazard centroid.
+
+    Returns
+    -------
+    list of numpy.ndarray
+        Positions of the points in each chunk
+    """
+    order = np.argsort(centr, kind='stable')
+    return [order[start:start + chunk_size] for start in range(0, len(order), chunk_size)]
+
+
+def calc_impact_chunked(exp, impf_set, haz, chunk_size, n_workers=1, assign_centroids=True):
+    """Calculate an impact with its impact matrix, one chunk of the exposure
+    at a time.
+
+    The result is the same as ImpactCalc(exp, impf_set, haz).impact(save_mat=True).
+
+    Parameters
+    ----------
+    exp : climada.entity.Exposures
+    impf_set : climada.entity.ImpactFuncSet
+    haz : climada.hazard.Hazard
+    chunk_size : int
+        Maximum number of exposure points in a chunk. Peak memory grows with
+        this and the number of workers.
+    n_workers : int
+        Number of chunks to calculate at the same time, in threads. Threads
+        share the hazard, which processes would each need a copy of.
+    assign_centroids : bool
+        Assign the exposure to the hazard's centroids first. If False the
+        exposure must already be assigned.
+
+    Returns
+    -------
+    climada.engine.Impact
+    """
+    if exp.gdf.shape[0] <= chunk_size:
+        return ImpactCalc(exp, impf_set, haz).impact(save_mat=True, assign_centroids=assign_centroids)
+
+    # Centroids are assigned once for the whole exposure rather than for each chunk
+    if assign_centroids:
+        exp.assign_centroids(haz, overwrite=True)
+    chunks = get_chunks(exp.gdf[INDICATOR_CENTR + haz.haz_type].to_numpy(), chunk_size)
+    LOGGER.info(f'Calculating the impact of {exp.gdf.shape[0]} exposure points in {len(chunks)} chunks')
+
+    def calc_chunk(positions):
+        chunk_exp = Exposures(
+            exp.gdf.iloc[positions].reset_index(drop=True),
+            crs=exp.crs,
+            value_unit=exp.value_unit
+        )
+        return positions, ImpactCalc(chunk_exp, impf_set, haz).impact(save_mat=True, assign_centroids=False)
+
+    if n_workers > 1:
+        with ThreadPoolExecutor(n_workers) as executor:
+            futures = [executor.submit(calc_chunk, positions) for positions in chunks]
+            # Each future's result is dropped once it's been taken in, so that only the stitched impact holds it
+            return stitch_chunk_impacts(
+                (futures.pop(futures.index(f)).result() for f in as_completed(futures)), exp.gdf.shape[0]
+            )
+    return stitch_chunk_impacts((calc_chunk(positions) for positions in chunks), exp.gdf.shape[0])
+
+
+def stitch_chunk_impacts(chunk_impacts, n_points):
+    """Join the impacts of exposure chunks into one impact, with the exposure
+    points in their original order.
+
+    Each chunk's impact is taken in as it is produced: its per-point results
+    are written to the full arrays and only its impact matrix, renumbered to
+    the points' original positions, is kept. The matrices are then copied into
+    one preallocated matrix, each chunk's freed once it's been copied, so the
+    stitched matrix and the chunks' are never all held twice over.
+
+    Parameters
+    ----------
+    chunk_impacts : iterable of tuple
+        The positions of each chunk's points in the full exposure and the
+        chunk's climada.engine.Impact, all from the same hazard, in any order.
+        Can be a generator, e.g. of chunks as they are finished.
+    n_points : int
+        Number of points in the full exposure
+    """
+    eai_exp = np.zeros(n_points)
+    coord_exp = np.zeros((n_points, 2))
+    at_event, tot_value, meta, matrices = None, 0, None, []
+    for positions, imp in chunk_impacts:
+        if meta is None:
+            meta = {attr: getattr(imp, attr) for attr in
+                    ['event_id', 'event_name', 'date', 'frequency', 'frequency_unit', 'crs', 'unit', 'haz_type']}
+            at_event = np.zeros(len(imp.event_id))
+        eai_exp[positions] = imp.eai_exp
+        coord_exp[positions] = imp.coord_exp
+        at_event += imp.at_event
+        tot_value += imp.tot_value
+        chunk_mat = imp.imp_mat.tocsr()
+        matrices.append((chunk_mat.indptr, positions[chunk_mat.indices], chunk_mat.data))
+        del imp, chunk_mat
+
+    # Each row of the stitched matrix holds the row's values from every chunk, in the order of the chunks
+    row_counts = np.sum([np.diff(indptr) for indptr, _, _ in matrices], axis=0)
+    indptr = np.zeros(len(row_counts) + 1, dtype=np.int64)
+    np.cumsum(row_counts, out=indptr[1:])
+    data = np.empty(indptr[-1], dtype=np.result_type(*[chunk_data.dtype for _, _, chunk_data in matrices]))
+    indices = np.empty(indptr[-1], dtype=np.int64 if n_points > np.iinfo(np.int32).max else np.int32)
+    row_filled = indptr[:-1].copy()
+    while matrices:
+        chunk_indptr, chunk_indices, chunk_data = matrices.pop(0)
+        chunk_counts = np.diff(chunk_indptr)
+        dest = np.repeat(row_filled - chunk_indptr[:-1], chunk_counts) + np.arange(chunk_indptr[-1])
+        data[dest] = chunk_data
+        indices[dest] = chunk_indices
+        row_filled += chunk_counts
+        del chunk_indptr, chunk_indices, chunk_data, dest
+    imp_mat = sparse.csr_matrix((data, indices, indptr), shape=(len(row_counts), n_points))
+    imp_mat.sort_indices()
+
+    return Impact(
+        event_id=meta['event_id'],
+        event_name=meta['event_name'],
+        date=meta['date'],
+        frequency=meta['frequency'],
+        frequency_unit=meta['frequency_unit'],
+        coord_exp=coord_exp,
+        crs=meta['crs'],
+        eai_exp=eai_exp,
+        at_event=at_event,
+        tot_value=tot_value,
+        aai_agg=float(np.sum(eai_exp)),
+        unit=meta['unit'],
+        imp_mat=imp_mat,
+        haz_type=meta['haz_type']
+    )
@@ -1,16 +1,24 @@
 # for the wilfire impact function:
 # /climada_petals/blob/main/climada_petals/entity/impact_funcs/wildfire.py
 
+import copy
+import hashlib
+import json
+import logging
+from collections import Counter
+from functools import cache
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import pycountry
+from climada.engine import Impact
 from climada.engine.impact_calc import ImpactCalc
 from climada.entity import Exposures
+from climada.entity.exposures.base import INDICATOR_CENTR, INDICATOR_IMPF
 from climada.entity import ImpactFuncSet, ImpfSetTropCyclone, ImpfTropCyclone
 from climada.entity.impact_funcs.storm_europe import ImpfStormEurope
 from climada.hazard import Hazard
-from climada.util.api_client import Client
 from climada_petals.entity.impact_funcs.river_flood import RIVER_FLOOD_REGIONS_CSV, flood_imp_func_set
 # for the wilfire impact function:
 # https://github.com/CLIMADA-project/climada_petals/blob/main/climada_petals/entity/impact_funcs
@@ -20,9 +28,17 @@ from exposures.utils import root_dir
 from nccs.pipeline.direct import agriculture, stormeurope
 from nccs.pipeline.direct.business_interruption import convert_impf_to_sectoral_bi_dry
 from nccs.pipeline.direct.business_interruption import convert_impf_to_sectoral_bi_wet
-from nccs.utils.folder_naming import get_resources_dir
+from nccs.pipeline.direct.calc_yearset import get_cap_vector
+from nccs.pipeline.direct.chunked_impact import calc_impact_chunked
+from nccs.pipeline.direct.exposure_cache import EXPOSURE_CACHE
+from nccs.pipeline.direct.impf_registry import lookup_impf_set
+from nccs.utils.atomic_files import atomic_path
+from nccs.utils.data_catalog import get_api_exposures, get_api_hazard, get_litpop_properties
+from nccs.utils.folder_naming import get_centroid_assignment_dir, get_resources_dir
 from nccs.utils.s3client import download_from_s3_bucket
 
+LOGGER = logging.getLogger(__name__)
+
 project_root = root_dir()
 # /wildfire.py
 
@@ -44,12 +60,20 @@ def nccs_direct_impacts_simple(
         ref_year,
         business_interruption=True,
         calibrated=True,
-        use_sector_bi_scaling=True):
+        use_sector_bi_scaling=True,
+        haz=None,
+        cache_centroids=True,
+        chunk_size=None,
+        n_chunk_workers=1):
     # Country names can be checked here: https://github.com/flyingcircusio/pycountry/blob/main/src/pycountry
     # /databases/iso3166-1.json
     country_iso3alpha = pycountry.countries.get(name=country).alpha_3
-    haz = get_hazard(haz_type, country_iso3alpha, scenario, ref_year)
+    # The hazard can be passed in when it's shared by several calculations, to avoid loading it again
+    if haz is None:
+        haz = get_hazard(haz_type, country_iso3alpha, scenario, ref_year)
     exp = get_sector_exposure(sector, country)  # was originally here
+    if cache_centroids:
+        assign_centroids_cached(exp, haz)
     # exp = sectorial_exp_CI_MRIOT(country=country_iso3alpha, sector=sector) #replaces the command above
     impf_set = apply_sector_impf_set(
         haz_type,
@@ -61,13 +85,184 @@ def nccs_direct_impacts_simple(
     )
 
 
-    imp = ImpactCalc(exp, impf_set, haz).impact(save_mat=True)
+    if chunk_size:
+        imp = calc_impact_chunked(exp, impf_set, haz, chunk_size, n_chunk_workers,
+                                  assign_centroids=not cache_centroids)
+    else:
+        imp = ImpactCalc(exp, impf_set, haz).impact(save_mat=True, assign_centroids=not cache_centroids)
     imp.event_name = [str(e) for e in imp.event_name]
     # Drop events with no impact to save space
     # imp = imp.select(event_ids = [id for id, event_impact in zip(imp.event_id, imp.at_event) if event_impact > 0])
     return imp
 
 
+def nccs_direct_impacts_batched(
+        haz_type,
+        sectors,
+        country,
+        scenario,
+        ref_year,
+        business_interruption=True,
+        calibrated=True,
+        use_sector_bi_scaling=True,
+        haz=None,
+        cache_centroids=True,
+        chunk_size=None,
+        n_chunk_workers=1):
+    """Calculate the direct impacts of one hazard on several sectors of a
+    country in a single impact calculation.
+
+    The sector exposures are stacked into one exposure, with each sector's
+    impact function ids renumbered so that they stay distinct. Sectors whose
+    impact functions are identical share an id, so the hazard intensity at
+    their centroids is evaluated once for all of them. The combined impact
+    matrix is then split back into one Impact per sector, equal to what
+    nccs_direct_impacts_simple would return for that sector. Only sectors that
+    share impact functions gain from this (see get_batchable_sectors).
+
+    Parameters
+    ----------
+    haz_type, country, scenario, ref_year, business_interruption, calibrated,
+    use_sector_bi_scaling, haz, cache_centroids, chunk_size, n_chunk_workers :
+        As for nccs_direct_impacts_simple
+    sectors : list of str
+        Sectors to calculate impacts for
+
+    Returns
+    -------
+    dict
+        Impact of each sector
+    """
+    country_iso3alpha = pycountry.countries.get(name=country).alpha_3
+    if haz is None:
+        haz = get_hazard(haz_type, country_iso3alpha, scenario, ref_year)
+    impf_col = INDICATOR_IMPF + haz.haz_type
+    centr_col = INDICATOR_CENTR + haz.haz_type
+
+    exp_gdfs, exp_units, tot_values, bounds = [], [], [], {}
+    impfs, impf_ids = [], {}
+    n_points = 0
+    for sector in sectors:
+        exp = get_sector_exposure(sector, country)
+        if cache_centroids:
+            assign_centroids_cached(exp, haz)
+        else:
+            exp.assign_centroids(haz, overwrite=True)
+        impf_set = apply_sector_impf_set(
+            haz_type,
+            sector,
+            country_iso3alpha,
+            business_interruption,
+            calibrated,
+            use_sector_bi_scaling
+        )
+        sector_impf_ids = exp.gdf[exp.get_impf_column(haz.haz_type)].to_numpy()
+        new_ids = np.full(sector_impf_ids.shape, np.nan)
+        for fun_id in pd.unique(sector_impf_ids[~pd.isna(sector_impf_ids)]):
+            impf = impf_set.get_func(haz_type=haz.haz_type, fun_id=fun_id)
+            if not impf:
+                raise ValueError(f'No impact function {fun_id} for hazard {haz.haz_type} and sector {sector}')
+            key = _impf_key(impf)
+            if key not in impf_ids:
+                impf_ids[key] = len(impf_ids) + 1
+                impf = copy.deepcopy(impf)
+                impf.id = impf_ids[key]
+                impfs.append(impf)
+            new_ids[sector_impf_ids == fun_id] = impf_ids[key]
+
+        exp_gdfs.append(pd.DataFrame({
+            'value': exp.gdf['value'].to_numpy(),
+            'latitude': exp.gdf['latitude'].to_numpy(),
+            'longitude': exp.gdf['longitude'].to_numpy(),
+            impf_col: new_ids,
+            centr_col: exp.gdf[centr_col].to_numpy(),
+            **{col: exp.gdf[col].to_numpy() for col in ['cover', 'deductible'] if col in exp.gdf.columns}
+        }))
+        exp_units.append(exp.value_unit)
+        # As ImpactCalc sets it for the sector's exposure alone
+        tot_values.append(exp.centroids_total_value(haz))
+        bounds[sector] = (n_points, n_points + exp.gdf.shape[0])
+        n_points += exp.gdf.shape[0]
+
+    stacked = Exposures(pd.concat(exp_gdfs, ignore_index=True), crs=haz.centroids.crs)
+    if chunk_size:
+        imp = calc_impact_chunked(stacked, ImpactFuncSet(impfs), haz, chunk_size, n_chunk_workers,
+                                  assign_centroids=False)
+    else:
+        imp = ImpactCalc(stacked, ImpactFuncSet(impfs), haz).impact(save_mat=True, assign_centroids=False)
+
+    event_name = [str(e) for e in imp.event_name]
+    imp_mat = imp.imp_mat.tocsc()
+    impacts = {}
+    for sector, exp_unit, tot_value in zip(sectors, exp_units, tot_values):
+        start, stop = bounds[sector]
+        sector_mat = imp_mat[:, start:stop].tocsr()
+        eai_exp = ImpactCalc.eai_exp_from_mat(sector_mat, imp.frequency)
+        impacts[sector] = Impact(
+            event_id=imp.event_id,
+            event_name=event_name,
+            date=imp.date,
+            frequency=imp.frequency,
+            frequency_unit=imp.frequency_unit,
+            coord_exp=imp.coord_exp[start:stop],
+            crs=imp.crs,
+            eai_exp=eai_exp,
+            at_event=ImpactCalc.at_event_from_mat(sector_mat),
+            aai_agg=ImpactCalc.aai_agg_from_eai_exp(eai_exp),
+            tot_value=tot_value,
+            imp_mat=sector_mat,
+            unit=exp_unit,
+            haz_type=imp.haz_type
+        )
+    return impacts
+
+
+def get_batchable_sectors(
+        haz_type,
+        sectors,
+        country,
+        business_interruption=True,
+        calibrated=True,
+        use_sector_bi_scaling=True):
+    """The sectors worth calculating together with nccs_direct_impacts_batched:
+    those with an impact function identical to one of another sector's.
+
+    Batching only saves work where sectors share impact functions. Otherwise
+    ImpactCalc still evaluates every function separately and stacking the
+    exposures only adds copies. With business interruption each sector's
+    functions are scaled differently, so usually no sectors are returned.
+
+    Returns
+    -------
+    list of str
+    """
+    country_iso3alpha = pycountry.countries.get(name=country).alpha_3
+    sector_keys = {}
+    for sector in sectors:
+        impf_set = apply_sector_impf_set(
+            haz_type,
+            sector,
+            country_iso3alpha,
+            business_interruption,
+            calibrated,
+            use_sector_bi_scaling
+        )
+        sector_keys[sector] = {_impf_key(impf) for impfs in impf_set.get_func().values() for impf in impfs.values()}
+    n_sectors_by_key = Counter(key for keys in sector_keys.values() for key in keys)
+    return [sector for sector in sectors if any(n_sectors_by_key[key] > 1 for key in sector_keys[sector])]
+
+
+def _impf_key(impf):
+    """Identify an impact function by its shape, so that identical functions
+    in different sectors' sets are evaluated once"""
+    return (
+        impf.intensity_unit,
+        np.asarray(impf.intensity, dtype=np.float64).tobytes(),
+        np.asarray(impf.mdd, dtype=np.float64).tobytes(),
+        np.asarray(impf.paa, dtype=np.float64).tobytes(),
+    )
+
+
 # @cache
 # def load_forestry_exposure():
 #     # Load an exposure from an hdf5 file
@@ -81,10 +276,20 @@ def nccs_direct_impacts_simple(
 #     return exp
 
 
+def get_local_exposure_path(s3_filepath):
+    """Where an exposure file from the S3 bucket is stored locally"""
+    return f'{project_root}/{s3_filepath}'
+
+
+def get_local_hazard_path(s3_filepath):
+    """Where a hazard file from the S3 bucket is stored locally"""
+    return f'{project_root}/resources/{s3_filepath}'
+
+
 def download_exposure_from_s3(country, file_short):
     country_iso3alpha = pycountry.countries.get(name=country).alpha_3
     s3_filepath = f'exposures/{file_short}_{country_iso3alpha}.h5'
-    outputfile = f'{project_root}/exposures/{file_short}_{country_iso3alpha}.h5'
+    outputfile = get_local_exposure_path(s3_filepath)
     download_from_s3_bucket(s3_filepath, outputfile)
     h5_file = pd.read_hdf(outputfile)
     # Generate an Exposures instance from DataFrame
@@ -95,66 +300,193 @@ def download_exposure_from_s3(country, file_short):
     return exp
 
 
+def get_centroids_fingerprint(haz):
+    """A hash of a hazard's type and centroid coordinates. Hazards with the
+    same fingerprint, e.g. the historical and future scenarios of a tropical
+    cyclone set, assign exposures to the same centroids."""
+    h = hashlib.sha1(haz.haz_type.encode())
+    for coords in [haz.centroids.lat, haz.centroids.lon]:
+        h.update(np.ascontiguousarray(coords, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def get_exposure_coords_fingerprint(exp):
+    """A hash of an exposure's point coordinates"""
+    h = hashlib.sha1()
+    for coords in [exp.gdf['latitude'], exp.gdf['longitude']]:
+        h.update(np.ascontiguousarray(coords, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def get_centroid_assignment_path(exp, haz):
+    """Where the exposure-to-centroid assignment for an exposure's points and
+    a hazard's centroids is stored"""
+    key = json.dumps([get_exposure_coords_fingerprint(exp), get_centroids_fingerprint(haz)])
+    return Path(get_centroid_assignment_dir(), f'{hashlib.sha1(key.encode()).hexdigest()}.npy')
+
+
+def assign_centroids_cached(exp, haz):
+    """Assign an exposure to a hazard's centroids, reusing the assignment
+    stored by an earlier calculation with the same exposure points and
+    centroids.
+
+    The nearest-centroid search is the slowest part of setting up an impact
+    calculation and its result only depends on the exposure's coordinates and
+    the hazard's grid, so it is done once and shared by all scenarios and
+    years.
+    """
+    centr_col = INDICATOR_CENTR + haz.haz_type
+    path = get_centroid_assignment_path(exp, haz)
+    if path.exists():
+        exp.gdf[centr_col] = np.load(path)
+        return exp
+
+    exp.assign_centroids(haz, overwrite=True)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with atomic_path(path, suffix='.npy') as tmp_path:
+        np.save(tmp_path, exp.gdf[centr_col].to_numpy())
+    return exp
+
+
 def download_hazard_from_s3(s3_filepath):
-    outputfile = f'{project_root}/resources/{s3_filepath}'
+    outputfile = get_local_hazard_path(s3_filepath)
     download_from_s3_bucket(s3_filepath, outputfile)
     haz = Hazard.from_hdf5(outputfile)
     haz.check()
     return haz
 
 
+# Country-split exposure files on the S3 bucket, by sector. Paths are relative to exposures/ and are completed with
+# the country's ISO3 code. Earlier versions of the model (the best guesstimate run) used LitPop for manufacturing, an
+# Excel file for mining and the WRI power plant database for electricity.
+SECTOR_EXPOSURE_FILES = {
+    'manufacturing': 'manufacturing/manufacturing_general_exposure/refinement_1/country_split'
+                     '/global_noxemissions_2011_above_100t_0.1deg_ISO3_values_Manfac_scaled',
+    'mining': 'mining/refinement_1/country_split/'
+              'global_miningarea_v2_30arcsecond_converted_ISO3_improved_values_MP_scaled',
+    'forestry': 'forestry/refinement_1/country_split/forestry_values_MRIO_avg(WB-v2)',
+    # Utilities
+    'energy': 'utilities/refinement_1/Subscore_energy/country_split/Subscore_energy_MRIO',
+    'waste': 'utilities/refinement_1/Subscore_waste/country_split/Subscore_waste_MRIO',
+    'water': 'utilities/refinement_1/Subscore_water/country_split/Subscore_water_MRIO',
+    # Raw materials
+    'pharmaceutical': 'manufacturing/manufacturing_sub_exposures/refinement_1/pharmaceutical/country_split/'
+                      'pharmaceutical_NMVOC_emissions_2011_above_0t_0.1deg_ISO3_values_Manfac_scaled',
+    'basic_metals': 'manufacturing/manufacturing_sub_exposures/refinement_1/basic_metals/country_split'
+                    '/basic_metals_CO_emissions_2011_above_0t_0.1deg_ISO3_values_Manfac_scaled',
+    'chemical': 'manufacturing/manufacturing_sub_exposures/refinement_1/chemical_process/country_split/'
+                'chemical_process_NMVOC_emissions_2011_above_0t_0.1deg_ISO3_values_Manfac_scaled',
+    'food': 'manufacturing/manufacturing_sub_exposures/refinement_1/food_and_paper/country_split'
+            '/food_and_paper_NOX_emissions_2011_above_0t_0.1deg_ISO3_values_Manfac_scaled',
+    'non_metallic_mineral': 'manufacturing/manufacturing_sub_exposures/refinement_1/non_metallic_mineral/'
+                            'country_split/non_metallic_mineral_PM10_emissions_2011_above_0t_0.1deg_ISO3_values'
+                            '_Manfac_scaled',
+    'refin_and_transform': 'manufacturing/manufacturing_sub_exposures/refinement_1/refin_and_transform/'
+                           'country_split/refin_and_transform_NOx_emissions_2011_above_0t_0.1deg_ISO3_values'
+                           '_Manfac_scaled',
+    'rubber_and_plastic': 'manufacturing/manufacturing_sub_exposures/refinement_1/rubber_and_plastic/'
+                          'country_split/rubber_and_plastic_NOx_emissions_2011_above_100t_0.1deg_ISO3_values'
+                          '_Manfac_scaled',
+    'wood': 'manufacturing/manufacturing_sub_exposures/refinement_1/wood/country_split'
+            '/wood_NOx_emissions_2011_above_100t_0.1deg_ISO3_values_Manfac_scaled',
+}
+
+CROP_TYPES = ["whe", "mai", "soy", "ric"]
+
+# Increase when the way exposures are loaded changes, so that cached exposures are not reused
+EXPOSURE_CACHE_VERSION = 1
+
+
+def get_sector_exposure_source(sector, country):
+    """Describe where the exposure for a sector and country is loaded from,
+    without loading it.
+
+    The returned dictionary identifies the exposure data: two calls returning
+    equal dictionaries load the same data. It is used to key cached results.
+
+    Parameters
+    ----------
+    sector : str
+        Sector name, as used in the run configurations
+    country : str
+        Country name, as understood by pycountry
+
+    Returns
+    -------
+    dict
+        'origin' is one of 's3' or 'api'. S3 sources have an 's3_path', API
+        sources have a 'data_type' and the 'properties' used in the query.
+    """
+    if sector in SECTOR_EXPOSURE_FILES:
+        country_iso3alpha = pycountry.countries.get(name=country).alpha_3
+        return {
+            'origin': 's3',
+            's3_path': f'exposures/{SECTOR_EXPOSURE_FILES[sector]}_{country_iso3alpha}.h5'
+        }
+    if sector in ['service', 'economic_assets']:
+        return {'origin': 'api', 'data_type': 'litpop', 'properties': {'country': country}}
+    # In this case a sub sector of agriculture is selected, this is only applied during the direct impacts
+    if sector.startswith('agriculture_'):
+        _, crop_type = agriculture.split_agriculture_sector(sector)
+        return {
+            'origin': 'api',
+            'data_type': 'crop_production',
+            'properties': agriculture.get_exposure_properties(crop_type=crop_type, irr="firr")
+        }
+    if sector == 'agriculture':
+        return {
+            'origin': 'api',
+            'data_type': 'crop_production',
+            'properties': [agriculture.get_exposure_properties(crop_type=crop_type, irr="firr")
+                           for crop_type in CROP_TYPES]
+        }
+    raise ValueError(f'No exposure defined for sector {sector}')
+
+
+def get_exposure_key(sector, country):
+    """A key identifying a sector exposure's data and how it is loaded"""
+    source = json.dumps(get_sector_exposure_source(sector, country), sort_keys=True)
+    return sector, country, EXPOSURE_CACHE_VERSION, source
+
+
 def get_sector_exposure(sector, country):
+    """Get the exposure for a sector and country.
+
+    Exposures are loaded once per process and kept in the exposure cache (see
+    nccs.pipeline.direct.exposure_cache). The returned exposure is a shallow
+    copy of the cached one, whose gdf shares the cached data instead of
+    copying the whole exposure on every call. Callers may add or overwrite
+    columns (as centroid assignment does) but must not modify the values of
+    existing columns in place, unless pandas' copy-on-write is on (the default
+    from pandas 3).
+
+    See get_sector_exposure_source for where each sector's data comes from.
     """
-    There are now commeneted versions that worked previously only locally, as the files were not synched. The best
-    guesstimate
-    results are now also availabe in the s3 bucket and could be selected by changing the file path to the s3 bucket
-    would require to create a new donwload function, as for instance the mining file is an xlsx and would not work
-    with the opening command
+    exp = EXPOSURE_CACHE.get(get_exposure_key(sector, country), lambda: load_sector_exposure(sector, country))
+    return exp.copy(deep=False)
+
+
+def get_sector_cap_vector(sector, country):
+    """The values of a sector exposure as a contiguous array, to cap impacts
+    at (see cap_impact). Computed once per exposure in the exposure cache."""
+    exp = EXPOSURE_CACHE.get(get_exposure_key(sector, country), lambda: load_sector_exposure(sector, country))
+    return get_cap_vector(exp)
+
+
+def load_sector_exposure(sector, country):
+    """Load the exposure for a sector and country, bypassing the exposure
+    cache.
     """
+    if sector not in SECTOR_EXPOSURE_FILES and sector not in ['service', 'economic_assets'] \
+            and not sector.startswith('agriculture'):
+        raise ValueError(f'No exposure defined for sector {sector}')
 
-    if sector == 'service':
-        client = Client()
-        exp = client.get_litpop(country)
-        exp.gdf['value'] = exp.gdf['value']  # / 100
-
-    if sector == 'manufacturing':
-        # best guesstimate run used this:
-        # client = Client()
-        # exp = client.get_litpop(country)  # first guess with litpop
-        # exp.gdf['value'] = exp.gdf['value']  # / 100
-
-        # current active version
-        file_short = (f'manufacturing/manufacturing_general_exposure/refinement_1/country_split'
-                      f'/global_noxemissions_2011_above_100t_0.1deg_ISO3_values_Manfac_scaled')
-        exp = download_exposure_from_s3(country, file_short)
-
-    if sector == 'mining':
-        # best guesstimate run used this:
-        # # load an exposure from an excel file
-        # input_file = f'{get_resource_dir()}/mining/best_guesstimate/mining_500_exposure.xlsx'
-        # excel_data = pd.read_excel(input_file)
-        # # Generate an Exposures instance from DataFrame
-        # exp = Exposures(excel_data)
-        # exp.set_geometry_points()
-        # exp.gdf['value'] = exp.gdf.value
-        # exp.check()
-
-        file_short = (f'{sector}/refinement_1/country_split/'
-                      f'global_miningarea_v2_30arcsecond_converted_ISO3_improved_values_MP_scaled')
-        exp = download_exposure_from_s3(country, file_short)
-
-        # only used for best guesstimate
-    # if sector == 'electricity':
-    #     # load an exposure from an excel file
-    #     input_file = f'{get_resource_dir()}/utilities/best_guesstimate/utilities_power_plant_global_database_WRI.xlsx'
-    #     excel_data = pd.read_excel(input_file)
-    #     # Generate an Exposures instance from DataFrame
-    #     exp = Exposures(excel_data)
-    #     exp.set_geometry_points()
-    #     exp.gdf['value'] = exp.gdf.value
-    #     exp.check()
+    if sector in SECTOR_EXPOSURE_FILES:
+        exp = download_exposure_from_s3(country, SECTOR_EXPOSURE_FILES[sector])
+
+    if sector in ['service', 'economic_assets']:
+        exp = get_api_exposures('litpop', get_litpop_properties(country))
 
-    # In this case a sub sector of agriculture is selected, this is only applied during the direct impacts
     if sector.startswith('agriculture_'):
         _, crop_type = agriculture.split_agriculture_sector(sector)
         exp = agriculture.get_exposure(crop_type=crop_type, scenario="histsoc", irr="firr")
@@ -163,76 +495,13 @@ def get_sector_exposure(sector, country):
         # For agriculture, we need to combine the exposures for the different crop types. Since we
         # have already merged the yearsets for the different crop types.
         exps = [agriculture.get_exposure(crop_type=crop_type, scenario="histsoc", irr="firr")
-                for crop_type in ["whe", "mai", "soy", "ric"]]
+                for crop_type in CROP_TYPES]
         # Sum up the exposures
         exp = exps[0].copy()
         columns_to_sum = "value"
         for i in range(1, len(exps)):
             exp.gdf[columns_to_sum] += exps[i].gdf[columns_to_sum]
 
-    if sector == 'forestry':
-        # exp = load_forestry_exposure() #only used for best guesstimate
-        file_short = f'forestry/refinement_1/country_split/{sector}_values_MRIO_avg(WB-v2)'
-        exp = download_exposure_from_s3(country, file_short)
-
-    # Utilities
-    if sector == 'energy':
-        file_short = f'utilities/refinement_1/Subscore_{sector}/country_split/Subscore_{sector}_MRIO'
-        exp = download_exposure_from_s3(country, file_short)
-
-    if sector == 'waste':
-        file_short = f'utilities/refinement_1/Subscore_{sector}/country_split/Subscore_{sector}_MRIO'
-        exp = download_exposure_from_s3(country, file_short)
-
-    if sector == 'water':
-        file_short = f'utilities/refinement_1/Subscore_{sector}/country_split/Subscore_{sector}_MRIO'
-        exp = download_exposure_from_s3(country, file_short)
-
-    # raw materials
-    if sector == 'pharmaceutical':
-        file_short = (f'manufacturing/manufacturing_sub_exposures/refinement_1/{sector}/country_split/'
-                      f'{sector}_NMVOC_emissions_2011_above_0t_0.1deg_ISO3_values_Manfac_scaled')
-        exp = download_exposure_from_s3(country, file_short)
-
-    if sector == 'basic_metals':
-        file_short = (f'manufacturing/manufacturing_sub_exposures/refinement_1/{sector}/country_split'
-                      f'/{sector}_CO_emissions_2011_above_0t_0.1deg_ISO3_values_Manfac_scaled')
-        exp = download_exposure_from_s3(country, file_short)
-
-    if sector == 'chemical':
-        file_short = (f'manufacturing/manufacturing_sub_exposures/refinement_1/{sector}_process/country_split/'
-                      f'{sector}_process_NMVOC_emissions_2011_above_0t_0.1deg_ISO3_values_Manfac_scaled')
-        exp = download_exposure_from_s3(country, file_short)
-
-    if sector == 'food':
-        file_short = (f'manufacturing/manufacturing_sub_exposures/refinement_1/{sector}_and_paper/country_split'
-                      f'/{sector}_and_paper_NOX_emissions_2011_above_0t_0.1deg_ISO3_values_Manfac_scaled')
-        exp = download_exposure_from_s3(country, file_short)
-
-    if sector == 'non_metallic_mineral':
-        file_short = (f'manufacturing/manufacturing_sub_exposures/refinement_1/{sector}/country_split/'
-                      f'{sector}_PM10_emissions_2011_above_0t_0.1deg_ISO3_values_Manfac_scaled')
-        exp = download_exposure_from_s3(country, file_short)
-
-    if sector == 'refin_and_transform':
-        file_short = (f'manufacturing/manufacturing_sub_exposures/refinement_1/{sector}/country_split/'
-                      f'{sector}_NOx_emissions_2011_above_0t_0.1deg_ISO3_values_Manfac_scaled')
-        exp = download_exposure_from_s3(country, file_short)
-
-    if sector == 'rubber_and_plastic':
-        file_short = (f'manufacturing/manufacturing_sub_exposures/refinement_1/{sector}/country_split/'
-                      f'{sector}_NOx_emissions_2011_above_100t_0.1deg_ISO3_values_Manfac_scaled')
-        exp = download_exposure_from_s3(country, file_short)
-
-    if sector == 'wood':
-        file_short = (f'manufacturing/manufacturing_sub_exposures/refinement_1/{sector}/country_split'
-                      f'/{sector}_NOx_emissions_2011_above_100t_0.1deg_ISO3_values_Manfac_scaled')
-        exp = download_exposure_from_s3(country, file_short)
-
-    if sector == 'economic_assets':
-        client = Client()
-        exp = client.get_litpop(country)
-
     exp.gdf.reset_index(inplace=True)
 
     return exp
@@ -245,6 +514,26 @@ def apply_sector_impf_set(
         business_interruption=True,
         calibrated=True,
         use_sector_bi_scaling=True):
+    """The impact function set for a hazard, sector and country.
+
+    Looked up in the run's impact function registry if there is one (see
+    nccs.pipeline.direct.impf_registry), and built otherwise. Sets from the
+    registry are shared and must not be modified.
+    """
+    args = (hazard, sector, country_iso3alpha, business_interruption, calibrated, use_sector_bi_scaling)
+    impf_set = lookup_impf_set(*args)
+    if impf_set is not None:
+        return impf_set
+    return build_sector_impf_set(*args)
+
+
+def build_sector_impf_set(
+        hazard,
+        sector,
+        country_iso3alpha,
+        business_interruption=True,
+        calibrated=True,
+        use_sector_bi_scaling=True):
     if not business_interruption or sector in ['agriculture', 'economic_assets']:
         sector_bi = None
     else:
@@ -274,20 +563,14 @@ def apply_sector_impf_set(
 
 
 def get_sector_impf_tc(country_iso3alpha, sector_bi, calibrated=True, use_sector_bi_scaling=True):
-    _, impf_ids, _, region_mapping = ImpfSetTropCyclone.get_countries_per_region()
+    _, impf_ids, _, region_mapping = _get_tc_countries_per_region()
     region = [region for region, country_list in region_mapping.items() if country_iso3alpha in country_list]
     if len(region) != 1:
         raise ValueError(f'Could not find a unique region for ISO3 code {country_iso3alpha}. Results: {region}')
     region = region[0]
 
     if calibrated:
-        calibrated_impf_parameters_file = Path(
-            get_resources_dir(),
-            'impact_functions',
-            'tropical_cyclone',
-            'calibrated_emanuel_v1.csv'
-        )
-        calibrated_impf_parameters = pd.read_csv(calibrated_impf_parameters_file).set_index(['region'])
+        calibrated_impf_parameters = _read_calibrated_tc_parameters()
         impf = ImpfTropCyclone.from_emanuel_usa(
             scale=calibrated_impf_parameters.loc[region, 'scale'],
             v_thresh=calibrated_impf_parameters.loc[region, 'v_thresh'],
@@ -295,10 +578,10 @@ def get_sector_impf_tc(country_iso3alpha, sector_bi, calibrated=True, use_sector
         )
     else:
         fun_id = impf_ids[region]
-        impf = ImpfSetTropCyclone.from_calibrated_regional_ImpfSet().get_func(
+        impf = copy.deepcopy(_get_calibrated_regional_tc_impf_set().get_func(
             haz_type='TC',
             fun_id=fun_id
-        )  # To use Eberenz functions
+        ))  # To use Eberenz functions
 
     impf.id = 1
     if not sector_bi:
@@ -311,6 +594,37 @@ def get_sector_impf_tc(country_iso3alpha, sector_bi, calibrated=True, use_sector
     )
 
 
+@cache
+def _read_calibrated_tc_parameters():
+    calibrated_impf_parameters_file = Path(
+        get_resources_dir(),
+        'impact_functions',
+        'tropical_cyclone',
+        'calibrated_emanuel_v1.csv'
+    )
+    return pd.read_csv(calibrated_impf_parameters_file).set_index(['region'])
+
+
+@cache
+def _get_tc_countries_per_region():
+    return ImpfSetTropCyclone.get_countries_per_region()
+
+
+@cache
+def _get_calibrated_regional_tc_impf_set():
+    return ImpfSetTropCyclone.from_calibrated_regional_ImpfSet()
+
+
+@cache
+def _read_river_flood_regions():
+    return pd.read_csv(RIVER_FLOOD_REGIONS_CSV)
+
+
+@cache
+def _get_flood_imp_func_set():
+    return flood_imp_func_set()
+
+
 #####
 ## Option 2, apply BI scaling but keep global emanuel function
 #####
@@ -326,31 +640,10 @@ def get_sector_impf_tc(country_iso3alpha, sector_bi, calibrated=True, use_sector
 
 def get_sector_impf_rf(country_iso3alpha, sector_bi, use_sector_bi_scaling=True, haz_type='RF'):
     # Use the flood module's lookup to get the regional impact function for the country
-    country_info = pd.read_csv(RIVER_FLOOD_REGIONS_CSV)
+    country_info = _read_river_flood_regions()
     impf_id = country_info.loc[country_info['ISO'] == country_iso3alpha, 'impf_RF'].values[0]
     # Grab just that impact function from the flood set, and set its ID to 1
-    impf_set = flood_imp_func_set()
-    impf_set.plot()
-    impf_AFR = impf_set.get_func(fun_id=1)
-    impf_AFR[0].plot()
-
-    impf_ASIA = impf_set.get_func(fun_id=2)
-    impf_ASIA[0].plot()
-
-    impf_EU = impf_set.get_func(fun_id=3)
-    impf_EU[0].plot()
-
-    impf_NA = impf_set.get_func(fun_id=4)
-    impf_NA[0].plot()
-
-    impf_OCE = impf_set.get_func(fun_id=5)
-    impf_OCE[0].plot()
-
-    impf_SAM = impf_set.get_func(fun_id=6)
-    impf_SAM[0].plot()
-
-
-    impf = impf_set.get_func(haz_type='RF',fun_id=impf_id)
+    impf = copy.deepcopy(_get_flood_imp_func_set().get_func(haz_type='RF', fun_id=impf_id))
 
     if haz_type != "RF":
         impf.haz_type = haz_type
@@ -394,49 +687,67 @@ def get_sector_impf_wf(sector_bi, country_iso3alpha=None, use_sector_bi_scaling=
     )
 
 
-def get_hazard(haz_type, country_iso3alpha, scenario, ref_year):
-    client = Client()
+def get_hazard_source(haz_type, country_iso3alpha, scenario, ref_year):
+    """Describe where the hazard for an analysis is loaded from, without
+    loading it.
+
+    The returned dictionary identifies the hazard data: two calls returning
+    equal dictionaries load the same hazard. It is used to key cached results.
+
+    Parameters
+    ----------
+    haz_type : str
+        One of HAZ_TYPE_LOOKUP, or a crop-specific relative_crop_yield hazard
+    country_iso3alpha : str
+        ISO3 code of the country
+    scenario : str
+        Climate scenario, or 'None' for the historical climate
+    ref_year : int or str
+        Reference year of the scenario, or 'historical'
+
+    Returns
+    -------
+    dict or None
+        'origin' is one of 's3', 'api', 'storm_europe' or 'crop'. S3 sources
+        have an 's3_path', API and crop sources have a 'data_type' and the
+        'properties' used in the query. None if no hazard is available for
+        this combination.
+    """
     if haz_type == 'tropical_cyclone':
         if scenario == 'None' and ref_year == 'historical':
             s3_path = f'hazard/tc_wind/historical/tropcyc_{country_iso3alpha}_historical.hdf5'
         else:
             s3_path = (f'hazard/tc_wind/{scenario}_{ref_year}/tropcyc_150arcsec_25synth_'
                        f'{country_iso3alpha}_1980_to_2023_{scenario}_{ref_year}.hdf5')
-        return download_hazard_from_s3(s3_path)
+        return {'origin': 's3', 's3_path': s3_path}
 
     elif haz_type == 'river_flood':
         if scenario == 'None' and ref_year == 'historical':
-            return client.get_hazard(
-                haz_type, properties={
-                    'country_iso3alpha': country_iso3alpha,
-                    'climate_scenario': 'historical', 'year_range': '1980_2000'
-                }
-            )
+            properties = {
+                'country_iso3alpha': country_iso3alpha,
+                'climate_scenario': 'historical', 'year_range': '1980_2000'
+            }
         else:
             year_range_midpoint = round(ref_year / 20) * 20
             year_range = str(year_range_midpoint - 10) + '_' + str(year_range_midpoint + 10)
-            return client.get_hazard(
-                haz_type, properties={
-                    'country_iso3alpha': country_iso3alpha,
-                    'climate_scenario': scenario, 'year_range': year_range
-                }
-            )
+            properties = {
+                'country_iso3alpha': country_iso3alpha,
+                'climate_scenario': scenario, 'year_range': year_range
+            }
+        return {'origin': 'api', 'data_type': haz_type, 'properties': properties}
+
     elif haz_type == 'wildfire':
         year_range = '2001_2020'
         if scenario == 'None' and ref_year == 'historical':
-            return client.get_hazard(
-                haz_type, properties={
-                    'country_iso3alpha': country_iso3alpha,
-                    'climate_scenario': 'historical', 'year_range': year_range
-                }
-            )
+            properties = {
+                'country_iso3alpha': country_iso3alpha,
+                'climate_scenario': 'historical', 'year_range': year_range
+            }
+            return {'origin': 'api', 'data_type': haz_type, 'properties': properties}
+        return None
+
     elif haz_type == "storm_europe":
-        country_iso3num = pycountry.countries.get(alpha_3=country_iso3alpha).numeric
-        haz = stormeurope.get_hazard(
-            scenario=scenario,
-            country_iso3alpha=country_iso3alpha
-        )
-        return haz
+        return {'origin': 'storm_europe', 'scenario': scenario, 'country_iso3alpha': country_iso3alpha}
 
     elif haz_type == 'sea_level_rise':
         """
@@ -461,36 +772,101 @@ def get_hazard(haz_type, country_iso3alpha, scenario, ref_year):
         else:
             s3_path = (f'hazard/tc_surge/no_cc/{scenario}_{ref_year}slr/surge_28arcsec_25synth_{country_iso3alpha}'
                        f'_{scenario}_{ref_year}slr_no_cc.hdf5')
-        return download_hazard_from_s3(s3_path)
+        return {'origin': 's3', 's3_path': s3_path}
 
     elif haz_type.startswith("relative_crop_yield"):
         _, crop_type = agriculture.split_agriculture_hazard(haz_type)
         # TODO currently always returns the same hazard
         if scenario == 'None' and ref_year == "historical":
             # For soy, there is another historical period available (due to availability)
-            if crop_type == 'soy':
-                return agriculture.get_hazard(
-                    country=country_iso3alpha,
-                    year_range="1980_2012",
-                    scenario="historical",
-                    crop_type=crop_type
-                )
             # For the other crop types we use this historical period (due to availability)
-            else:
-                return agriculture.get_hazard(
-                    country=country_iso3alpha,
-                    year_range="1971_2001",
-                    scenario="historical",
-                    crop_type=crop_type
-                )
+            year_range = "1980_2012" if crop_type == 'soy' else "1971_2001"
+            crop_scenario = "historical"
+            date_range = None
         else:
-            return agriculture.get_hazard(
-                country=country_iso3alpha,
-                year_range="2006_2099",
-                scenario=scenario,
-                crop_type=crop_type
-            ).select(date=('2045-01-01', '2074-12-31'))
+            year_range = "2006_2099"
+            crop_scenario = scenario
+            date_range = ('2045-01-01', '2074-12-31')
+        return {
+            'origin': 'crop',
+            'data_type': 'relative_cropyield',
+            'properties': agriculture.get_hazard_properties(year_range, crop_scenario, crop_type),
+            'country_iso3alpha': country_iso3alpha,
+            'date_range': date_range
+        }
     else:
         raise ValueError(
             f'Unrecognised haz_type variable: {haz_type}.\nPlease use one of: {list(HAZ_TYPE_LOOKUP)}'
         )
+
+
+def get_data_api_queries(haz_type, sector, country, scenario, ref_year):
+    """The CLIMADA data API queries an analysis loads its hazard and exposure
+    with, as (data type, properties) pairs for the data catalog (see
+    nccs.utils.data_catalog)"""
+    country_iso3alpha = pycountry.countries.get(name=country).alpha_3
+    queries = []
+    hazard_source = get_hazard_source(haz_type, country_iso3alpha, scenario, ref_year)
+    if hazard_source is not None and hazard_source['origin'] in ['api', 'crop']:
+        queries.append((hazard_source['data_type'], hazard_source['properties']))
+    elif hazard_source is not None and hazard_source['origin'] == 'storm_europe' \
+            and hazard_source['scenario'] == 'observed':
+        queries.append((stormeurope.ERA5_DATA_TYPE, stormeurope.ERA5_PROPERTIES))
+
+    exposure_source = get_sector_exposure_source(sector, country)
+    if exposure_source.get('data_type') == 'litpop':
+        queries.append(('litpop', get_litpop_properties(country)))
+    elif exposure_source['origin'] == 'api':
+        properties = exposure_source['properties']
+        for p in properties if isinstance(properties, list) else [properties]:
+            queries.append((exposure_source['data_type'], p))
+    return queries
+
+
+def get_s3_input_files(haz_type, sector, country, scenario, ref_year):
+    """The files an analysis downloads from the S3 bucket for its hazard and
+    exposure, as (S3 key, local path) pairs for the prefetcher (see
+    nccs.pipeline.prefetch)"""
+    country_iso3alpha = pycountry.countries.get(name=country).alpha_3
+    files = []
+    hazard_source = get_hazard_source(haz_type, country_iso3alpha, scenario, ref_year)
+    if hazard_source is not None and hazard_source['origin'] == 's3':
+        files.append((hazard_source['s3_path'], get_local_hazard_path(hazard_source['s3_path'])))
+
+    exposure_source = get_sector_exposure_source(sector, country)
+    if exposure_source['origin'] == 's3':
+        files.append((exposure_source['s3_path'], get_local_exposure_path(exposure_source['s3_path'])))
+    return files
+
+
+def get_hazard(haz_type, country_iso3alpha, scenario, ref_year):
+    source = get_hazard_source(haz_type, country_iso3alpha, scenario, ref_year)
+    if source is None:
+        return None
+
+    if source['origin'] == 's3':
+        return download_hazard_from_s3(source['s3_path'])
+
+    if source['origin'] == 'api':
+        return get_api_hazard(source['data_type'], source['properties'])
+
+    if source['origin'] == 'storm_europe':
+        return stormeurope.get_hazard(
+            scenario=source['scenario'],
+            country_iso3alpha=source['country_iso3alpha']
+        )
+
+    if source['origin'] == 'crop':
+        properties = source['properties']
+        haz = agriculture.get_hazard(
+            country=source['country_iso3alpha'],
+            year_range=properties['year_range'],
+            scenario=properties['climate_scenario'],
+            crop_type=properties['crop'],
+            irr=properties['irrigation_status']
+        )
+        if source['date_range'] is not None:
+            haz = haz.select(date=source['date_range'])
+        return haz
+
+    raise ValueError(f'Unrecognised hazard source: {source}')
@@ -0,0 +1,115 @@
+"""
+A process-level cache of loaded exposures.
+
+The same sector exposure is used to calculate direct impacts, to cap yearsets
+and combined yearsets, and to model supply chain impacts. Loading it means
+reading an HDF5 file or API dataset, building point geometries and checking
+the result, so the cache keeps recently used exposures in memory up to a
+memory budget and evicts the least recently used ones beyond it.
+
+The budget is passed to worker processes through the environment.
+"""
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+LOGGER = logging.getLogger(__name__)
+
+EXPOSURE_CACHE_MB_ENV = 'NCCS_EXPOSURE_CACHE_MB'
+DEFAULT_EXPOSURE_CACHE_MB = 2048
+
+
+def set_exposure_cache_budget(max_mb):
+    """Set the memory budget of the exposure cache in this process and the
+    processes it starts. 0 turns the cache off, None restores the default."""
+    if max_mb is None:
+        os.environ.pop(EXPOSURE_CACHE_MB_ENV, None)
+    else:
+        os.environ[EXPOSURE_CACHE_MB_ENV] = str(max_mb)
+    EXPOSURE_CACHE.clear()
+
+
+def get_exposure_cache_budget():
+    """The memory budget of the exposure cache in bytes"""
+    return int(float(os.environ.get(EXPOSURE_CACHE_MB_ENV, DEFAULT_EXPOSURE_CACHE_MB)) * 1024 ** 2)
+
+
+def exposure_nbytes(exp):
+    """Approximate memory used by an exposure's data"""
+    return int(exp.gdf.memory_usage(deep=True).sum())
+
+
+class LRUCache:
+    """A thread-safe least recently used cache bounded by the total size of
+    its values.
+
+    Parameters
+    ----------
+    max_bytes : int or callable
+        Memory budget, or a function returning it (read on every insert so the
+        budget can change during a run)
+    nbytes : callable
+        Returns the size in bytes of a cached value
+    """
+
+    def __init__(self, max_bytes, nbytes):
+        self._max_bytes = max_bytes
+        self.nbytes = nbytes
+        self._items = OrderedDict()
+        self._lock = threading.RLock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes() if callable(self._max_bytes) else self._max_bytes
+
+    def get(self, key, load):
+        """Return the cached value for a key, calling load() to create it if
+        it isn't cached"""
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key][0]
+            self.misses += 1
+        value = load()
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        max_bytes = self.max_bytes
+        size = self.nbytes(value)
+        with self._lock:
+            self._remove(key)
+            if size > max_bytes:
+                LOGGER.debug(f'Not caching {key}: {size} bytes is over the cache budget of {max_bytes}')
+                return
+            self._items[key] = (value, size)
+            self.total_bytes += size
+            while self.total_bytes > max_bytes:
+                evicted, (_, evicted_size) = self._items.popitem(last=False)
+                self.total_bytes -= evicted_size
+                LOGGER.debug(f'Evicted {evicted} from the cache')
+
+    def _remove(self, key):
+        if key in self._items:
+            _, size = self._items.pop(key)
+            self.total_bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.total_bytes = 0
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+
+EXPOSURE_CACHE = LRUCache(get_exposure_cache_budget, exposure_nbytes)
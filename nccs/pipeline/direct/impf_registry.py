@@ -0,0 +1,160 @@
+"""
+A registry of the impact function sets used in a run.
+
+Building a sector's impact function set reads several CSV files and composes
+the hazard's damage function with the sector's business interruption
+function. The registry builds every set a run needs once, before any impacts
+are calculated, and writes them all to one file. Each worker process loads
+the file once and then gets impact function sets by lookup.
+
+The registry file is passed to worker processes through the environment. It
+records a fingerprint of the impact function resource files and of the code
+that built it, and is ignored when these have changed since.
+"""
+
+import hashlib
+import importlib
+import inspect
+import logging
+import os
+import pickle
+from functools import cache, lru_cache
+from pathlib import Path
+
+from climada.entity import ImpactFunc, ImpactFuncSet
+
+from nccs.utils.atomic_files import atomic_path
+from nccs.utils.folder_naming import get_resources_dir
+
+LOGGER = logging.getLogger(__name__)
+
+IMPF_REGISTRY_PATH_ENV = 'NCCS_IMPF_REGISTRY_PATH'
+IMPF_REGISTRY_VERSION = 2
+
+_IMPF_FIELDS = ['haz_type', 'id', 'intensity', 'mdd', 'paa', 'intensity_unit', 'name']
+
+
+def set_impf_registry_path(path):
+    """Set the registry file that this process and the processes it starts
+    look impact function sets up in. None turns lookups off."""
+    if path is None:
+        os.environ.pop(IMPF_REGISTRY_PATH_ENV, None)
+    else:
+        os.environ[IMPF_REGISTRY_PATH_ENV] = os.fspath(path)
+
+
+def get_impf_registry_path():
+    return os.environ.get(IMPF_REGISTRY_PATH_ENV)
+
+
+@cache
+def get_impf_resources_fingerprint():
+    """Hash the contents of the impact function resource files (calibrated
+    parameters and business interruption tables) so that editing them
+    invalidates stored impacts and impact function sets."""
+    h = hashlib.sha256()
+    impf_dir = Path(get_resources_dir(), 'impact_functions')
+    for f in sorted(impf_dir.rglob('*.csv')):
+        h.update(str(f.relative_to(impf_dir)).encode())
+        h.update(f.read_bytes())
+    return h.hexdigest()
+
+
+@cache
+def get_impf_registry_fingerprint(build_module):
+    """Hash the impact function resource files and the source of the module
+    that builds the impact function sets, so that a registry isn't used after
+    either has changed"""
+    h = hashlib.sha256(get_impf_resources_fingerprint().encode())
+    h.update(inspect.getsource(importlib.import_module(build_module)).encode())
+    return h.hexdigest()
+
+
+def get_impf_key(hazard, sector, country_iso3alpha, business_interruption, calibrated, use_sector_bi_scaling):
+    """The registry key of a sector's impact function set"""
+    flags = [bool(business_interruption), bool(calibrated), bool(use_sector_bi_scaling)]
+    return '|'.join([str(hazard), str(sector), str(country_iso3alpha), *[str(int(f)) for f in flags]])
+
+
+def build_impf_registry(keys, build, path):
+    """Build the impact function sets for a list of keys and write them to a
+    registry file.
+
+    Parameters
+    ----------
+    keys : iterable of tuple
+        Arguments to get_impf_key for each set
+    build : callable
+        Builds the impact function set for one key's arguments, e.g.
+        nccs.pipeline.direct.direct.build_sector_impf_set
+    path : str or os.PathLike
+        Where to write the registry
+
+    Returns
+    -------
+    int
+        Number of impact function sets in the registry. Sets that can't be
+        built are left out: looking them up builds them again and raises the
+        error where the impacts are calculated.
+    """
+    registry = {}
+    for args in dict.fromkeys(keys):
+        try:
+            impf_set = build(*args)
+        except Exception:
+            LOGGER.warning(f'Could not build the impact functions for {args}', exc_info=True)
+            continue
+        registry[get_impf_key(*args)] = [
+            tuple(getattr(impf, field) for field in _IMPF_FIELDS)
+            for haz_type in impf_set.get_hazard_types()
+            for impf in impf_set.get_func(haz_type=haz_type)
+        ]
+
+    contents = {
+        'version': IMPF_REGISTRY_VERSION,
+        'build_module': build.__module__,
+        'fingerprint': get_impf_registry_fingerprint(build.__module__),
+        'impf_sets': registry
+    }
+    with atomic_path(path) as tmp_path, open(tmp_path, 'wb') as f:
+        pickle.dump(contents, f, protocol=pickle.HIGHEST_PROTOCOL)
+    load_impf_registry.cache_clear()
+    return len(registry)
+
+
+@lru_cache(maxsize=4)
+def load_impf_registry(path):
+    """Load a registry file into a dictionary of impact function sets. Loaded
+    once per process. Registries written by another version, or before the
+    resource files or the code building the sets changed, load as empty."""
+    with open(path, 'rb') as f:
+        registry = pickle.load(f)
+    if registry.get('version') != IMPF_REGISTRY_VERSION:
+        LOGGER.warning(f'Ignoring impact function registry {path}: it was written by another version')
+        return {}
+    if registry['fingerprint'] != get_impf_registry_fingerprint(registry['build_module']):
+        LOGGER.warning(f'Ignoring impact function registry {path}: the impact functions have changed since it was '
+                       f'written')
+        return {}
+    return {
+        key: ImpactFuncSet([ImpactFunc(**dict(zip(_IMPF_FIELDS, values))) for values in impfs])
+        for key, impfs in registry['impf_sets'].items()
+    }
+
+
+def lookup_impf_set(*args):
+    """The impact function set for get_impf_key's arguments from the current
+    registry, or None if there is no registry or it doesn't have the set.
+
+    The returned set is shared by all lookups in the process and must not be
+    modified.
+    """
+    path = get_impf_registry_path()
+    if path is None:
+        return None
+    try:
+        registry = load_impf_registry(path)
+    except OSError:
+        LOGGER.warning(f'Could not read the impact function registry {path}', exc_info=True)
+        return None
+    return registry.get(get_impf_key(*args))
@@ -0,0 +1,109 @@
+"""
+Read impact files lazily.
+
+Impact.from_hdf5 reads every dataset of an impact file into memory. Sampling
+yearsets and combining them only need a few of them, and only some rows of
+the impact matrix. LazyImpact reads each dataset the first time it is used,
+and memory-maps the impact matrix's CSR arrays so that only the rows used are
+read from disk.
+"""
+
+import logging
+import os
+
+import h5py
+import numpy as np
+from climada.engine import Impact
+from scipy import sparse
+
+LOGGER = logging.getLogger(__name__)
+
+# The datasets and attributes of an impact file written by Impact.write_hdf5
+ARRAY_DATASETS = ('event_id', 'date', 'coord_exp', 'eai_exp', 'at_event', 'frequency')
+SCALAR_ATTRS = ('crs', 'tot_value', 'unit', 'aai_agg', 'frequency_unit', 'haz_type')
+
+
+def _memmap_dataset(filepath, dataset):
+    """Memory-map an HDF5 dataset if it is stored contiguously and
+    uncompressed, and read it otherwise"""
+    offset = dataset.id.get_offset()
+    if offset is None or dataset.chunks is not None or dataset.compression is not None or dataset.size == 0:
+        return dataset[()]
+    return np.memmap(filepath, dtype=dataset.dtype, mode='r', offset=offset, shape=dataset.shape)
+
+
+class LazyImpact:
+    """An impact file whose datasets are read when they are first used.
+
+    The attributes of a CLIMADA Impact (event_id, frequency, at_event,
+    coord_exp, unit, ...) can be read from it, so it can stand in for an
+    Impact where only those are used. imp_mat is a CSR matrix backed by
+    memory-mapped arrays: it is read-only.
+
+    Examples
+    --------
+        >>> with LazyImpact(path) as imp:
+        >>>     rows = imp.imp_mat[[3, 17]]
+        >>>     impact = imp.to_impact(imp_mat=False)
+    """
+
+    def __init__(self, filepath):
+        self.filepath = os.fspath(filepath)
+        self._file = h5py.File(self.filepath, 'r')
+        self._cache = {}
+
+    def __getattr__(self, name):
+        # Only called for attributes that aren't set on the instance
+        if name.startswith('_') or name not in ARRAY_DATASETS + SCALAR_ATTRS + ('event_name', 'imp_mat'):
+            raise AttributeError(name)
+        if name not in self._cache:
+            self._cache[name] = self._read(name)
+        return self._cache[name]
+
+    def _read(self, name):
+        if name == 'imp_mat':
+            return self._read_imp_mat()
+        if name == 'event_name':
+            return list(self._file['event_name'].asstr()[:]) if 'event_name' in self._file else []
+        if name in ARRAY_DATASETS:
+            return self._file[name][:] if name in self._file else None
+        return self._file.attrs.get(name)
+
+    def _read_imp_mat(self):
+        if 'imp_mat' not in self._file:
+            return sparse.csr_matrix(np.empty((0, 0)))
+        group = self._file['imp_mat']
+        arrays = [_memmap_dataset(self.filepath, group[name]) for name in ['data', 'indices', 'indptr']]
+        return sparse.csr_matrix(tuple(arrays), shape=tuple(group.attrs['shape']), copy=False)
+
+    @property
+    def n_events(self):
+        return self._file['event_id'].shape[0]
+
+    def to_impact(self, imp_mat=True):
+        """Build a CLIMADA Impact from the file.
+
+        Parameters
+        ----------
+        imp_mat : bool
+            Also load the impact matrix. Without it the Impact has an empty
+            matrix, which saves memory when the matrix is read from this
+            object instead.
+        """
+        kwargs = {name: getattr(self, name) for name in ARRAY_DATASETS + SCALAR_ATTRS
+                  if name in self._file or name in self._file.attrs}
+        kwargs['event_name'] = self.event_name
+        if imp_mat and 'imp_mat' in self._file:
+            kwargs['imp_mat'] = self.imp_mat.copy()
+        return Impact(**kwargs)
+
+    def close(self):
+        self._file.close()
+        self._cache.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
@@ -0,0 +1,140 @@
+"""
+Event sampling plans shared by the yearsets of an event set.
+
+Every sector of a (hazard, country, scenario, reference year) group has an
+impact over the same event set. Instead of sampling years for each sector's
+impact, the events of each simulated year are sampled once per event set,
+seed, number of years and sampling method. The resulting plan is written to
+disk, kept in memory, and applied to every sector's impact matrix, so all
+sectors are sampled on identical simulated years.
+
+Plans are stored as the positions of the sampled events in the full event
+set. Impacts whose zero-impact events were dropped (see prune_zero_events)
+map the positions to the events they kept and leave out the others.
+"""
+
+import hashlib
+import logging
+from pathlib import Path
+
+import numpy as np
+from climada.util import yearsets
+
+from nccs.pipeline.direct.exposure_cache import LRUCache
+from nccs.utils.atomic_files import atomic_path
+
+LOGGER = logging.getLogger(__name__)
+
+SAMPLING_PLAN_VERSION = 1
+SAMPLING_PLAN_CACHE_MB = 256
+
+
+def sampling_plan_nbytes(plan):
+    indptr, positions = plan
+    return indptr.nbytes + positions.nbytes
+
+
+# Plans used by this process, by key
+SAMPLING_PLAN_CACHE = LRUCache(SAMPLING_PLAN_CACHE_MB * 1024 ** 2, sampling_plan_nbytes)
+
+
+def get_sampling_plan_key(event_id, frequency, n_sim_years, poisson, seed):
+    """Identify a sampling plan by a hash of its event set and sampling
+    parameters"""
+    h = hashlib.sha1(repr([SAMPLING_PLAN_VERSION, int(n_sim_years), bool(poisson), seed]).encode())
+    h.update(np.ascontiguousarray(event_id, dtype=np.int64).tobytes())
+    h.update(np.ascontiguousarray(frequency, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def make_sampling_plan(frequency, n_sim_years, poisson, seed):
+    """Sample the events of each simulated year from an event set.
+
+    Poisson sampling draws as yearset_from_imp does for the full event set.
+    Otherwise each year is one event, drawn uniformly with the seed.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        indptr and positions: the events of year i are at
+        positions[indptr[i]:indptr[i + 1]]
+    """
+    if poisson:
+        lam = np.sum(frequency) * 25 / 26  # The same frequency correction as yearset_from_imp
+        events_per_year = yearsets.sample_from_poisson(n_sim_years, lam, seed=seed)
+        samp_vec = yearsets.sample_events(events_per_year, np.asarray(frequency), seed=seed)
+    else:
+        draws = np.random.RandomState(seed).randint(len(frequency), size=n_sim_years)
+        samp_vec = [np.array([x]) for x in draws]
+
+    indptr = np.zeros(len(samp_vec) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(events) for events in samp_vec])
+    positions = np.concatenate([np.asarray(events, dtype=np.int64).ravel() for events in samp_vec] + [
+        np.array([], dtype=np.int64)])
+    return indptr, positions
+
+
+def get_sampling_plan(event_id, frequency, n_sim_years, poisson, seed, plan_dir=None):
+    """The sampling plan of an event set, from memory, from plan_dir or
+    newly sampled (and then written to plan_dir).
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        indptr and positions, as returned by make_sampling_plan. Shared by
+        all users of the plan: don't modify them.
+    """
+    key = get_sampling_plan_key(event_id, frequency, n_sim_years, poisson, seed)
+
+    def load():
+        path = Path(plan_dir, f'{key}.npz') if plan_dir is not None else None
+        if path is not None and path.exists():
+            with np.load(path) as f:
+                return f['indptr'], f['positions']
+        plan = make_sampling_plan(frequency, n_sim_years, poisson, seed)
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with atomic_path(path, suffix='.npz') as tmp_path:
+                np.savez(tmp_path, indptr=plan[0], positions=plan[1])
+        return plan
+
+    return SAMPLING_PLAN_CACHE.get(key, load)
+
+
+def apply_sampling_plan(plan, event_id_total, event_id):
+    """The sampling vector of an impact under a plan of its full event set:
+    for each year, the rows of the impact's sampled events.
+
+    Parameters
+    ----------
+    plan : tuple of numpy.ndarray
+        indptr and positions in the full event set
+    event_id_total : numpy.ndarray
+        Event ids of the full event set
+    event_id : numpy.ndarray
+        Event ids of the impact: the full event set, or part of it if its
+        zero-impact events were dropped. Dropped events are left out of the
+        years they were sampled in.
+
+    Returns
+    -------
+    list of numpy.ndarray
+    """
+    indptr, positions = plan
+    event_id_total = np.asarray(event_id_total)
+    event_id = np.asarray(event_id)
+    if np.array_equal(event_id_total, event_id):
+        return np.split(positions, indptr[1:-1])
+
+    # The row of each event of the full set in the impact, or -1 if it was dropped
+    rows = np.full(len(event_id_total), -1, dtype=np.int64)
+    if len(event_id) > 0:
+        order = np.argsort(event_id, kind='stable')
+        found = order[np.minimum(np.searchsorted(event_id, event_id_total, sorter=order), len(event_id) - 1)]
+        rows = np.where(event_id[found] == event_id_total, found, -1)
+
+    sampled_rows = rows[positions]
+    kept = sampled_rows >= 0
+    # The number of kept events before each year's first event gives the years' boundaries among the kept events
+    kept_indptr = np.concatenate([[0], np.cumsum(kept)])[indptr]
+    return np.split(sampled_rows[kept], kept_indptr[1:-1])
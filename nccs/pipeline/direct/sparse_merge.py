@@ -0,0 +1,146 @@
+"""
+Merge several sparse matrices into one in a single pass.
+
+Combining the yearsets of several hazards by folding pairs of matrices
+together allocates a new intermediate CSR matrix at every step. merge_csr
+merges k CSR matrices of the same shape at once: it keys their entries by
+position, merges the k sorted key runs in one stable sort to find the union
+of their sparsity patterns, and reduces the values at each position with a
+single vectorised reduceat. It also counts how many matrices are non-zero at
+each position, which combining with occur_together needs.
+
+scipy's pairwise operations are linear merges in compiled code, so folding
+is still faster for a handful of matrices. The sort-based merge scales as
+n log k rather than n k and overtakes folding for many inputs, especially
+when the non-zero counts are needed too. Run this module to benchmark the
+two on your machine.
+
+combine_yearsets doesn't use it yet: a multihazard combination has 2 to 6
+inputs, where folding is faster. On 300 x 200,000 yearsets with 10% non-zeros,
+none of a concatenation followed by sum_duplicates, a product with stacked
+identity matrices, or Numba k-way and dense-accumulator kernels beat folding
+below 6 inputs, and all of them lose when the inputs share most of their
+non-zeros.
+"""
+
+import logging
+import time
+from functools import reduce
+
+import numpy as np
+from scipy import sparse
+
+LOGGER = logging.getLogger(__name__)
+
+_REDUCERS = {'sum': np.add, 'max': np.maximum, 'min': np.minimum}
+
+
+def merge_csr(matrices, how='sum', return_counts=False):
+    """Combine CSR matrices of the same shape element-wise.
+
+    The result is the same as folding the matrices pairwise with +,
+    .maximum or .minimum: positions missing from some matrices count as
+    zeros there.
+
+    Parameters
+    ----------
+    matrices : list of scipy.sparse matrix
+    how : str
+        'sum', 'max' or 'min'
+    return_counts : bool
+        Also return, for each stored value of the result, the number of
+        matrices with a non-zero value at its position
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix or tuple
+        The merged matrix, with sorted indices and no explicit zeros, and the
+        counts if return_counts is set
+    """
+    if how not in _REDUCERS:
+        raise ValueError(f"'{how}' is not a valid method. The implemented methods are sum, max or min")
+    if len(matrices) == 0:
+        raise ValueError('No matrices to merge')
+    shape = matrices[0].shape
+    if any(m.shape != shape for m in matrices):
+        raise ValueError(f'Matrices to merge must have the same shape: {[m.shape for m in matrices]}')
+    dtype = np.result_type(*[m.dtype for m in matrices])
+
+    # Key each entry by its position in the flattened matrix. Explicit zeros are dropped so they don't count as present
+    keys, indices, values = [], [], []
+    for m in matrices:
+        m = sparse.csr_matrix(m)
+        m_keys = np.repeat(np.arange(shape[0], dtype=np.int64) * shape[1], np.diff(m.indptr)) + m.indices
+        if m.data.all():
+            keys.append(m_keys), indices.append(m.indices), values.append(m.data)
+        else:
+            nonzero = m.data != 0
+            keys.append(m_keys[nonzero]), indices.append(m.indices[nonzero]), values.append(m.data[nonzero])
+    keys = np.concatenate(keys)
+
+    # Each matrix's keys are already sorted, so a stable sort only merges k sorted runs
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    values = np.concatenate(values).astype(dtype, copy=False)[order]
+    is_start = np.empty(keys.shape[0], dtype=bool)
+    is_start[:1] = True
+    np.not_equal(keys[1:], keys[:-1], out=is_start[1:])
+    starts = np.flatnonzero(is_start)
+
+    merged = _REDUCERS[how].reduceat(values, starts) if starts.size > 0 else values
+    counts = np.diff(np.append(starts, keys.shape[0]))
+    if how != 'sum':
+        # Positions missing from some matrices compare against their implicit zeros
+        missing = counts < len(matrices)
+        merged[missing] = _REDUCERS[how](merged[missing], 0)
+
+    kept = merged != 0
+    starts, merged, counts = starts[kept], merged[kept], counts[kept]
+    # Row boundaries in the merged, sorted keys
+    indptr = np.searchsorted(keys[starts], np.arange(shape[0] + 1, dtype=np.int64) * shape[1])
+    result = sparse.csr_matrix((merged, np.concatenate(indices)[order[starts]], indptr), shape=shape)
+    return (result, counts) if return_counts else result
+
+
+def merge_csr_pairwise(matrices, how='sum'):
+    """The pairwise fold merge_csr replaces, for comparison"""
+    f = {
+        'sum': lambda m1, m2: m1 + m2,
+        'max': lambda m1, m2: m1.maximum(m2),
+        'min': lambda m1, m2: m1.minimum(m2),
+    }[how]
+    return reduce(f, matrices).tocsr()
+
+
+def benchmark(n_matrices=6, n_rows=1000, n_cols=200_000, density=0.01, n_repeats=3, seed=161):
+    """Time merge_csr against the pairwise fold on random matrices.
+
+    Returns
+    -------
+    dict
+        The best time in seconds of each method, by method name
+    """
+    rng = np.random.default_rng(seed)
+    nnz = int(n_rows * n_cols * density)
+    matrices = [
+        sparse.csr_matrix(
+            (rng.random(nnz), (rng.integers(n_rows, size=nnz), rng.integers(n_cols, size=nnz))),
+            shape=(n_rows, n_cols)
+        )
+        for _ in range(n_matrices)
+    ]
+    timings = {}
+    for how in _REDUCERS:
+        for name, merge in [('pairwise', merge_csr_pairwise), ('merge_csr', merge_csr)]:
+            best = np.inf
+            for _ in range(n_repeats):
+                start = time.perf_counter()
+                merge(matrices, how=how)
+                best = min(best, time.perf_counter() - start)
+            timings[f'{how}_{name}'] = best
+    return timings
+
+
+if __name__ == '__main__':
+    for name, seconds in benchmark().items():
+        print(f'{name:>20}: {seconds:.3f} s')
@@ -12,6 +12,7 @@ from climada.util.api_client import Client
 from climada.hazard import Hazard
 from climada.entity import ImpactFuncSet
 from climada.entity.impact_funcs.storm_europe import ImpfStormEurope
+from nccs.utils.data_catalog import get_api_hazard
 from nccs.utils.s3client import download_from_s3_bucket
 from nccs.utils.folder_naming import get_resources_dir
 from nccs.pipeline.direct.business_interruption import convert_impf_to_sectoral_bi_dry
@@ -32,12 +33,25 @@ WS_SCENARIO_LOOKUP = {
 
 DEFAULT_DATA_DIR = Path(get_resources_dir(), 'hazard', 'stormeurope', 'data')
 
+# The CLIMADA data API query for the observed (ERA5) windstorms
+ERA5_DATA_TYPE = 'storm_europe'
+ERA5_PROPERTIES = {
+    'spatial_coverage': 'Europe',
+    'data_source': 'ERA5',
+}
+
 
-def download_hazard_from_s3(cmip_scenario, country_iso3alpha, scenario, save_dir=DEFAULT_DATA_DIR):
+def get_s3_hazard_file(scenario, country_iso3alpha, save_dir=DEFAULT_DATA_DIR):
+    """The S3 key and local path of the modelled windstorm hazard of a scenario"""
     country_iso3num = str(int(pycountry.countries.get(alpha_3=country_iso3alpha).numeric))
+    cmip_scenario = WS_SCENARIO_LOOKUP[scenario]
     s3_filepath = f'stormeurope_hazard/stormeurope_{cmip_scenario}_{country_iso3num}.hdf5' #replaced old statement
-    outputfile=f'{save_dir}/stormeurope_{scenario}_{country_iso3num}.hdf5'
+    outputfile = f'{save_dir}/stormeurope_{scenario}_{country_iso3num}.hdf5'
+    return s3_filepath, outputfile
+
 
+def download_hazard_from_s3(country_iso3alpha, scenario, save_dir=DEFAULT_DATA_DIR):
+    s3_filepath, outputfile = get_s3_hazard_file(scenario, country_iso3alpha, save_dir)
     download_from_s3_bucket(s3_filepath, outputfile)
 
 
@@ -48,21 +62,14 @@ def get_hazard(scenario, country_iso3alpha, save_dir=DEFAULT_DATA_DIR):
     cmip_scenario = WS_SCENARIO_LOOKUP[scenario]
     filename = f'stormeurope_{cmip_scenario}_{country_iso3num}.hdf5'
     if not os.path.isfile(filename):
-        download_hazard_from_s3(cmip_scenario, country_iso3alpha, scenario, save_dir)
+        download_hazard_from_s3(country_iso3alpha, scenario, save_dir)
         filename = f'{save_dir}/stormeurope_{scenario}_{country_iso3num}.hdf5' #inserted because otherwise file could not be opened
     return Hazard.from_hdf5(filename)
 
 
 # TODO save this pre-calculated on S3
 def get_era5(country_iso3num = None):
-    client = Client()
-    haz = client.get_hazard(
-                'storm_europe',
-                properties={
-                    'spatial_coverage': 'Europe',
-                    'data_source': 'ERA5',
-                }
-            )
+    haz = get_api_hazard(ERA5_DATA_TYPE, ERA5_PROPERTIES)
     haz.centroids.set_lat_lon_to_meta()
     haz = aggregate_windstorm_by_year(haz, is_historical=True)
     if country_iso3num:
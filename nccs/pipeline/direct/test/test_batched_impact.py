@@ -0,0 +1,96 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from climada.entity import Exposures, ImpactFuncSet, ImpfTropCyclone
+from climada.hazard import Centroids, Hazard
+
+from nccs.pipeline.direct import direct
+from nccs.pipeline.direct.direct import get_batchable_sectors, nccs_direct_impacts_batched, \
+    nccs_direct_impacts_simple
+
+COUNTRY = 'Switzerland'
+
+
+def dummy_hazard():
+    lat, lon = np.meshgrid(np.arange(4.), np.arange(3.))
+    rng = np.random.default_rng(3)
+    intensity = sparse.csr_matrix(rng.uniform(20, 80, size=(5, lat.size)) * (rng.random((5, lat.size)) > 0.3))
+    return Hazard(
+        haz_type='TC',
+        units='m/s',
+        centroids=Centroids(lat=lat.ravel(), lon=lon.ravel()),
+        event_id=np.arange(1, 6),
+        event_name=[f'event_{i}' for i in range(5)],
+        date=np.arange(5) + 730000,
+        frequency=np.full(5, 0.2),
+        intensity=intensity,
+        fraction=intensity.copy().astype(bool).astype(float)
+    )
+
+
+def dummy_exposures(seed, impf_ids):
+    rng = np.random.default_rng(seed)
+    n = len(impf_ids)
+    return Exposures(pd.DataFrame({
+        'value': rng.uniform(1, 100, size=n),
+        'latitude': rng.uniform(-0.2, 3.2, size=n),
+        'longitude': rng.uniform(-0.2, 2.2, size=n),
+        'impf_TC': impf_ids
+    }), value_unit='USD')
+
+
+class TestBatchedImpacts(unittest.TestCase):
+
+    def setUp(self):
+        self.haz = dummy_hazard()
+        shared = ImpfTropCyclone.from_emanuel_usa(impf_id=1)
+        steep = ImpfTropCyclone.from_emanuel_usa(impf_id=2, v_half=50)
+        other = ImpfTropCyclone.from_emanuel_usa(impf_id=1, v_half=90)
+        self.impf_sets = {
+            'a': ImpactFuncSet([shared]),
+            'b': ImpactFuncSet([shared, steep]),
+            'c': ImpactFuncSet([other]),
+        }
+        self.exposures = {
+            'a': dummy_exposures(1, [1] * 8),
+            'b': dummy_exposures(2, [1, 2] * 5),
+            'c': dummy_exposures(3, [1] * 6),
+        }
+        self.patches = [
+            mock.patch.object(direct, 'get_sector_exposure',
+                              side_effect=lambda sector, country: self.exposures[sector].copy(deep=True)),
+            mock.patch.object(direct, 'apply_sector_impf_set',
+                              side_effect=lambda haz_type, sector, *args: self.impf_sets[sector]),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def test_only_sectors_sharing_functions_are_batched(self):
+        self.assertEqual(get_batchable_sectors('tropical_cyclone', ['a', 'b', 'c'], COUNTRY), ['a', 'b'])
+        self.assertEqual(get_batchable_sectors('tropical_cyclone', ['a', 'c'], COUNTRY), [])
+
+    def test_batched_impacts_match_per_sector_impacts(self):
+        sectors = ['a', 'b', 'c']
+        batched = nccs_direct_impacts_batched('tropical_cyclone', sectors, COUNTRY, 'None', 'historical',
+                                              haz=self.haz, cache_centroids=False)
+        for sector in sectors:
+            imp = nccs_direct_impacts_simple('tropical_cyclone', sector, COUNTRY, 'None', 'historical',
+                                             haz=self.haz, cache_centroids=False)
+            with self.subTest(sector=sector):
+                np.testing.assert_allclose(batched[sector].imp_mat.toarray(), imp.imp_mat.toarray())
+                np.testing.assert_allclose(batched[sector].at_event, imp.at_event)
+                np.testing.assert_allclose(batched[sector].eai_exp, imp.eai_exp)
+                self.assertAlmostEqual(batched[sector].aai_agg, imp.aai_agg)
+                self.assertAlmostEqual(batched[sector].tot_value, imp.tot_value)
+                np.testing.assert_array_equal(batched[sector].coord_exp, imp.coord_exp)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,13 @@
 import unittest
 import numpy as np
+import pandas as pd
 from copy import deepcopy
 from scipy import sparse
+from climada.entity import Exposures
 
-from nccs.pipeline.direct.calc_yearset import yearset_from_imp
+from nccs.pipeline.direct.calc_yearset import cap_impact, combine_yearsets, get_cap_vector, prune_zero_events, \
+    sampled_impact_matrix, sampling_matrix, set_matrix_dtype, yearset_from_imp
+from nccs.pipeline.direct.sampling_plan import apply_sampling_plan, make_sampling_plan
 from nccs.pipeline.direct.test.create_test_impact import dummy_impact, dummy_impact_yearly
 
 seed = 1312
@@ -12,6 +16,8 @@ np.random.seed(seed)
 class TestYearsets(unittest.TestCase):
 
     def setUp(self):
+        # Some tests sample with the global random state, which seeded yearsets (in CLIMADA) also reseed
+        np.random.seed(seed)
         self.n_sim_years = 10
         self.dummy_imp = dummy_impact()
         self.dummy_imp_yearly = dummy_impact_yearly()
@@ -51,6 +57,79 @@ class TestYearsets(unittest.TestCase):
         # TODO also test capping from an Exposures object
         pass
 
+    def test_pruned_impacts_keep_event_totals(self):
+        """Dropping zero-impact events keeps the event ids and records the full event set"""
+        pruned, totals = prune_zero_events(self.dummy_imp)
+        np.testing.assert_array_equal(pruned.event_id, self.dummy_imp.event_id[1:])
+        self.assertEqual(totals['n_events_total'], 6)
+        self.assertAlmostEqual(totals['frequency_total'], np.sum(self.dummy_imp.frequency))
+        self.assertAlmostEqual(pruned.aai_agg, self.dummy_imp.aai_agg)
+
+    def test_pruned_yearsets_sample_like_the_full_event_set(self):
+        """Years sampled one event per year from a pruned impact have the distribution of the full event set"""
+        pruned, totals = prune_zero_events(self.dummy_imp_yearly)
+        np.random.seed(seed)
+        yimp = yearset_from_imp(self.dummy_imp_yearly, n_sim_years=6000, poisson=False)
+        np.random.seed(seed)
+        yimp_pruned = yearset_from_imp(pruned, n_sim_years=6000, poisson=False, **totals)
+        self.assertAlmostEqual(np.mean(yimp_pruned.at_event == 0), 1 / 6, delta=0.02)
+        self.assertAlmostEqual(np.mean(yimp_pruned.at_event), np.mean(yimp.at_event), delta=2)
+
+    def test_pruned_poisson_yearsets_match_the_full_event_set(self):
+        """Poisson years sampled from a pruned impact through a plan of the full event set are the unpruned years"""
+        pruned, totals = prune_zero_events(self.dummy_imp)
+        # Few enough years that no year has more events than the impact (CLIMADA samples a year's events without
+        # replacement)
+        yimp = yearset_from_imp(self.dummy_imp, n_sim_years=50, poisson=True, seed=seed)
+        plan = make_sampling_plan(self.dummy_imp.frequency, 50, True, seed)
+        samp_vec = apply_sampling_plan(plan, self.dummy_imp.event_id, pruned.event_id)
+        yimp_pruned = yearset_from_imp(pruned, n_sim_years=50, poisson=True, seed=seed, samp_vec=samp_vec, **totals)
+        np.testing.assert_allclose(yimp_pruned.at_event, yimp.at_event)
+        np.testing.assert_allclose(yimp_pruned.imp_mat.toarray(), yimp.imp_mat.toarray())
+        # Without the full event set the pruned impact can't be sampled like the unpruned one
+        with self.assertRaises(ValueError):
+            yearset_from_imp(pruned, n_sim_years=50, poisson=True, seed=seed, **totals)
+
+    def test_float32_yearsets_keep_float64_aggregates(self):
+        """Yearsets of float32 impacts are stored in float32 and aggregated in float64"""
+        imp32 = set_matrix_dtype(deepcopy(self.dummy_imp), 'float32')
+        yimp = yearset_from_imp(imp32, n_sim_years=self.n_sim_years, poisson=True, cap_exposure=100, seed=seed)
+        yimp64 = yearset_from_imp(self.dummy_imp, n_sim_years=self.n_sim_years, poisson=True, cap_exposure=100,
+                                  seed=seed)
+        self.assertEqual(yimp.imp_mat.dtype, np.float32)
+        self.assertEqual(yimp.eai_exp.dtype, np.float64)
+        np.testing.assert_allclose(yimp.at_event, yimp64.at_event, rtol=1e-6)
+
+    def test_sampled_matrix_sums_the_rows_of_each_year(self):
+        """The sparse sampling product matches summing each year's rows, including repeated events and empty years"""
+        imp_mat = sparse.random(20, 50, density=0.2, format='csr', dtype=np.float32, random_state=seed)
+        samp_vec = [np.array([3, 3, 7]), np.array([], dtype=int), np.array([19]), np.array([0, 5, 11, 12])]
+        ymat = sampled_impact_matrix(sampling_matrix(samp_vec, imp_mat.shape[0]), imp_mat)
+        expected = np.vstack([imp_mat[events].sum(0, dtype=np.float64) for events in samp_vec])
+        self.assertEqual(ymat.dtype, np.float32)
+        self.assertTrue(ymat.has_sorted_indices)
+        np.testing.assert_allclose(ymat.toarray(), expected, rtol=1e-6)
+
+    def test_combined_yearsets_only_keep_impacts_occurring_together(self):
+        """Combining a stream of impacts with occur_together keeps only the points where every impact is non-zero"""
+        imp1, imp2 = deepcopy(self.dummy_imp), deepcopy(self.dummy_imp)
+        imp2.imp_mat = sparse.csr_matrix(np.array([[5, 0], [0, 1], [2, 0], [3, 3], [0, 0], [31, 31]]))
+        combined = combine_yearsets((imp for imp in [imp1, imp2]), occur_together=True, cap_exposure=40)
+        expected = np.array([[0, 0], [0, 2], [4, 0], [6, 6], [0, 0], [40, 40]])
+        np.testing.assert_array_equal(combined.imp_mat.toarray(), expected)
+        np.testing.assert_array_equal(combined.at_event, expected.sum(axis=1))
+
+    def test_impacts_are_capped_at_each_points_exposure(self):
+        """Capping with an exposure or its cached cap vector caps each column at its point's value"""
+        exp = Exposures(pd.DataFrame({'value': [2.5, 30.], 'latitude': [1, 1.5], 'longitude': [2, 2.5]}))
+        cap = get_cap_vector(exp)
+        self.assertIs(get_cap_vector(exp), cap)
+        capped = cap_impact(deepcopy(self.dummy_imp), exp)
+        capped_by_vector = cap_impact(deepcopy(self.dummy_imp), cap)
+        expected = np.minimum(self.dummy_imp.imp_mat.toarray(), [2.5, 30.])
+        np.testing.assert_array_equal(capped.imp_mat.toarray(), expected)
+        np.testing.assert_array_equal(capped_by_vector.imp_mat.toarray(), expected)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
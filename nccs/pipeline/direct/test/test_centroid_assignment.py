@@ -0,0 +1,47 @@
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+from climada.entity import Exposures
+
+from nccs.pipeline.direct import direct
+from nccs.pipeline.direct.direct import assign_centroids_cached
+from nccs.pipeline.direct.test.test_batched_impact import dummy_exposures, dummy_hazard
+
+
+class TestCentroidAssignment(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dir_patch = mock.patch.object(direct, 'get_centroid_assignment_dir', return_value=self.tmpdir.name)
+        self.dir_patch.start()
+        self.haz = dummy_hazard()
+
+    def tearDown(self):
+        self.dir_patch.stop()
+        self.tmpdir.cleanup()
+
+    def assert_assigned_like_climada(self, exp):
+        expected = exp.copy(deep=True)
+        expected.assign_centroids(self.haz, overwrite=True)
+        np.testing.assert_array_equal(exp.gdf['centr_TC'], expected.gdf['centr_TC'])
+
+    def test_assignments_are_reused(self):
+        exp = assign_centroids_cached(dummy_exposures(1, [1] * 8), self.haz)
+        self.assert_assigned_like_climada(exp)
+        with mock.patch.object(Exposures, 'assign_centroids') as assign:
+            reused = assign_centroids_cached(dummy_exposures(1, [1] * 8), self.haz)
+        assign.assert_not_called()
+        np.testing.assert_array_equal(reused.gdf['centr_TC'], exp.gdf['centr_TC'])
+
+    def test_moved_points_are_assigned_again(self):
+        """An exposure re-published with the same number of points at other coordinates doesn't reuse the
+        assignment of the old points"""
+        assign_centroids_cached(dummy_exposures(1, [1] * 8), self.haz)
+        moved = assign_centroids_cached(dummy_exposures(2, [1] * 8), self.haz)
+        self.assert_assigned_like_climada(moved)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+
+import numpy as np
+from scipy import sparse
+from climada.engine import Impact
+
+from nccs.pipeline.direct.chunked_impact import get_chunks, stitch_chunk_impacts
+from nccs.pipeline.direct.test.create_test_impact import dummy_impact
+
+
+def select_points(imp, positions):
+    """The impact of some of an impact's exposure points"""
+    imp_mat = imp.imp_mat[:, positions]
+    eai_exp = imp_mat.T.dot(imp.frequency)
+    return Impact(
+        event_id=imp.event_id,
+        event_name=imp.event_name,
+        date=imp.date,
+        frequency=imp.frequency,
+        frequency_unit=imp.frequency_unit,
+        coord_exp=imp.coord_exp[positions],
+        crs=imp.crs,
+        eai_exp=eai_exp,
+        at_event=np.asarray(imp_mat.sum(axis=1)).ravel(),
+        tot_value=0,
+        aai_agg=eai_exp.sum(),
+        unit=imp.unit,
+        imp_mat=imp_mat,
+        haz_type=imp.haz_type
+    )
+
+
+class TestChunkedImpact(unittest.TestCase):
+
+    def test_chunks_are_ordered_by_centroid(self):
+        chunks = get_chunks(np.array([5, 1, 3, 1, 0]), chunk_size=2)
+        np.testing.assert_array_equal(np.concatenate(chunks), [4, 1, 3, 2, 0])
+        self.assertEqual([len(c) for c in chunks], [2, 2, 1])
+
+    def test_stitched_impact_matches_whole_impact(self):
+        imp = dummy_impact()
+        imp.imp_mat = imp.imp_mat.multiply(np.array([1, 2])).tocsr()
+        chunks = [np.array([1]), np.array([0])]
+        stitched = stitch_chunk_impacts(((c, select_points(imp, c)) for c in chunks), n_points=2)
+        np.testing.assert_array_equal(stitched.imp_mat.toarray(), imp.imp_mat.toarray())
+        np.testing.assert_array_equal(stitched.coord_exp, imp.coord_exp)
+        np.testing.assert_allclose(stitched.at_event, np.asarray(imp.imp_mat.sum(axis=1)).ravel())
+        np.testing.assert_allclose(stitched.eai_exp, imp.imp_mat.T.dot(imp.frequency))
+
+    def test_stitched_matrix_is_sorted_csr_whatever_the_chunk_order(self):
+        imp = dummy_impact()
+        rng = np.random.default_rng(0)
+        imp.imp_mat = sparse.random(imp.event_id.size, 7, density=0.5, format='csr', random_state=rng)
+        imp.coord_exp = rng.random((7, 2))
+        chunks = [np.array([6, 2]), np.array([0, 5, 3]), np.array([4, 1])]
+        stitched = stitch_chunk_impacts(((c, select_points(imp, c)) for c in chunks[::-1]), n_points=7)
+        self.assertTrue(stitched.imp_mat.has_sorted_indices)
+        np.testing.assert_array_equal(stitched.imp_mat.toarray(), imp.imp_mat.toarray())
+        np.testing.assert_array_equal(stitched.coord_exp, imp.coord_exp)
+
+
+if __name__ == '__main__':
+    unittest.main()
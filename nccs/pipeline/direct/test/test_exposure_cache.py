@@ -0,0 +1,46 @@
+import unittest
+
+from nccs.pipeline.direct.exposure_cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def setUp(self):
+        self.loads = []
+        self.cache = LRUCache(10, len)
+
+    def load(self, value):
+        def _load():
+            self.loads.append(value)
+            return value
+        return _load
+
+    def test_values_are_loaded_once(self):
+        self.assertEqual(self.cache.get('a', self.load('aaa')), 'aaa')
+        self.assertEqual(self.cache.get('a', self.load('aaa')), 'aaa')
+        self.assertEqual(self.loads, ['aaa'])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.get('a', self.load('aaaa'))
+        self.cache.get('b', self.load('bbbb'))
+        self.cache.get('a', self.load('aaaa'))
+        self.cache.get('c', self.load('cccc'))
+        self.assertIn('a', self.cache)
+        self.assertNotIn('b', self.cache)
+        self.assertEqual(self.cache.total_bytes, 8)
+
+    def test_values_over_budget_are_not_cached(self):
+        self.assertEqual(self.cache.get('a', self.load('a' * 11)), 'a' * 11)
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.total_bytes, 0)
+
+    def test_zero_budget_turns_cache_off(self):
+        cache = LRUCache(lambda: 0, len)
+        cache.get('a', self.load('a'))
+        cache.get('a', self.load('a'))
+        self.assertEqual(self.loads, ['a', 'a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
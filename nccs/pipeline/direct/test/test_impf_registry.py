@@ -0,0 +1,71 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from nccs.pipeline.direct import direct, impf_registry
+from nccs.pipeline.direct.direct import apply_sector_impf_set, build_sector_impf_set
+from nccs.pipeline.direct.impf_registry import build_impf_registry, get_impf_key, get_impf_registry_path, \
+    load_impf_registry, set_impf_registry_path
+
+KEYS = [
+    ('tropical_cyclone', 'manufacturing', 'THA', True, True, True),
+    ('tropical_cyclone', 'mining', 'THA', False, True, True),
+    ('river_flood', 'forestry', 'DEU', True, False, True),
+    ('wildfire', 'energy', 'DEU', False, True, False),
+]
+
+
+class TestImpfRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'impf_registry.pkl')
+        self.old_path = get_impf_registry_path()
+
+    def tearDown(self):
+        set_impf_registry_path(self.old_path)
+        self.tmpdir.cleanup()
+
+    def assert_impf_sets_equal(self, impf_set, expected):
+        self.assertEqual(impf_set.get_hazard_types(), expected.get_hazard_types())
+        for haz_type in expected.get_hazard_types():
+            impfs = impf_set.get_func(haz_type=haz_type)
+            expected_impfs = expected.get_func(haz_type=haz_type)
+            self.assertEqual([impf.id for impf in impfs], [impf.id for impf in expected_impfs])
+            for impf, expected_impf in zip(impfs, expected_impfs):
+                np.testing.assert_array_equal(impf.intensity, expected_impf.intensity)
+                np.testing.assert_array_equal(impf.mdd, expected_impf.mdd)
+                np.testing.assert_array_equal(impf.paa, expected_impf.paa)
+                self.assertEqual(impf.intensity_unit, expected_impf.intensity_unit)
+
+    def test_registry_round_trip_matches_built_sets(self):
+        self.assertEqual(build_impf_registry(KEYS, build_sector_impf_set, self.path), len(KEYS))
+        registry = load_impf_registry(self.path)
+        for args in KEYS:
+            with self.subTest(args=args):
+                self.assert_impf_sets_equal(registry[get_impf_key(*args)], build_sector_impf_set(*args))
+
+    def test_missing_keys_are_built(self):
+        build_impf_registry(KEYS[:1], build_sector_impf_set, self.path)
+        set_impf_registry_path(self.path)
+        with mock.patch.object(direct, 'build_sector_impf_set', wraps=build_sector_impf_set) as build:
+            apply_sector_impf_set(*KEYS[0])
+            build.assert_not_called()
+            impf_set = apply_sector_impf_set(*KEYS[1])
+            build.assert_called_once_with(*KEYS[1])
+        self.assert_impf_sets_equal(impf_set, build_sector_impf_set(*KEYS[1]))
+
+    def test_registry_is_ignored_when_impact_functions_change(self):
+        build_impf_registry(KEYS, build_sector_impf_set, self.path)
+        load_impf_registry.cache_clear()
+        with mock.patch.object(impf_registry, 'get_impf_registry_fingerprint', return_value='changed'):
+            self.assertEqual(load_impf_registry(self.path), {})
+        load_impf_registry.cache_clear()
+        self.assertEqual(len(load_impf_registry(self.path)), len(KEYS))
+
+
+if __name__ == '__main__':
+    unittest.main()
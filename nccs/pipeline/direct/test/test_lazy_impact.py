@@ -0,0 +1,43 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from nccs.pipeline.direct.lazy_impact import LazyImpact
+from nccs.pipeline.direct.test.create_test_impact import dummy_impact
+
+
+class TestLazyImpact(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'impact.hdf5')
+        self.imp = dummy_impact()
+        # As nccs_direct_impacts does before impacts are written
+        self.imp.event_name = [str(e) for e in self.imp.event_name]
+        self.imp.write_hdf5(self.path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_reads_datasets_and_matrix(self):
+        with LazyImpact(self.path) as lazy:
+            self.assertEqual(lazy.n_events, 6)
+            np.testing.assert_array_equal(lazy.event_id, self.imp.event_id)
+            np.testing.assert_array_equal(lazy.frequency, self.imp.frequency)
+            np.testing.assert_array_equal(lazy.imp_mat.toarray(), self.imp.imp_mat.toarray())
+            np.testing.assert_array_equal(lazy.imp_mat[[1, 4]].toarray(), self.imp.imp_mat[[1, 4]].toarray())
+
+    def test_builds_impact(self):
+        with LazyImpact(self.path) as lazy:
+            imp = lazy.to_impact()
+            imp_without_matrix = lazy.to_impact(imp_mat=False)
+        np.testing.assert_array_equal(imp.imp_mat.toarray(), self.imp.imp_mat.toarray())
+        np.testing.assert_array_equal(imp.at_event, self.imp.at_event)
+        self.assertEqual(imp_without_matrix.imp_mat.shape[0], 0)
+        np.testing.assert_array_equal(imp_without_matrix.coord_exp, self.imp.coord_exp)
+
+
+if __name__ == '__main__':
+    unittest.main()
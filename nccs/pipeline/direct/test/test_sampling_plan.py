@@ -0,0 +1,39 @@
+import tempfile
+import unittest
+
+import numpy as np
+
+from nccs.pipeline.direct.sampling_plan import SAMPLING_PLAN_CACHE, apply_sampling_plan, get_sampling_plan
+
+seed = 1312
+
+
+class TestSamplingPlan(unittest.TestCase):
+
+    def setUp(self):
+        SAMPLING_PLAN_CACHE.clear()
+        self.event_id = np.arange(10, 16)
+        self.frequency = np.full(6, 0.5)
+
+    def test_plans_are_stored_and_reused(self):
+        with tempfile.TemporaryDirectory() as plan_dir:
+            plan = get_sampling_plan(self.event_id, self.frequency, 50, True, seed, plan_dir=plan_dir)
+            SAMPLING_PLAN_CACHE.clear()
+            reloaded = get_sampling_plan(self.event_id, self.frequency, 50, True, seed, plan_dir=plan_dir)
+        np.testing.assert_array_equal(plan[0], reloaded[0])
+        np.testing.assert_array_equal(plan[1], reloaded[1])
+        self.assertEqual(len(plan[0]), 51)
+
+    def test_pruned_impacts_keep_the_years_of_their_events(self):
+        plan = (np.array([0, 3, 3, 4, 6]), np.array([0, 2, 2, 5, 1, 3]))
+        samp_vec = apply_sampling_plan(plan, self.event_id, np.array([15, 12, 11]))
+        self.assertEqual([list(year) for year in samp_vec], [[1, 1], [], [0], [2]])
+
+    def test_one_event_per_year_without_poisson(self):
+        indptr, positions = get_sampling_plan(self.event_id, self.frequency, 20, False, seed)
+        np.testing.assert_array_equal(indptr, np.arange(21))
+        self.assertTrue(np.all((positions >= 0) & (positions < 6)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import logging
+import unittest
+
+import numpy as np
+from scipy import sparse
+
+from nccs.pipeline.direct.sparse_merge import benchmark, merge_csr, merge_csr_pairwise
+
+LOGGER = logging.getLogger(__name__)
+
+
+class TestMergeCSR(unittest.TestCase):
+
+    def setUp(self):
+        self.matrices = [
+            sparse.random(20, 30, density=0.3, format='csr', random_state=i) * (1 if i % 2 else -1)
+            for i in range(4)
+        ]
+
+    def test_merge_matches_pairwise_fold(self):
+        for how in ['sum', 'max', 'min']:
+            merged = merge_csr(self.matrices, how=how)
+            expected = merge_csr_pairwise(self.matrices, how=how)
+            np.testing.assert_allclose(merged.toarray(), expected.toarray())
+            self.assertTrue(merged.has_sorted_indices)
+            self.assertTrue(np.all(merged.data != 0))
+
+    def test_counts_ignore_explicit_zeros(self):
+        m1 = sparse.csr_matrix((np.array([1., 0.]), np.array([0, 1]), np.array([0, 2, 2])), shape=(2, 2))
+        m2 = sparse.csr_matrix(np.array([[3., 5.], [4., 0.]]))
+        merged, counts = merge_csr([m1, m2], return_counts=True)
+        np.testing.assert_array_equal(merged.toarray(), [[4., 5.], [4., 0.]])
+        np.testing.assert_array_equal(counts, [2, 1, 1])
+
+    def test_benchmark(self):
+        for n_matrices in [2, 6]:
+            timings = benchmark(n_matrices=n_matrices, n_rows=300, n_cols=20_000, density=0.05, n_repeats=1)
+            for how in ['sum', 'max', 'min']:
+                self.assertGreater(timings[f'{how}_pairwise'], 0)
+                self.assertGreater(timings[f'{how}_merge_csr'], 0)
+            LOGGER.info(f'{n_matrices} matrices: ' + ', '.join(f'{k} {v:.3f} s' for k, v in timings.items()))
+
+    def test_shapes_must_match(self):
+        with self.assertRaises(ValueError):
+            merge_csr([sparse.csr_matrix((2, 2)), sparse.csr_matrix((2, 3))])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,12 @@
+import copy
+from functools import cache
+
 import numpy as np
 import pandas as pd
 import pycountry
 from climada_petals.engine import SupplyChain
 from exposures.utils import root_dir
+from nccs.utils.atomic_files import atomic_path
 
 
 # original
@@ -132,9 +136,25 @@ def get_secs_shock(supchain: SupplyChain, country_iso3alpha, impacted_secs, n_to
 
 
 def get_supply_chain() -> SupplyChain:
+    """Return a fresh SupplyChain for the WIOD16 MRIO table.
+
+    The table is loaded once per process and copied for each call, since the
+    calculations store their results on the SupplyChain object.
+    """
+    return copy.deepcopy(_load_supply_chain())
+
+
+@cache
+def _load_supply_chain() -> SupplyChain:
     return SupplyChain.from_mriot(mriot_type='WIOD16', mriot_year=2011)
 
 
+def init_supply_chain_worker():
+    """Initializer for worker processes: load the MRIO table once, when the
+    worker starts, so that it is kept for the worker's lifetime."""
+    _ = _load_supply_chain()
+
+
 def supply_chain_climada(exposure, direct_impact, io_approach, impacted_sector="service", shock_factor=None):
     assert impacted_sector in SUPER_SEC.keys(), f"impacted_sector must be one of {SUPER_SEC.keys()}"
     sec_range = SUPER_SEC[impacted_sector]
@@ -233,7 +253,7 @@ def dump_direct_to_csv(supchain,
            f"_{country_iso3alpha}" \
            f".csv"
 
-    df_direct.to_csv(path)
+    write_csv_atomically(df_direct, path)
     # TODO write to s3 as well
     return path
 
@@ -302,6 +322,13 @@ def dump_supchain_to_csv(supchain,
            f"_{io_approach}" \
            f"_{country_iso3alpha}" \
            f".csv"
-    df_indirect.to_csv(path)
+    write_csv_atomically(df_indirect, path)
     # TODO write to s3 as well
     return path
+
+
+def write_csv_atomically(df, path):
+    """Write a dataframe to csv so that the file at path is either absent or
+    complete, even if the process is killed or several processes write it."""
+    with atomic_path(path) as tmp_path:
+        df.to_csv(tmp_path)
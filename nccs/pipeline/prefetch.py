@@ -0,0 +1,196 @@
+"""
+Download the input files of a run in the background.
+
+Hazard and exposure files are downloaded from the S3 bucket by the task that
+first needs them, one file at a time, while the task's worker waits. The
+prefetcher takes the list of files a run plan needs, drops duplicates and
+files already on disk, and downloads the rest with a small pool of threads
+while the first tasks are calculated. Downloads follow the order of the list,
+so the inputs of the tasks that run first arrive first.
+
+Files are downloaded to a temporary name and renamed when complete, so a task
+never reads a partial file. A task that needs a file before it has been
+prefetched downloads it itself, as before.
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from nccs.utils.atomic_files import atomic_path
+from nccs.utils.s3client import BUCKET_NAME, get_client
+
+LOGGER = logging.getLogger(__name__)
+
+
+class BandwidthLimiter:
+    """A token bucket limiting the bytes per second shared by all download
+    threads. Threads that go over the limit sleep until they are back under
+    it."""
+
+    def __init__(self, max_bytes_per_s, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(max_bytes_per_s)
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self.rate
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes):
+        with self._lock:
+            now = self._clock()
+            # Allow bursts of up to one second's worth of bytes
+            self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= nbytes
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+        if delay > 0:
+            self._sleep(delay)
+
+
+class PrefetchProgress:
+    """Counts of the files and bytes a prefetcher has handled, updated by its
+    threads"""
+
+    def __init__(self, n_files):
+        self.n_files = n_files
+        self.n_downloaded = 0
+        self.n_skipped = 0
+        self.n_failed = 0
+        self.bytes_downloaded = 0
+        self._lock = threading.Lock()
+
+    def add(self, n_downloaded=0, n_skipped=0, n_failed=0, nbytes=0):
+        with self._lock:
+            self.n_downloaded += n_downloaded
+            self.n_skipped += n_skipped
+            self.n_failed += n_failed
+            self.bytes_downloaded += nbytes
+
+    @property
+    def n_done(self):
+        return self.n_downloaded + self.n_skipped + self.n_failed
+
+    def summary(self):
+        return {
+            'n_files': self.n_files,
+            'n_downloaded': self.n_downloaded,
+            'n_skipped': self.n_skipped,
+            'n_failed': self.n_failed,
+            'bytes_downloaded': self.bytes_downloaded,
+        }
+
+    def __str__(self):
+        return (
+            f'{self.n_done}/{self.n_files} files ({self.n_downloaded} downloaded, {self.n_skipped} already present, '
+            f'{self.n_failed} failed), {self.bytes_downloaded / 1024 ** 2:.1f} MB'
+        )
+
+
+class Prefetcher:
+    """Downloads a list of files from the S3 bucket in background threads.
+
+    Parameters
+    ----------
+    files : iterable of (str, str)
+        The S3 key and local path of each file, in the order to download them
+    max_workers : int
+        Number of files downloaded at the same time
+    max_mb_per_s : float, optional
+        Limit on the combined download speed in MB per second. No limit if not
+        given.
+    client : optional
+        The boto3 S3 client, or an object with the same download_file method.
+        By default one is created with nccs.utils.s3client.get_client when the
+        first file needs downloading.
+    bucket : str
+    log_every_s : float
+        How often to log the progress
+
+    Examples
+    --------
+        >>> prefetcher = Prefetcher(files, max_workers=4, max_mb_per_s=50).start()
+        >>> ...  # calculate impacts
+        >>> prefetcher.wait()
+    """
+
+    def __init__(self, files, max_workers=4, max_mb_per_s=None, client=None, bucket=BUCKET_NAME, log_every_s=30):
+        self.files = list(dict.fromkeys((key, os.fspath(path)) for key, path in files))
+        self.max_workers = max(1, int(max_workers))
+        self.limiter = BandwidthLimiter(max_mb_per_s * 1024 ** 2) if max_mb_per_s else None
+        self.bucket = bucket
+        self.progress = PrefetchProgress(len(self.files))
+        self.log_every_s = log_every_s
+        self._client = client
+        self._client_lock = threading.Lock()
+        self._last_log = 0
+        self._executor = None
+        self._futures = []
+
+    def start(self):
+        """Start downloading in the background. Returns the prefetcher."""
+        if self._executor is not None:
+            return self
+        self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='prefetch')
+        self._futures = [self._executor.submit(self._fetch, key, path) for key, path in self.files]
+        LOGGER.info(f'Prefetching {len(self.files)} input files with {self.max_workers} threads')
+        return self
+
+    def wait(self, timeout=None):
+        """Wait for the downloads to finish, or for timeout seconds, and
+        return the progress"""
+        wait(self._futures, timeout=timeout)
+        if self.done:
+            self._executor.shutdown(wait=False)
+            LOGGER.info(f'Prefetched {self.progress}')
+        return self.progress
+
+    def cancel(self):
+        """Drop the downloads that haven't started. Those running finish."""
+        for future in self._futures:
+            future.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    @property
+    def done(self):
+        return all(future.done() for future in self._futures)
+
+    def _get_client(self):
+        with self._client_lock:
+            if self._client is None:
+                # boto3 clients can be shared between threads
+                self._client = get_client()
+            return self._client
+
+    def _fetch(self, key, path):
+        if os.path.exists(path):
+            self.progress.add(n_skipped=1)
+            return
+        dirname = os.path.dirname(path)
+        if dirname != '':
+            os.makedirs(dirname, exist_ok=True)
+        nbytes = [0]
+
+        def callback(n):
+            nbytes[0] += n
+            if self.limiter is not None:
+                self.limiter.consume(n)
+
+        try:
+            with atomic_path(path) as tmp_path:
+                self._get_client().download_file(self.bucket, key, tmp_path, Callback=callback)
+        except Exception:
+            LOGGER.warning(f'Could not prefetch {key}. The task that needs it will download it', exc_info=True)
+            self.progress.add(n_failed=1, nbytes=nbytes[0])
+        else:
+            self.progress.add(n_downloaded=1, nbytes=nbytes[0])
+        self._log_progress()
+
+    def _log_progress(self):
+        now = time.monotonic()
+        if now - self._last_log >= self.log_every_s:
+            self._last_log = now
+            LOGGER.info(f'Prefetched {self.progress}')
@@ -0,0 +1,495 @@
+"""
+A crash-safe journal of the tasks in a run, kept in SQLite.
+
+Each task (one direct impact, yearset or supply chain calculation) has a row
+with its state, timings and output path. Every state change is its own
+transaction, so a run that is killed leaves a journal that says exactly what
+had finished, and a restarted run carries on from there. Tasks are claimed
+atomically, so several processes can work from one journal without running
+the same task twice.
+
+The journal also works as a task queue for workers on several machines
+sharing a filesystem (see nccs.pipeline.worker). SQLite's write-ahead log
+keeps its index in shared memory, which only works between processes on one
+host, so a journal shared between machines uses the rollback journal
+instead. Queued tasks carry the name
+of the function to run and its JSON-encoded arguments, and can depend on
+other tasks. Workers hold a lease on each task they claim and renew it with
+heartbeats. A task whose lease runs out, e.g. because its worker's machine
+went down, is handed to the next worker that asks.
+"""
+
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+
+import numpy as np
+
+from nccs.pipeline.scheduler import DONE, FAILED, SKIPPED
+
+LOGGER = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    task_id TEXT PRIMARY KEY,
+    stage TEXT NOT NULL,
+    output_path TEXT,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    started REAL,
+    finished REAL,
+    duration REAL,
+    output_exists INTEGER,
+    error TEXT,
+    func TEXT,
+    args TEXT,
+    priority REAL NOT NULL DEFAULT 0,
+    lease_expires REAL
+);
+CREATE INDEX IF NOT EXISTS tasks_stage_state ON tasks (stage, state);
+CREATE TABLE IF NOT EXISTS task_deps (
+    task_id TEXT NOT NULL,
+    dep_id TEXT NOT NULL,
+    PRIMARY KEY (task_id, dep_id)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Columns added since the first version of the journal, added to older journals when they're opened
+_ADDED_COLUMNS = {
+    'func': 'TEXT',
+    'args': 'TEXT',
+    'priority': 'REAL NOT NULL DEFAULT 0',
+    'lease_expires': 'REAL',
+}
+
+# A task is blocked while any of the tasks it depends on isn't done
+_BLOCKED = """EXISTS (
+    SELECT 1 FROM task_deps d JOIN tasks t ON t.task_id = d.dep_id
+    WHERE d.task_id = tasks.task_id AND t.state IN ({states})
+)"""
+
+
+def get_task_id(stage, output_path):
+    """Identify a task by its stage and the file it writes"""
+    return f'{stage}:{os.fspath(output_path)}'
+
+
+def get_worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def get_func_name(func):
+    """The 'module:function' name a worker uses to import a queued task's
+    function"""
+    if isinstance(func, str):
+        return func
+    if func.__module__ == '__main__':
+        raise ValueError(f'Queued functions must be importable by workers: {func.__qualname__} is in __main__')
+    return f'{func.__module__}:{func.__qualname__}'
+
+
+def _json_default(o):
+    # Rows of analysis dataframes hold numpy scalars and paths
+    if isinstance(o, np.generic):
+        return o.item()
+    if isinstance(o, os.PathLike):
+        return os.fspath(o)
+    raise TypeError(f'Object of type {type(o).__name__} can not be passed to a queued task')
+
+
+class RunJournal:
+    """Task states for a run, stored in an SQLite database at path.
+
+    The journal can be passed to worker processes: each process opens its own
+    connection the first time it uses it.
+
+    Parameters
+    ----------
+    path : str or os.PathLike
+    shared : bool
+        The journal is used by processes on several machines over a network
+        filesystem. Every process opening it must set this. Local journals use
+        SQLite's faster write-ahead log, which doesn't work across machines.
+
+    Examples
+    --------
+        >>> journal = RunJournal('run_journal.sqlite')
+        >>> journal.add_tasks([(get_task_id('direct', path), 'direct', path)])
+        >>> journal.run(get_task_id('direct', path), calculate_direct_impact, calc, config)
+        >>> journal.get_states('direct')
+    """
+
+    def __init__(self, path, shared=False):
+        self.path = os.fspath(path)
+        self.shared = shared
+        self._conn = None
+        self._pid = None
+        dirname = os.path.dirname(self.path)
+        if dirname != '':
+            os.makedirs(dirname, exist_ok=True)
+        self.conn.executescript(_SCHEMA)
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(tasks)')}
+        for column, column_type in _ADDED_COLUMNS.items():
+            if column not in columns:
+                self.conn.execute(f'ALTER TABLE tasks ADD COLUMN {column} {column_type}')
+
+    def __getstate__(self):
+        return {'path': self.path, 'shared': self.shared}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self.shared = state.get('shared', False)
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self):
+        # Connections can't be shared between processes, so open one per process
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            if self.shared:
+                # Every transaction goes through the database file and its locks, which a network filesystem shares
+                self._conn.execute('PRAGMA journal_mode=DELETE')
+                self._conn.execute('PRAGMA synchronous=FULL')
+            else:
+                self._conn.execute('PRAGMA journal_mode=WAL')
+                self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._pid = os.getpid()
+        return self._conn
+
+    def _transaction(self):
+        return _Transaction(self.conn)
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+    def add_tasks(self, tasks):
+        """Register tasks as pending. Tasks already in the journal keep their
+        state.
+
+        Parameters
+        ----------
+        tasks : iterable of tuple
+            (task_id, stage, output_path) for each task
+        """
+        with self._transaction() as conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO tasks (task_id, stage, output_path) VALUES (?, ?, ?)',
+                [(task_id, stage, None if path is None else os.fspath(path)) for task_id, stage, path in tasks]
+            )
+
+    def enqueue(self, tasks):
+        """Queue tasks for workers. Queued tasks are set to pending (unless a
+        worker is running them) whatever their previous state: the caller
+        decides what needs calculating.
+
+        Parameters
+        ----------
+        tasks : iterable of dict
+            Each with keys task_id, stage and func (a module-level function or
+            its 'module:function' name) and optionally output_path, args (a
+            list), kwargs (a dict), deps (ids of tasks that must be done
+            first) and priority (higher priority tasks are claimed first).
+            Arguments must be JSON serialisable.
+        """
+        rows, deps = [], []
+        for task in tasks:
+            output_path = task.get('output_path')
+            payload = json.dumps({'args': list(task.get('args', [])), 'kwargs': task.get('kwargs', {})},
+                                 default=_json_default)
+            rows.append((
+                task['task_id'], task['stage'], None if output_path is None else os.fspath(output_path),
+                get_func_name(task['func']), payload, float(task.get('priority', 0))
+            ))
+            deps.extend((task['task_id'], dep_id) for dep_id in task.get('deps', []))
+        with self._transaction() as conn:
+            conn.executemany(
+                'INSERT INTO tasks (task_id, stage, output_path, func, args, priority) VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (task_id) DO UPDATE SET func = excluded.func, args = excluded.args, '
+                'priority = excluded.priority, output_path = COALESCE(excluded.output_path, tasks.output_path), '
+                f"state = '{PENDING}', worker = NULL, lease_expires = NULL, error = NULL "
+                f"WHERE tasks.state != '{RUNNING}'",
+                rows
+            )
+            conn.executemany('INSERT OR IGNORE INTO task_deps (task_id, dep_id) VALUES (?, ?)', deps)
+
+    def reset_running(self):
+        """Return tasks left running by a run that was killed to pending.
+
+        Returns
+        -------
+        int
+            Number of tasks reset
+        """
+        with self._transaction() as conn:
+            return conn.execute(
+                'UPDATE tasks SET state = ?, worker = NULL WHERE state = ?', (PENDING, RUNNING)
+            ).rowcount
+
+    def claim(self, task_id, worker=None, force=False):
+        """Atomically mark a task as running if it is pending or failed (or
+        done, with force). Tasks not in the journal are added, with the stage
+        and output path read from a task id made by get_task_id.
+
+        Returns
+        -------
+        bool
+            Whether this caller claimed the task
+        """
+        claimable = (PENDING, FAILED, DONE) if force else (PENDING, FAILED)
+        stage, _, output_path = task_id.partition(':')
+        with self._transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO tasks (task_id, stage, output_path) VALUES (?, ?, ?)',
+                         (task_id, stage, output_path or None))
+            n = conn.execute(
+                f'UPDATE tasks SET state = ?, worker = ?, attempts = attempts + 1, started = ?, finished = NULL, '
+                f'duration = NULL, error = NULL WHERE task_id = ? AND state IN ({",".join("?" * len(claimable))})',
+                (RUNNING, worker or get_worker_name(), time.time(), task_id, *claimable)
+            ).rowcount
+        return n == 1
+
+    def claim_next(self, stage=None, worker=None, lease_seconds=None, queued=False, max_attempts=None):
+        """Atomically claim the next task that is ready to run: pending, or
+        running with an expired lease, and not waiting on any dependencies.
+        Tasks whose dependencies failed or were skipped are marked skipped.
+
+        Parameters
+        ----------
+        stage : str, optional
+            Only claim tasks of this stage
+        worker : str, optional
+            Name of the claiming worker. Defaults to host:pid
+        lease_seconds : float, optional
+            Hold the task for this long. The worker must renew the lease with
+            heartbeat() before it runs out or the task can be claimed by
+            another worker. If not given the lease never runs out.
+        queued : bool
+            Only claim tasks that were queued with a function to run
+        max_attempts : int, optional
+            Tasks whose lease has run out this many times are marked failed
+            instead of being claimed again
+
+        Returns
+        -------
+        str or None
+            The claimed task id, or None if no task is ready
+        """
+        now = time.time()
+        conditions, params = [], []
+        if stage is not None:
+            conditions.append('stage = ?')
+            params.append(stage)
+        if queued:
+            conditions.append('func IS NOT NULL')
+        with self._transaction() as conn:
+            self._skip_blocked(conn, now)
+            if max_attempts is not None:
+                conn.execute(
+                    'UPDATE tasks SET state = ?, finished = ?, error = ? '
+                    'WHERE state = ? AND lease_expires < ? AND attempts >= ?',
+                    (FAILED, now, 'Lease expired too many times', RUNNING, now, max_attempts)
+                )
+            row = conn.execute(
+                'SELECT task_id FROM tasks '
+                'WHERE (state = ? OR (state = ? AND lease_expires < ?)) '
+                f'AND NOT {_BLOCKED.format(states=",".join("?" * 4))} '
+                + ''.join(f'AND {c} ' for c in conditions) +
+                'ORDER BY priority DESC, rowid LIMIT 1',
+                (PENDING, RUNNING, now, PENDING, RUNNING, FAILED, SKIPPED, *params)
+            ).fetchone()
+            if row is None:
+                return None
+            if self.get_task(row[0])['state'] == RUNNING:
+                LOGGER.warning(f'The lease on task {row[0]} expired. Reclaiming it')
+            conn.execute(
+                'UPDATE tasks SET state = ?, worker = ?, attempts = attempts + 1, started = ?, lease_expires = ? '
+                'WHERE task_id = ?',
+                (RUNNING, worker or get_worker_name(), now, None if lease_seconds is None else now + lease_seconds,
+                 row[0])
+            )
+        return row[0]
+
+    @staticmethod
+    def _skip_blocked(conn, now):
+        # Skipping a task can block the tasks that depend on it, so repeat until nothing changes
+        while conn.execute(
+                f'UPDATE tasks SET state = ?, finished = ? WHERE state = ? '
+                f'AND {_BLOCKED.format(states="?, ?")}',
+                (SKIPPED, now, PENDING, FAILED, SKIPPED)
+        ).rowcount > 0:
+            pass
+
+    def heartbeat(self, task_id, worker, lease_seconds):
+        """Renew a worker's lease on a running task.
+
+        Returns
+        -------
+        bool
+            False if the worker no longer holds the task, e.g. because its
+            lease ran out and another worker claimed it
+        """
+        with self._transaction() as conn:
+            return conn.execute(
+                'UPDATE tasks SET lease_expires = ? WHERE task_id = ? AND worker = ? AND state = ?',
+                (time.time() + lease_seconds, task_id, worker, RUNNING)
+            ).rowcount == 1
+
+    def n_unfinished(self, queued=True):
+        """Number of pending and running tasks, by default only counting those
+        queued for workers"""
+        query = 'SELECT COUNT(*) FROM tasks WHERE state IN (?, ?)'
+        if queued:
+            query += ' AND func IS NOT NULL'
+        with self._transaction() as conn:
+            # Resolve skipped tasks first so that tasks that can never run aren't counted
+            self._skip_blocked(conn, time.time())
+            return conn.execute(query, (PENDING, RUNNING)).fetchone()[0]
+
+    def set_meta(self, key, value):
+        with self._transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def get_meta(self, key, default=None):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def mark_done(self, task_id, worker=None):
+        """Record that a task finished, and whether its output file exists.
+
+        Parameters
+        ----------
+        task_id : str
+        worker : str, optional
+            The worker that ran the task. If given, the task is only updated if
+            that worker still holds it.
+
+        Returns
+        -------
+        bool
+            False if the worker lost the task to another worker, whose
+            state is left alone
+        """
+        output_path = self.get_task(task_id)['output_path']
+        output_exists = output_path is not None and os.path.exists(output_path)
+        now = time.time()
+        return self._finish(task_id, worker, 'output_exists = ?', (DONE, now, now, int(output_exists)))
+
+    def mark_failed(self, task_id, error=None, worker=None, retry=False):
+        """Record that a task failed. If retry is set it goes back to pending,
+        to be claimed again. See mark_done for worker and the return value."""
+        now = time.time()
+        return self._finish(
+            task_id, worker, 'error = ?', (PENDING if retry else FAILED, now, now, None if error is None else repr(error))
+        )
+
+    def _finish(self, task_id, worker, column, params):
+        query = (
+            f'UPDATE tasks SET state = ?, finished = ?, duration = ? - started, {column}, lease_expires = NULL '
+            'WHERE task_id = ?'
+        )
+        params = (*params, task_id)
+        if worker is not None:
+            query += ' AND worker = ? AND state = ?'
+            params += (worker, RUNNING)
+        with self._transaction() as conn:
+            return conn.execute(query, params).rowcount == 1
+
+    def run(self, task_id, func, *args, force=False, **kwargs):
+        """Claim a task, run func(*args, **kwargs) and record the outcome.
+        Exceptions are recorded and re-raised. If the task can't be claimed
+        (it's done or another process is running it) func isn't called.
+
+        Returns
+        -------
+        The result of func, or None if the task wasn't claimed
+        """
+        if not self.claim(task_id, force=force):
+            LOGGER.info(f'Task {task_id} is already done or running elsewhere. Skipping')
+            return None
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self.mark_failed(task_id, e)
+            raise
+        self.mark_done(task_id)
+        return result
+
+    def get_task(self, task_id):
+        cursor = self.conn.execute('SELECT * FROM tasks WHERE task_id = ?', (task_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([c[0] for c in cursor.description], row))
+
+    def get_states(self, stage=None):
+        """The state of each task, optionally of one stage, as a dict"""
+        if stage is None:
+            rows = self.conn.execute('SELECT task_id, state FROM tasks').fetchall()
+        else:
+            rows = self.conn.execute('SELECT task_id, state FROM tasks WHERE stage = ?', (stage,)).fetchall()
+        return dict(rows)
+
+    def get_interrupted(self, stage=None):
+        """The ids of tasks that were started but didn't finish: left running
+        by a run that was killed, or failed. Their output files, if any, may
+        be incomplete."""
+        query = 'SELECT task_id FROM tasks WHERE attempts > 0 AND state != ?'
+        params = (DONE,)
+        if stage is not None:
+            query += ' AND stage = ?'
+            params += (stage,)
+        return {row[0] for row in self.conn.execute(query, params)}
+
+    def is_interrupted(self, task_id):
+        """Whether a task is among get_interrupted()"""
+        task = self.get_task(task_id)
+        return task is not None and task['attempts'] > 0 and task['state'] != DONE
+
+    def get_done_with_output(self, stage=None):
+        """The ids of tasks that are done and wrote their output file"""
+        query = 'SELECT task_id FROM tasks WHERE state = ? AND output_exists = 1'
+        params = (DONE,)
+        if stage is not None:
+            query += ' AND stage = ?'
+            params += (stage,)
+        return {row[0] for row in self.conn.execute(query, params)}
+
+    def summary(self):
+        """Number of tasks in each stage and state, as a dict of dicts"""
+        out = {}
+        for stage, state, n in self.conn.execute('SELECT stage, state, COUNT(*) FROM tasks GROUP BY stage, state'):
+            out.setdefault(stage, {})[state] = n
+        return out
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT, rolling back on errors. Taking the write
+    lock at the start means no other process can claim the same task between
+    our read and our write."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute('COMMIT')
+        else:
+            self.conn.execute('ROLLBACK')
+        return False
@@ -0,0 +1,123 @@
+"""
+Compile a run configuration into a dataframe of analyses (the run plan).
+
+The plan is built column by column rather than row by row so that the full
+configurations (hundreds of countries, all sectors, several scenarios and
+hazards) compile in well under a second.
+"""
+
+import logging
+import os
+import typing
+from functools import cache
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pycountry
+
+LOGGER = logging.getLogger(__name__)
+
+CROP_TYPES = ["whe", "mai", "ric", "soy"]
+
+
+def config_to_dataframe(
+        config: dict,
+        direct_output_dir: typing.Union[str, os.PathLike],
+        indirect_output_dir: typing.Union[str, os.PathLike]):
+    """Convert a run config to a dataframe of required model runs.
+    Note: these don't include model runs that combine hazards, sectors and
+    countries, which are created after this first set is run.
+
+    Parameters
+    ----------
+    config : dict
+        A config object. See run_configurations/ for the format
+    direct_output_dir : str or os.PathLike
+        Location to save direct impact modelling outputs
+    indirect_output_dir : str or os.PathLike
+        Location to save supply chain impact modelling outputs
+
+    Returns
+    -------
+    pandas.DataFrame
+        A dataframe with one row for each simulation that will be run in the
+        supply chain modelling, and the parameters required to run the
+        simulations. hazard, sector and country are categorical,
+        country_iso3alpha holds the ISO3 code of each country, and
+        direct_impact_path and yearset_path the output locations as strings.
+    """
+    frames = [_run_to_dataframe(run) for run in config['runs']]
+    frames = [df for df in frames if df.shape[0] > 0]
+    if len(frames) == 0:
+        return pd.DataFrame(columns=[
+            'hazard', 'sector', 'country', 'scenario', 'i_scenario', 'ref_year', 'country_iso3alpha',
+            'direct_impact_path', 'yearset_path'
+        ])
+    df = pd.concat(frames, ignore_index=True)
+
+    # unfold the agriculture sector into the different crop types, dropping the original agriculture rows
+    is_crop = (df['hazard'] == 'relative_crop_yield').values
+    if is_crop.any():
+        df_crop = df[is_crop]
+        df_crop_types = [
+            df_crop.assign(hazard=f'relative_crop_yield_{crop_type}', sector=df_crop['sector'] + f'_{crop_type}')
+            for crop_type in CROP_TYPES
+        ]
+        df = pd.concat([df[~is_crop]] + df_crop_types, ignore_index=True)
+
+    for col in ['hazard', 'sector', 'country']:
+        df[col] = df[col].astype('category')
+
+    iso3_lookup = {country: _country_iso3alpha(country) for country in df['country'].cat.categories}
+    df['country_iso3alpha'] = df['country'].map(iso3_lookup).astype('category')
+
+    # Output paths follow folder_naming.get_direct_namestring (note: with the country name rather than its ISO3
+    # code). They're concatenated a column at a time: sector names are shortened once per category.
+    sector_short = np.array(
+        [sector.replace(' ', '_')[:15] for sector in df['sector'].cat.categories], dtype=object
+    )[df['sector'].cat.codes]
+    stems = _as_str_array(df['hazard']) + '_' + sector_short + '_' + _as_str_array(df['scenario']) + \
+        '_' + _as_str_array(df['ref_year']) + '_' + _as_str_array(df['country']) + '.hdf5'
+    df['direct_impact_path'] = str(Path(direct_output_dir, "impact_raw")) + os.sep + 'impact_raw_' + stems
+    df['yearset_path'] = str(Path(direct_output_dir, "yearsets")) + os.sep + 'yearset_' + stems
+
+    return df
+
+
+def _run_to_dataframe(run):
+    """Expand one run of a config into rows ordered by scenario, then country,
+    then sector."""
+    scenario_years = run['scenario_years']
+    countries = np.array(run['countries'], dtype=object)
+    sectors = np.array(run['sectors'], dtype=object)
+    n_scenarios, n_countries, n_sectors = len(scenario_years), len(countries), len(sectors)
+    n_per_scenario = n_countries * n_sectors
+
+    # Reference years mix strings ('historical') and integers so they're kept as objects
+    scenarios = np.array([s['scenario'] for s in scenario_years], dtype=object)
+    ref_years = np.array([s['ref_year'] for s in scenario_years], dtype=object)
+
+    return pd.DataFrame({
+        'hazard': np.full(n_scenarios * n_per_scenario, run['hazard'], dtype=object),
+        'sector': np.tile(sectors, n_scenarios * n_countries),
+        'country': np.tile(np.repeat(countries, n_sectors), n_scenarios),
+        'scenario': np.repeat(scenarios, n_per_scenario),
+        'i_scenario': np.repeat(np.arange(n_scenarios), n_per_scenario),
+        'ref_year': np.repeat(ref_years, n_per_scenario),
+    })
+
+
+def _as_str_array(series):
+    return series.astype(str).to_numpy(dtype=object)
+
+
+@cache
+def _country_iso3alpha(country):
+    # Country names can be checked here: https://github.com/flyingcircusio/pycountry/blob/main/src/pycountry
+    # /databases/iso3166-1.json
+    result = pycountry.countries.get(name=country)
+    if result is None:
+        LOGGER.warning(f'Could not find an ISO3 code for the country {country}')
+        return None
+    return result.alpha_3
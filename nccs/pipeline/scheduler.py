@@ -0,0 +1,163 @@
+"""
+A small dependency-graph executor for the pipeline.
+
+Tasks are added with the names of the tasks they depend on. A task is started
+as soon as all of its dependencies have finished, so that e.g. a yearset can
+be generated as soon as its direct impact exists rather than waiting for all
+direct impacts in the run.
+"""
+
+import heapq
+import itertools
+import logging
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+LOGGER = logging.getLogger(__name__)
+
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+class TaskGraph:
+    """A set of named tasks and the dependencies between them.
+
+    Examples
+    --------
+        >>> graph = TaskGraph()
+        >>> graph.add_task('direct/0', calculate_direct_impact, row, config)
+        >>> graph.add_task('yearset/0', calculate_yearset, row, config, deps=['direct/0'])
+        >>> states = graph.run(ncpus=4)
+    """
+
+    def __init__(self):
+        self.tasks = {}
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __contains__(self, name):
+        return name in self.tasks
+
+    def add_task(self, name, func, *args, deps=(), allow_failed_deps=False, priority=0, **kwargs):
+        """Add a task to the graph.
+
+        Parameters
+        ----------
+        name : str
+            Unique name of the task
+        func : callable
+            A picklable (module-level) function, called as func(*args, **kwargs).
+            The task fails if it raises or returns False.
+        deps : iterable of str
+            Names of the tasks that must finish before this one starts. Names
+            that aren't in the graph when it is run are ignored: they're
+            assumed to have been completed in an earlier run.
+        allow_failed_deps : bool
+            If False (default) the task is skipped when any of its dependencies
+            fail or are skipped. If True it runs regardless, e.g. for tasks that
+            combine whichever inputs are available.
+        priority : float
+            Among tasks that are ready to run, those with the highest priority
+            are started first.
+        """
+        if name in self.tasks:
+            raise ValueError(f'A task named {name} is already in the graph')
+        self.tasks[name] = {
+            'func': func,
+            'args': args,
+            'kwargs': kwargs,
+            'deps': list(deps),
+            'allow_failed_deps': allow_failed_deps,
+            'priority': priority,
+        }
+
+    def run(self, ncpus=1):
+        """Run all tasks, each as soon as its dependencies have finished.
+
+        Parameters
+        ----------
+        ncpus : int
+            Number of worker processes. With 1 the tasks run in this process.
+
+        Returns
+        -------
+        dict
+            The final state of each task: 'done', 'failed' or 'skipped'
+        """
+        deps = {name: [d for d in task['deps'] if d in self.tasks] for name, task in self.tasks.items()}
+        dependents = {name: [] for name in self.tasks}
+        for name, task_deps in deps.items():
+            for d in task_deps:
+                dependents[d].append(name)
+        n_waiting = {name: len(task_deps) for name, task_deps in deps.items()}
+
+        states = {}
+        ready = []
+        counter = itertools.count()  # Keeps the heap FIFO among tasks of equal priority
+
+        def push(name):
+            heapq.heappush(ready, (-self.tasks[name]['priority'], next(counter), name))
+
+        def finish(name, state):
+            # Record a task's final state and release (or skip) the tasks waiting on it
+            to_finish = [(name, state)]
+            while to_finish:
+                name, state = to_finish.pop()
+                states[name] = state
+                for dependent in dependents[name]:
+                    n_waiting[dependent] -= 1
+                    if n_waiting[dependent] > 0:
+                        continue
+                    all_done = all(states[d] == DONE for d in deps[dependent])
+                    if all_done or self.tasks[dependent]['allow_failed_deps']:
+                        push(dependent)
+                    else:
+                        LOGGER.info(f'Skipping {dependent}: one or more of its dependencies did not complete')
+                        to_finish.append((dependent, SKIPPED))
+
+        for name, n in n_waiting.items():
+            if n == 0:
+                push(name)
+
+        if ncpus <= 1:
+            while ready:
+                _, _, name = heapq.heappop(ready)
+                finish(name, _run_task(name, self.tasks[name]))
+        else:
+            with ProcessPoolExecutor(ncpus) as pool:
+                running = {}
+                while ready or running:
+                    # Only hand the pool as many tasks as it has workers so that priorities are respected
+                    while ready and len(running) < ncpus:
+                        _, _, name = heapq.heappop(ready)
+                        task = self.tasks[name]
+                        running[pool.submit(_run_task, name, task)] = name
+                    completed, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in completed:
+                        name = running.pop(future)
+                        try:
+                            state = future.result()
+                        except Exception:
+                            # The worker itself died, e.g. out of memory
+                            LOGGER.error(f'Task {name} crashed its worker', exc_info=True)
+                            state = FAILED
+                        finish(name, state)
+
+        n_failed = sum(s == FAILED for s in states.values())
+        n_skipped = sum(s == SKIPPED for s in states.values())
+        LOGGER.info(f'Finished {len(states)} tasks: {n_failed} failed, {n_skipped} skipped')
+        return states
+
+
+def _run_task(name, task):
+    try:
+        result = task['func'](*task['args'], **task['kwargs'])
+    except Exception:
+        LOGGER.error(f'Error running task {name}', exc_info=True)
+        return FAILED
+    # Some functions, e.g. the yearset combinations, report failure by returning False
+    if result is False:
+        LOGGER.error(f'Task {name} did not produce its output')
+        return FAILED
+    return DONE
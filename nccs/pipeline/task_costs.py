@@ -0,0 +1,221 @@
+"""
+Rough estimates of how expensive each analysis in a run is, used to hand out
+the largest tasks first when running in parallel.
+
+The cost of a direct impact calculation scales with the number of hazard
+events times the number of exposure points. Both are read from the headers of
+the local hazard and exposure files without loading them. Where the data
+hasn't been downloaded yet (or comes from the CLIMADA API) the size of its
+files is used instead, found with an S3 HEAD request or from the API
+dataset's metadata. The values of each factor are all counts or all sizes, so
+that they can be compared. Only where neither is available is the median of
+the known values used.
+
+Sizes are looked up once per process: runs estimate costs several times (for
+prefetching, the scheduler and the worker queue) and the S3 and API lookups,
+and their warnings when offline, shouldn't be repeated each time.
+"""
+
+import logging
+import os
+from functools import cache
+
+import h5py
+import numpy as np
+import pandas as pd
+import pycountry
+
+from nccs.pipeline.direct import stormeurope
+from nccs.pipeline.direct.direct import (
+    get_hazard_source,
+    get_local_exposure_path,
+    get_local_hazard_path,
+    get_sector_exposure_source
+)
+from nccs.utils.data_catalog import get_dataset_size, get_litpop_properties
+from nccs.utils.s3client import get_s3_object_fingerprint
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_hazard_n_events(haz_type, country, scenario, ref_year):
+    """Number of events in a hazard, if its file is available locally, else None"""
+    country_iso3alpha = pycountry.countries.get(name=country).alpha_3
+    source = get_hazard_source(haz_type, country_iso3alpha, scenario, ref_year)
+    if source is None or source['origin'] != 's3':
+        return None
+    path = get_local_hazard_path(source['s3_path'])
+    if not os.path.exists(path):
+        return None
+    try:
+        with h5py.File(path, 'r') as f:
+            return f['event_id'].shape[0]
+    except (OSError, KeyError):
+        return None
+
+
+def get_exposure_n_points(sector, country):
+    """Number of points in a sector exposure, if its file is available
+    locally, else None"""
+    source = get_sector_exposure_source(sector, country)
+    if source['origin'] != 's3':
+        return None
+    path = get_local_exposure_path(source['s3_path'])
+    if not os.path.exists(path):
+        return None
+    try:
+        # Exposures are stored with pandas.to_hdf: in 'table' format the rows are a 'table' dataset, in 'fixed'
+        # format the row index is stored in 'axis1'
+        with h5py.File(path, 'r') as f:
+            group = f[list(f.keys())[0]]
+            if 'table' in group:
+                return group['table'].shape[0]
+            return group['axis1'].shape[0]
+    except (OSError, KeyError, IndexError):
+        return None
+
+
+@cache
+def get_hazard_size(haz_type, country, scenario, ref_year):
+    """Size in bytes of a hazard's files, found without downloading them, or
+    None if it can't be found out"""
+    country_iso3alpha = pycountry.countries.get(name=country).alpha_3
+    source = get_hazard_source(haz_type, country_iso3alpha, scenario, ref_year)
+    if source is None:
+        return None
+    if source['origin'] == 's3':
+        return _s3_size(source['s3_path'], get_local_hazard_path(source['s3_path']))
+    if source['origin'] in ['api', 'crop']:
+        return _api_size(source['data_type'], source['properties'])
+    if source['scenario'] == 'observed':
+        return _api_size(stormeurope.ERA5_DATA_TYPE, stormeurope.ERA5_PROPERTIES)
+    return _s3_size(*stormeurope.get_s3_hazard_file(source['scenario'], source['country_iso3alpha']))
+
+
+@cache
+def get_exposure_size(sector, country):
+    """Size in bytes of a sector exposure's files, found without downloading
+    them, or None if it can't be found out"""
+    source = get_sector_exposure_source(sector, country)
+    if source['origin'] == 's3':
+        return _s3_size(source['s3_path'], get_local_exposure_path(source['s3_path']))
+    if source['data_type'] == 'litpop':
+        return _api_size('litpop', get_litpop_properties(country))
+    return _api_size(source['data_type'], source['properties'])
+
+
+def _s3_size(s3_path, local_path):
+    if os.path.exists(local_path):
+        return os.path.getsize(local_path)
+    try:
+        return get_s3_object_fingerprint(s3_path)['size']
+    except Exception as e:
+        LOGGER.warning(f'Could not find the size of {s3_path} on S3: {e}')
+        return None
+
+
+def _api_size(data_type, properties):
+    properties = properties if isinstance(properties, list) else [properties]
+    try:
+        sizes = [get_dataset_size(data_type, p) for p in properties]
+    except Exception as e:
+        LOGGER.warning(f'Could not find the size of the API dataset {data_type} {properties}: {e}')
+        return None
+    return None if None in sizes else sum(sizes)
+
+
+def get_impact_file_nnz(filepath):
+    """Number of stored values in the impact matrix of an impact file, or None
+    if it can't be read"""
+    if not os.path.exists(filepath):
+        return None
+    try:
+        with h5py.File(filepath, 'r') as f:
+            return f['imp_mat/data'].shape[0]
+    except (OSError, KeyError):
+        return None
+
+
+def estimate_direct_costs(df: pd.DataFrame):
+    """Estimate the relative cost of each direct impact calculation in an
+    analysis dataframe as n_events * n_exposure_points.
+
+    Returns
+    -------
+    pandas.Series
+        Cost estimate for each row, indexed like df
+    """
+    n_events = _counts_or_sizes(
+        df[['hazard', 'country', 'scenario', 'ref_year']].drop_duplicates().itertuples(index=False),
+        get_hazard_n_events,
+        get_hazard_size
+    )
+    n_points = _counts_or_sizes(
+        df[['sector', 'country']].drop_duplicates().itertuples(index=False),
+        get_exposure_n_points,
+        get_exposure_size
+    )
+    n_events_fill = _median_or_one(n_events.values())
+    n_points_fill = _median_or_one(n_points.values())
+
+    costs = [
+        (n_events[(row.hazard, row.country, row.scenario, row.ref_year)] or n_events_fill) *
+        (n_points[(row.sector, row.country)] or n_points_fill)
+        for row in df.itertuples()
+    ]
+    return pd.Series(costs, index=df.index, dtype=float)
+
+
+def estimate_yearset_costs(df: pd.DataFrame):
+    """Estimate the relative cost of each yearset calculation in an analysis
+    dataframe from the size of its direct impact matrix.
+
+    Returns
+    -------
+    pandas.Series
+        Cost estimate for each row, indexed like df
+    """
+    nnz = {p: get_impact_file_nnz(p) for p in df['direct_impact_path'].unique()}
+    fill = _median_or_one(nnz.values())
+    return pd.Series([nnz[p] or fill for p in df['direct_impact_path']], index=df.index, dtype=float)
+
+
+def order_by_cost(df: pd.DataFrame, costs: pd.Series, by=None):
+    """Split a dataframe into tasks, most expensive first. Workers pulling
+    these one at a time from a queue finish the largest analyses early
+    instead of being left with one at the end.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Analysis dataframe
+    costs : pandas.Series
+        Estimated cost of each row, indexed like df
+    by : list of str, optional
+        Columns to group rows by. Each group becomes one task, costing the sum
+        of its rows. If not given, each row is a task.
+
+    Returns
+    -------
+    list of pandas.DataFrame
+    """
+    if by is None:
+        order = costs.loc[df.index].sort_values(ascending=False, kind='stable').index
+        return [df.loc[[i]] for i in order]
+    groups = [df_group for _, df_group in df.groupby(by, sort=False, observed=True)]
+    return sorted(groups, key=lambda df_group: costs.loc[df_group.index].sum(), reverse=True)
+
+
+def _counts_or_sizes(keys, get_count, get_size):
+    """Counts for every key if they can all be read locally, otherwise sizes
+    for every key, so that the values are in the same unit"""
+    keys = list(keys)
+    counts = {k: get_count(*k) for k in keys}
+    if all(counts.values()):
+        return counts
+    return {k: get_size(*k) for k in keys}
+
+
+def _median_or_one(values):
+    known = [v for v in values if v]
+    return float(np.median(known)) if known else 1.
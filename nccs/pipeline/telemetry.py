@@ -0,0 +1,255 @@
+"""
+Performance telemetry for the tasks of a run.
+
+Each direct impact, yearset, combination and supply chain task measures its
+wall time, CPU time, peak memory and bytes read and written, along with the
+size of its data (hazard events, exposure points, impact matrix non-zeros).
+Measurements are appended as one JSON line per task to a metrics file, which
+every worker process (local or on another machine) writes to, and merged into
+the calculations report at the end of the run.
+
+Memory and I/O are read from /proc on Linux. Elsewhere peak memory falls back
+to resource.getrusage and bytes read and written are not recorded.
+"""
+
+import json
+import logging
+import os
+import time
+
+import pandas as pd
+
+LOGGER = logging.getLogger(__name__)
+
+# The metrics file is passed to worker processes through the environment
+METRICS_PATH_ENV = 'NCCS_METRICS_PATH'
+
+METRICS = [
+    'wall_time_s', 'cpu_time_s', 'peak_rss_mb', 'bytes_read', 'bytes_written', 'n_events', 'n_exposure_points',
+    'nnz', 'n_inputs'
+]
+
+# Report columns the metrics of each stage are merged on
+STAGE_REPORT_KEYS = {
+    'direct': 'direct_impact_path',
+    'yearset': 'yearset_path',
+    'combine': 'yearset_path',
+}
+HAZARD_LOAD_LABELS = ['hazard', 'country', 'scenario', 'ref_year']
+
+
+def set_metrics_path(path):
+    """Set the file that tasks in this process and the processes it starts
+    write their metrics to. None turns metrics off."""
+    if path is None:
+        os.environ.pop(METRICS_PATH_ENV, None)
+    else:
+        os.environ[METRICS_PATH_ENV] = os.fspath(path)
+
+
+def get_metrics_path():
+    return os.environ.get(METRICS_PATH_ENV)
+
+
+def _read_proc_io():
+    # rchar/wchar count all bytes passed to read and write calls, including those served from the page cache
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(':') for line in f)
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _reset_peak_rss():
+    # Writing 5 to clear_refs resets the process's peak RSS, so it measures this task rather than the worker's life
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        # Kilobytes on Linux, bytes on macOS: this fallback is approximate anyway
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except ImportError:
+        return None
+
+
+class TaskMetrics:
+    """Measure a task and append its metrics to the metrics file.
+
+    Does nothing if no metrics file is set.
+
+    Examples
+    --------
+        >>> with TaskMetrics('direct', calc['direct_impact_path'], sector=calc['sector']) as metrics:
+        >>>     imp = ...
+        >>>     metrics.record(n_events=len(imp.event_id), nnz=imp.imp_mat.nnz)
+    """
+
+    def __init__(self, stage, output_path=None, **labels):
+        self.stage = stage
+        self.output_path = None if output_path is None else os.fspath(output_path)
+        self.labels = labels
+        self.values = {}
+        self.failed = False
+        self.metrics_path = get_metrics_path()
+
+    def record(self, **values):
+        """Record size metrics such as n_events, n_exposure_points and nnz"""
+        self.values.update(values)
+
+    def fail(self, error):
+        """Record that the task ended without its output, for tasks that
+        report failure by returning rather than raising"""
+        self.failed = True
+        self.values['error'] = error
+
+    def __enter__(self):
+        if self.metrics_path is not None:
+            _reset_peak_rss()
+            self._io = _read_proc_io()
+            self._cpu = time.process_time()
+            self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.metrics_path is None:
+            return False
+        io = _read_proc_io()
+        record = {
+            'stage': self.stage,
+            'output_path': self.output_path,
+            **{k: _to_json(v) for k, v in self.labels.items()},
+            'success': exc_type is None and not self.failed,
+            'wall_time_s': time.perf_counter() - self._wall,
+            'cpu_time_s': time.process_time() - self._cpu,
+            'peak_rss_mb': _peak_rss_mb(),
+            'bytes_read': None if io is None or self._io is None else io[0] - self._io[0],
+            'bytes_written': None if io is None or self._io is None else io[1] - self._io[1],
+            **{k: _to_json(v) for k, v in self.values.items()},
+            'pid': os.getpid(),
+            'finished': time.time(),
+        }
+        try:
+            _append_line(self.metrics_path, json.dumps(record))
+        except OSError:
+            LOGGER.warning(f'Could not write task metrics to {self.metrics_path}', exc_info=True)
+        return False
+
+
+def impact_size_metrics(imp):
+    """Number of events, exposure points and stored impact matrix values of a
+    CLIMADA Impact"""
+    imp_mat = getattr(imp, 'imp_mat', None)
+    return {
+        'n_events': len(imp.event_id),
+        'n_exposure_points': len(imp.coord_exp),
+        'nnz': None if imp_mat is None or imp_mat.shape[0] == 0 else int(imp_mat.nnz),
+    }
+
+
+def _to_json(value):
+    if hasattr(value, 'item'):
+        return value.item()
+    if isinstance(value, os.PathLike):
+        return os.fspath(value)
+    return value
+
+
+def _append_line(path, line):
+    # A single write to a file opened for appending, so that lines from concurrent processes don't interleave
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (line + '\n').encode())
+    finally:
+        os.close(fd)
+
+
+def read_metrics(path):
+    """Read a metrics file into a dataframe with one row per task run.
+    Unreadable lines (e.g. from a process killed mid-write) are skipped."""
+    records = []
+    if path is not None and os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    return pd.DataFrame(records)
+
+
+def add_metrics_to_report(df, metrics_path):
+    """Add the metrics of each analysis's tasks to a calculations report as
+    columns <stage>_<metric>, e.g. direct_wall_time_s or
+    indirect_leontief_peak_rss_mb. Where a task ran more than once, the last
+    run is used.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The analysis dataframe
+    metrics_path : str or os.PathLike
+        The metrics file written during the run
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    metrics = read_metrics(metrics_path)
+    if metrics.shape[0] == 0:
+        return df
+    metrics = metrics.drop_duplicates(['stage', 'output_path', *_present(metrics, HAZARD_LOAD_LABELS)], keep='last')
+
+    for stage, key_col in STAGE_REPORT_KEYS.items():
+        stage_metrics = metrics[metrics['stage'] == stage]
+        if stage_metrics.shape[0] == 0 or key_col not in df.columns:
+            continue
+        lookup = stage_metrics.set_index('output_path')
+        _add_columns(df, stage, lookup, [_path_key(p) for p in df[key_col]])
+
+    # Supply chain tasks are matched by the yearset they model, one set of columns per IO approach
+    for stage in sorted(s for s in metrics['stage'].unique() if s.startswith('indirect')):
+        stage_metrics = metrics[metrics['stage'] == stage].drop_duplicates('input_path', keep='last')
+        _add_columns(df, stage, stage_metrics.set_index('input_path'), [_path_key(p) for p in df['yearset_path']])
+
+    # Hazards are loaded once for all the sectors that share them
+    hazard_metrics = metrics[metrics['stage'] == 'load_hazard']
+    if hazard_metrics.shape[0] > 0:
+        lookup = hazard_metrics.set_index(
+            pd.Index([_label_key(r, HAZARD_LOAD_LABELS) for _, r in hazard_metrics.iterrows()])
+        )
+        _add_columns(df, 'load_hazard', lookup, [_label_key(r, HAZARD_LOAD_LABELS) for _, r in df.iterrows()])
+    return df
+
+
+def _add_columns(df, stage, lookup, keys):
+    lookup = lookup[~lookup.index.duplicated(keep='last')]
+    for metric in METRICS:
+        if metric not in lookup.columns or lookup[metric].isna().all():
+            continue
+        df[f'{stage}_{metric}'] = lookup[metric].reindex(keys).values
+
+
+def _present(df, cols):
+    return [c for c in cols if c in df.columns]
+
+
+def _path_key(p):
+    return os.fspath(p) if isinstance(p, (str, os.PathLike)) else None
+
+
+def _label_key(row, labels):
+    return '|'.join(str(row.get(label)) for label in labels)
@@ -0,0 +1,48 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from nccs.pipeline.artifact_index import ArtifactIndex
+
+
+def touch(path):
+    with open(path, 'w'):
+        pass
+
+
+class TestArtifactIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dir = self.tmpdir.name
+        self.existing = os.path.join(self.dir, 'impact_raw_a.hdf5')
+        self.missing = os.path.join(self.dir, 'impact_raw_b.hdf5')
+        touch(self.existing)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_scan(self):
+        index = ArtifactIndex([self.dir, os.path.join(self.dir, 'does_not_exist')])
+        self.assertEqual(index.exists_many([self.existing, self.missing]), [True, False])
+        self.assertTrue(index.exists(Path(self.dir, 'impact_raw_a.hdf5')))
+
+    def test_refresh(self):
+        index = ArtifactIndex([self.dir])
+        touch(self.missing)
+        os.remove(self.existing)
+        self.assertEqual(index.exists_many([self.existing, self.missing]), [True, False])
+        index.refresh([self.existing, self.missing, float('nan')])
+        self.assertEqual(index.exists_many([self.existing, self.missing]), [False, True])
+
+    def test_s3_files_match_by_name(self):
+        index = ArtifactIndex([self.dir])
+        index.s3_filenames.add('impact_raw_b.hdf5')
+        self.assertFalse(index.exists(self.missing))
+        index.use_s3 = True
+        self.assertTrue(index.exists(self.missing))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from nccs.pipeline.prefetch import BandwidthLimiter, Prefetcher
+
+
+class FakeS3Client:
+    """Serves objects from a dictionary, like boto3's download_file"""
+
+    def __init__(self, objects, delay=0.):
+        self.objects = objects
+        self.delay = delay
+        self.calls = []
+        self.n_running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def download_file(self, bucket, key, filename, Callback=None):
+        with self._lock:
+            self.calls.append(key)
+            self.n_running += 1
+            self.max_running = max(self.max_running, self.n_running)
+        try:
+            time.sleep(self.delay)
+            if key not in self.objects:
+                raise KeyError(key)
+            with open(filename, 'wb') as f:
+                f.write(self.objects[key])
+            if Callback is not None:
+                Callback(len(self.objects[key]))
+        finally:
+            with self._lock:
+                self.n_running -= 1
+
+
+class TestPrefetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dir = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.dir, 'sub', name)
+
+    def test_downloads_each_missing_file_once(self):
+        client = FakeS3Client({'a': b'aaa', 'b': b'bb'})
+        os.makedirs(os.path.join(self.dir, 'sub'))
+        with open(self.path('b'), 'wb') as f:
+            f.write(b'old')
+        files = [('a', self.path('a')), ('b', self.path('b')), ('a', self.path('a'))]
+
+        progress = Prefetcher(files, client=client).start().wait()
+
+        self.assertEqual(client.calls, ['a'])
+        with open(self.path('a'), 'rb') as f:
+            self.assertEqual(f.read(), b'aaa')
+        self.assertEqual(progress.summary(), {
+            'n_files': 2, 'n_downloaded': 1, 'n_skipped': 1, 'n_failed': 0, 'bytes_downloaded': 3
+        })
+
+    def test_failed_downloads_leave_no_file(self):
+        client = FakeS3Client({})
+        progress = Prefetcher([('missing', self.path('missing'))], client=client).start().wait()
+        self.assertEqual(progress.n_failed, 1)
+        self.assertEqual(os.listdir(os.path.join(self.dir, 'sub')), [])
+
+    def test_concurrency_is_bounded(self):
+        objects = {str(i): b'x' for i in range(12)}
+        client = FakeS3Client(objects, delay=0.02)
+        files = [(key, self.path(key)) for key in objects]
+        progress = Prefetcher(files, max_workers=3, client=client).start().wait()
+        self.assertEqual(progress.n_downloaded, 12)
+        self.assertLessEqual(client.max_running, 3)
+
+
+class TestBandwidthLimiter(unittest.TestCase):
+
+    def test_sleeps_when_over_the_limit(self):
+        now = [0.]
+        sleeps = []
+        limiter = BandwidthLimiter(100, clock=lambda: now[0], sleep=sleeps.append)
+        limiter.consume(100)
+        self.assertEqual(sleeps, [])
+        limiter.consume(50)
+        self.assertEqual(sleeps, [0.5])
+        now[0] = 2.
+        limiter.consume(80)
+        self.assertEqual(sleeps, [0.5])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import multiprocessing
+import os
+import tempfile
+import unittest
+
+from nccs.pipeline.run_journal import PENDING, RUNNING, RunJournal, get_task_id
+from nccs.pipeline.scheduler import DONE, FAILED
+
+
+def write_file(path):
+    with open(path, 'w') as f:
+        f.write('output')
+    return True
+
+
+def raise_error():
+    raise RuntimeError('This task always fails')
+
+
+def claim_all(journal_path, result_queue):
+    journal = RunJournal(journal_path)
+    claimed = []
+    while True:
+        task_id = journal.claim_next()
+        if task_id is None:
+            break
+        claimed.append(task_id)
+        journal.mark_done(task_id)
+    result_queue.put(claimed)
+
+
+class TestRunJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.journal_path = os.path.join(self.tmpdir.name, 'run_journal.sqlite')
+        self.output_path = os.path.join(self.tmpdir.name, 'output.txt')
+        self.task_id = get_task_id('direct', self.output_path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_run_records_outcome(self):
+        journal = RunJournal(self.journal_path)
+        journal.add_tasks([(self.task_id, 'direct', self.output_path)])
+        self.assertEqual(journal.get_states(), {self.task_id: PENDING})
+        self.assertTrue(journal.run(self.task_id, write_file, self.output_path))
+        task = journal.get_task(self.task_id)
+        self.assertEqual(task['state'], DONE)
+        self.assertEqual(task['output_exists'], 1)
+        self.assertGreaterEqual(task['duration'], 0)
+        self.assertEqual(journal.get_done_with_output('direct'), {self.task_id})
+
+        # Done tasks are only run again with force
+        self.assertIsNone(journal.run(self.task_id, raise_error))
+        with self.assertRaises(RuntimeError):
+            journal.run(self.task_id, raise_error, force=True)
+        self.assertEqual(journal.get_task(self.task_id)['state'], FAILED)
+        self.assertEqual(journal.get_task(self.task_id)['attempts'], 2)
+
+    def test_resume_after_kill(self):
+        journal = RunJournal(self.journal_path)
+        self.assertTrue(journal.claim(self.task_id))
+        journal.close()
+
+        # A new run finds the task left running, and can claim it once it is reset
+        journal = RunJournal(self.journal_path)
+        self.assertEqual(journal.get_states('direct'), {self.task_id: RUNNING})
+        self.assertFalse(journal.claim(self.task_id))
+        self.assertEqual(journal.reset_running(), 1)
+        self.assertTrue(journal.claim(self.task_id))
+        self.assertEqual(journal.get_task(self.task_id)['output_path'], self.output_path)
+
+    def test_concurrent_claims(self):
+        journal = RunJournal(self.journal_path)
+        task_ids = [get_task_id('yearset', f'yearset_{i}.hdf5') for i in range(200)]
+        journal.add_tasks([(task_id, 'yearset', None) for task_id in task_ids])
+
+        result_queue = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=claim_all, args=(self.journal_path, result_queue))
+                     for _ in range(4)]
+        for p in processes:
+            p.start()
+        claimed = [task_id for _ in processes for task_id in result_queue.get(timeout=60)]
+        for p in processes:
+            p.join()
+
+        self.assertEqual(sorted(claimed), sorted(task_ids))
+        self.assertEqual(journal.summary(), {'yearset': {DONE: 200}})
+
+    def test_started_and_unfinished_tasks_are_interrupted(self):
+        """A killed run leaves its running tasks pending with an attempt: their output files can't be trusted"""
+        journal = RunJournal(self.journal_path)
+        tasks = {name: get_task_id('direct', os.path.join(self.tmpdir.name, name)) for name in ['a', 'b', 'c', 'd']}
+        journal.add_tasks([(task_id, 'direct', None) for task_id in tasks.values()])
+        journal.run(tasks['a'], write_file, os.path.join(self.tmpdir.name, 'a'))
+        journal.claim(tasks['b'])
+        with self.assertRaises(RuntimeError):
+            journal.run(tasks['c'], raise_error)
+        journal.reset_running()
+        self.assertEqual(journal.get_interrupted('direct'), {tasks['b'], tasks['c']})
+        self.assertEqual(journal.get_interrupted('yearset'), set())
+        self.assertTrue(journal.is_interrupted(tasks['b']))
+        self.assertFalse(journal.is_interrupted(tasks['d']))
+
+    def test_shared_journals_do_not_use_wal(self):
+        journal = RunJournal(self.journal_path)
+        self.assertEqual(journal.conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        journal.close()
+        # A journal shared between machines is switched to the rollback journal, which works over network filesystems
+        journal = RunJournal(self.journal_path, shared=True)
+        self.assertEqual(journal.conn.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+        self.assertFalse(os.path.exists(self.journal_path + '-wal'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import os
+import time
+import unittest
+from pathlib import Path
+
+import pycountry
+
+from nccs.pipeline.run_plan import config_to_dataframe
+from nccs.utils import folder_naming
+
+DIRECT_OUTPUT_DIR = '/tmp/direct'
+INDIRECT_OUTPUT_DIR = '/tmp/indirect'
+
+
+def make_config(n_countries, sectors, hazards, scenario_years):
+    countries = [c.name for c in list(pycountry.countries)[:n_countries]]
+    return {
+        'runs': [
+            {
+                'hazard': hazard,
+                'sectors': sectors,
+                'countries': countries,
+                'scenario_years': scenario_years
+            }
+            for hazard in hazards
+        ]
+    }
+
+
+class TestConfigToDataframe(unittest.TestCase):
+
+    def setUp(self):
+        self.config = make_config(
+            n_countries=3,
+            sectors=['agriculture', 'service', 'non_metallic_mineral'],
+            hazards=['tropical_cyclone', 'relative_crop_yield'],
+            scenario_years=[
+                {'scenario': 'None', 'ref_year': 'historical'},
+                {'scenario': 'rcp85', 'ref_year': 2080}
+            ]
+        )
+
+    def test_rows(self):
+        df = config_to_dataframe(self.config, DIRECT_OUTPUT_DIR, INDIRECT_OUTPUT_DIR)
+        df_tc = df[df['hazard'] == 'tropical_cyclone']
+        df_crop = df[df['hazard'].str.startswith('relative_crop_yield')]
+        self.assertEqual(df_tc.shape[0], 2 * 3 * 3)
+        self.assertEqual(df_crop.shape[0], 4 * 2 * 3 * 3)
+        self.assertNotIn('relative_crop_yield', df['hazard'].tolist())
+        self.assertEqual(
+            set(df_crop['hazard']),
+            {f'relative_crop_yield_{crop_type}' for crop_type in ['whe', 'mai', 'ric', 'soy']}
+        )
+        self.assertIn('agriculture_whe', df_crop['sector'].tolist())
+        self.assertEqual(df.loc[0, 'ref_year'], 'historical')
+        self.assertEqual(df_tc['ref_year'].iloc[-1], 2080)
+        self.assertEqual(df_tc['i_scenario'].iloc[-1], 1)
+
+    def test_typed_columns(self):
+        df = config_to_dataframe(self.config, DIRECT_OUTPUT_DIR, INDIRECT_OUTPUT_DIR)
+        for col in ['hazard', 'sector', 'country']:
+            self.assertEqual(df[col].dtype.name, 'category')
+        row = df.iloc[0]
+        self.assertEqual(row['country_iso3alpha'], pycountry.countries.get(name=row['country']).alpha_3)
+
+    def test_paths_match_folder_naming(self):
+        df = config_to_dataframe(self.config, DIRECT_OUTPUT_DIR, INDIRECT_OUTPUT_DIR)
+        for _, row in df.iterrows():
+            for prefix, folder, col in [('impact_raw', 'impact_raw', 'direct_impact_path'),
+                                        ('yearset', 'yearsets', 'yearset_path')]:
+                filename = folder_naming.get_direct_namestring(
+                    prefix=prefix,
+                    extension='hdf5',
+                    haz_type=row['hazard'],
+                    sector=row['sector'],
+                    scenario=row['scenario'],
+                    ref_year=row['ref_year'],
+                    country_iso3alpha=row['country']
+                )
+                self.assertEqual(row[col], str(Path(DIRECT_OUTPUT_DIR, folder, filename)))
+
+    def test_large_plan_benchmark(self):
+        # ~100k rows: 200 countries x 16 sectors x 4 scenarios x 8 hazards
+        config = make_config(
+            n_countries=200,
+            sectors=[f'sector_{i}' for i in range(16)],
+            hazards=[f'hazard_{i}' for i in range(8)],
+            scenario_years=[{'scenario': f'rcp{i}', 'ref_year': 2060 + i} for i in range(4)]
+        )
+        start = time.perf_counter()
+        df = config_to_dataframe(config, DIRECT_OUTPUT_DIR, INDIRECT_OUTPUT_DIR)
+        elapsed = time.perf_counter() - start
+        self.assertEqual(df.shape[0], 200 * 16 * 4 * 8)
+        max_seconds = float(os.environ.get('NCCS_RUN_PLAN_BENCHMARK_MAX_SECONDS', 1.))
+        self.assertLess(elapsed, max_seconds, f'Compiling a {df.shape[0]} row run plan took {elapsed:.3f} s')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import tempfile
+import unittest
+
+from nccs.pipeline.scheduler import DONE, FAILED, SKIPPED, TaskGraph
+
+
+def append_to_file(path, text):
+    with open(path, 'a') as f:
+        f.write(text + '\n')
+
+
+def raise_error():
+    raise RuntimeError('This task always fails')
+
+
+def return_false():
+    return False
+
+
+class TestTaskGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.log = os.path.join(self.tmpdir.name, 'log.txt')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read_log(self):
+        with open(self.log) as f:
+            return f.read().split()
+
+    def test_tasks_run_after_their_dependencies(self):
+        graph = TaskGraph()
+        graph.add_task('yearset', append_to_file, self.log, 'yearset', deps=['direct'])
+        graph.add_task('direct', append_to_file, self.log, 'direct')
+        graph.add_task('indirect', append_to_file, self.log, 'indirect', deps=['yearset'])
+        states = graph.run()
+        self.assertEqual(self.read_log(), ['direct', 'yearset', 'indirect'])
+        self.assertTrue(all(state == DONE for state in states.values()))
+
+    def test_failed_dependencies_skip_downstream_tasks(self):
+        graph = TaskGraph()
+        graph.add_task('direct', raise_error)
+        graph.add_task('yearset', append_to_file, self.log, 'yearset', deps=['direct'])
+        graph.add_task('indirect', append_to_file, self.log, 'indirect', deps=['yearset'])
+        graph.add_task('combine', append_to_file, self.log, 'combine', deps=['direct'], allow_failed_deps=True)
+        states = graph.run()
+        self.assertEqual(states, {'direct': FAILED, 'yearset': SKIPPED, 'indirect': SKIPPED, 'combine': DONE})
+        self.assertEqual(self.read_log(), ['combine'])
+
+    def test_tasks_returning_false_fail(self):
+        graph = TaskGraph()
+        graph.add_task('combine', return_false)
+        graph.add_task('indirect', append_to_file, self.log, 'indirect', deps=['combine'])
+        self.assertEqual(graph.run(), {'combine': FAILED, 'indirect': SKIPPED})
+
+    def test_dependencies_outside_the_graph_are_ignored(self):
+        graph = TaskGraph()
+        graph.add_task('yearset', append_to_file, self.log, 'yearset', deps=['direct_from_earlier_run'])
+        self.assertEqual(graph.run(), {'yearset': DONE})
+
+    def test_higher_priority_tasks_start_first(self):
+        graph = TaskGraph()
+        graph.add_task('small', append_to_file, self.log, 'small', priority=1)
+        graph.add_task('large', append_to_file, self.log, 'large', priority=10)
+        graph.run()
+        self.assertEqual(self.read_log(), ['large', 'small'])
+
+    def test_parallel_run_completes_all_tasks(self):
+        graph = TaskGraph()
+        for i in range(6):
+            graph.add_task(f'direct/{i}', append_to_file, self.log, f'direct/{i}')
+            graph.add_task(f'yearset/{i}', append_to_file, self.log, f'yearset/{i}', deps=[f'direct/{i}'])
+        states = graph.run(ncpus=3)
+        self.assertEqual(len(states), 12)
+        log = self.read_log()
+        for i in range(6):
+            self.assertLess(log.index(f'direct/{i}'), log.index(f'yearset/{i}'))
+
+
+if __name__ == '__main__':
+    unittest.main()
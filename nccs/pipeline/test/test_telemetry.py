@@ -0,0 +1,70 @@
+import os
+import tempfile
+import unittest
+
+import pandas as pd
+
+from nccs.pipeline.telemetry import TaskMetrics, add_metrics_to_report, read_metrics, set_metrics_path
+
+
+class TestTelemetry(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.metrics_path = os.path.join(self.tmpdir.name, 'task_metrics.jsonl')
+        set_metrics_path(self.metrics_path)
+
+    def tearDown(self):
+        set_metrics_path(None)
+        self.tmpdir.cleanup()
+
+    def test_task_metrics(self):
+        with TaskMetrics('direct', 'impact_a.hdf5', sector='mining') as metrics:
+            sum(range(100000))
+            metrics.record(n_events=10, nnz=5)
+        with self.assertRaises(ValueError):
+            with TaskMetrics('yearset', 'yearset_a.hdf5'):
+                raise ValueError()
+        with TaskMetrics('combine', 'combined_a.hdf5') as metrics:
+            metrics.fail('No yearsets to combine')
+
+        records = read_metrics(self.metrics_path)
+        self.assertEqual(list(records['stage']), ['direct', 'yearset', 'combine'])
+        self.assertEqual(list(records['success']), [True, False, False])
+        self.assertEqual(records.iloc[2]['error'], 'No yearsets to combine')
+        direct = records.iloc[0]
+        self.assertEqual((direct['sector'], direct['n_events'], direct['nnz']), ('mining', 10, 5))
+        self.assertGreater(direct['wall_time_s'], 0)
+        self.assertGreaterEqual(direct['cpu_time_s'], 0)
+        self.assertGreater(direct['peak_rss_mb'], 0)
+
+    def test_no_metrics_path(self):
+        set_metrics_path(None)
+        with TaskMetrics('direct', 'impact_a.hdf5') as metrics:
+            metrics.record(n_events=10)
+        self.assertFalse(os.path.exists(self.metrics_path))
+
+    def test_add_metrics_to_report(self):
+        for n_events in [1, 2]:
+            with TaskMetrics('direct', 'impact_a.hdf5') as metrics:
+                metrics.record(n_events=n_events)
+        with TaskMetrics('indirect_leontief', 'indirect_a.csv', input_path='yearset_a.hdf5'):
+            pass
+        with TaskMetrics('combine', 'yearset_a.hdf5') as metrics:
+            metrics.record(n_inputs=3)
+        df = pd.DataFrame({
+            'direct_impact_path': ['impact_a.hdf5', 'impact_b.hdf5'],
+            'yearset_path': ['yearset_a.hdf5', None],
+        })
+        df = add_metrics_to_report(df, self.metrics_path)
+        self.assertEqual(df.loc[0, 'direct_n_events'], 2)
+        self.assertTrue(pd.isna(df.loc[1, 'direct_n_events']))
+        self.assertIn('direct_wall_time_s', df.columns)
+        self.assertFalse(pd.isna(df.loc[0, 'indirect_leontief_wall_time_s']))
+        self.assertTrue(pd.isna(df.loc[1, 'indirect_leontief_wall_time_s']))
+        self.assertNotIn('yearset_wall_time_s', df.columns)
+        self.assertEqual(df.loc[0, 'combine_n_inputs'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
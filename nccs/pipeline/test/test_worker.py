@@ -0,0 +1,152 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from nccs.pipeline.run_journal import RunJournal, get_task_id
+from nccs.pipeline.scheduler import DONE, FAILED, SKIPPED
+from nccs.pipeline.worker import LOST, QUEUE_CLOSED_KEY, RETRIED, run_claimed_task, run_worker, wait_for_queue
+
+REPO_ROOT = Path(__file__).resolve().parents[3]
+# Named explicitly: how pytest imports this module can change its __module__
+WRITE_OUTPUT = 'nccs.pipeline.test.test_worker:write_output'
+RAISE_ERROR = 'nccs.pipeline.test.test_worker:raise_error'
+FAIL_ONCE = 'nccs.pipeline.test.test_worker:fail_once'
+
+
+def write_output(output_path, input_path=None):
+    if input_path is not None and not os.path.exists(input_path):
+        raise FileNotFoundError(f'{input_path} should have been written first')
+    time.sleep(0.01)
+    with open(output_path, 'w') as f:
+        f.write(f'{os.getpid()}\n')
+
+
+def raise_error():
+    raise RuntimeError('This task always fails')
+
+
+def fail_once(output_path):
+    # E.g. a hazard that couldn't be downloaded the first time
+    if not os.path.exists(output_path + '.attempted'):
+        open(output_path + '.attempted', 'w').close()
+        raise RuntimeError('This task fails the first time')
+    write_output(output_path)
+
+
+def start_worker(journal_path, name):
+    return subprocess.Popen(
+        [sys.executable, '-m', 'nccs.pipeline.worker', journal_path, '--worker', name,
+         '--poll-seconds', '0.05', '--lease-seconds', '5', '--log-level', 'WARNING'],
+        cwd=REPO_ROOT
+    )
+
+
+class TestWorkers(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.journal_path = os.path.join(self.tmpdir.name, 'run_journal.sqlite')
+        self.journal = RunJournal(self.journal_path, shared=True)
+
+    def tearDown(self):
+        self.journal.close()
+        self.tmpdir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def test_local_workers(self):
+        tasks = []
+        for i in range(30):
+            first, second = self.path(f'first_{i}.txt'), self.path(f'second_{i}.txt')
+            tasks.append({'task_id': get_task_id('first', first), 'stage': 'first', 'output_path': first,
+                          'func': WRITE_OUTPUT, 'args': [first]})
+            tasks.append({'task_id': get_task_id('second', second), 'stage': 'second', 'output_path': second,
+                          'func': WRITE_OUTPUT, 'args': [second, first], 'deps': [get_task_id('first', first)]})
+        tasks.append({'task_id': 'fail:', 'stage': 'fail', 'func': RAISE_ERROR})
+        tasks.append({'task_id': 'after_fail:', 'stage': 'after_fail', 'func': WRITE_OUTPUT,
+                      'args': [self.path('never.txt')], 'deps': ['fail:']})
+        self.journal.enqueue(tasks)
+
+        # The coordinator waits for the queue to empty and then closes it, which lets the workers exit
+        workers = [start_worker(self.journal_path, f'worker_{i}') for i in range(3)]
+        wait_for_queue(self.journal, poll_seconds=0.05)
+        self.journal.set_meta(QUEUE_CLOSED_KEY, True)
+        for worker in workers:
+            worker.wait(timeout=60)
+
+        summary = self.journal.summary()
+        self.assertEqual(summary['first'], {DONE: 30})
+        self.assertEqual(summary['second'], {DONE: 30})
+        self.assertEqual(summary['fail'], {FAILED: 1})
+        self.assertEqual(summary['after_fail'], {SKIPPED: 1})
+        self.assertEqual(len(self.journal.get_done_with_output()), 60)
+        self.assertFalse(os.path.exists(self.path('never.txt')))
+
+    def test_expired_lease_is_reclaimed(self):
+        output_path = self.path('output.txt')
+        task_id = get_task_id('direct', output_path)
+        self.journal.enqueue([{'task_id': task_id, 'stage': 'direct', 'output_path': output_path,
+                               'func': WRITE_OUTPUT, 'args': [output_path]}])
+
+        # A worker claims the task and dies without renewing its lease
+        self.assertEqual(self.journal.claim_next(worker='dead', lease_seconds=0.05, queued=True), task_id)
+        self.assertIsNone(self.journal.claim_next(worker='alive', lease_seconds=5, queued=True))
+        time.sleep(0.1)
+
+        counts = run_worker(self.journal_path, worker='alive', poll_seconds=0.01, exit_when_idle=True)
+        self.assertEqual(counts[DONE], 1)
+        task = self.journal.get_task(task_id)
+        self.assertEqual((task['state'], task['worker'], task['attempts']), (DONE, 'alive', 2))
+        self.assertTrue(os.path.exists(output_path))
+
+    def test_failed_tasks_are_retried(self):
+        output_path = self.path('output.txt')
+        task_id = get_task_id('direct', output_path)
+        self.journal.enqueue([
+            {'task_id': task_id, 'stage': 'direct', 'output_path': output_path, 'func': FAIL_ONCE,
+             'args': [output_path]},
+            {'task_id': 'fail:', 'stage': 'fail', 'func': RAISE_ERROR},
+        ])
+
+        counts = run_worker(self.journal_path, worker='a', poll_seconds=0.01, max_attempts=2, exit_when_idle=True)
+        self.assertEqual((counts[DONE], counts[RETRIED], counts[FAILED]), (1, 2, 1))
+        task = self.journal.get_task(task_id)
+        self.assertEqual((task['state'], task['attempts']), (DONE, 2))
+        self.assertTrue(os.path.exists(output_path))
+        self.assertEqual((self.journal.get_task('fail:')['state'], self.journal.get_task('fail:')['attempts']),
+                         (FAILED, 2))
+
+    def test_lost_task_keeps_the_new_workers_state(self):
+        output_path = self.path('output.txt')
+        task_id = get_task_id('direct', output_path)
+        self.journal.enqueue([{'task_id': task_id, 'stage': 'direct', 'output_path': output_path,
+                               'func': WRITE_OUTPUT, 'args': [output_path]}])
+
+        # A slow worker's lease runs out and another worker claims the task, which is running when the first finishes
+        self.journal.claim_next(worker='slow', lease_seconds=0.05, queued=True)
+        time.sleep(0.1)
+        self.assertEqual(self.journal.claim_next(worker='fast', lease_seconds=5, queued=True), task_id)
+        self.assertEqual(run_claimed_task(self.journal, task_id, 'slow'), LOST)
+        task = self.journal.get_task(task_id)
+        self.assertEqual((task['state'], task['worker']), ('running', 'fast'))
+
+        self.assertTrue(self.journal.mark_done(task_id, worker='fast'))
+        self.assertFalse(self.journal.mark_failed(task_id, RuntimeError(), worker='slow'))
+        self.assertEqual(self.journal.get_task(task_id)['state'], DONE)
+
+    def test_heartbeat(self):
+        self.journal.enqueue([{'task_id': 'task:', 'stage': 'task', 'func': RAISE_ERROR}])
+        self.journal.claim_next(worker='a', lease_seconds=0.05, queued=True)
+        self.assertTrue(self.journal.heartbeat('task:', 'a', lease_seconds=5))
+        time.sleep(0.1)
+        self.assertIsNone(self.journal.claim_next(worker='b', queued=True))
+        self.assertFalse(self.journal.heartbeat('task:', 'b', lease_seconds=5))
+
+
+if __name__ == '__main__':
+    unittest.main()
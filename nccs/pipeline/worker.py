@@ -0,0 +1,225 @@
+"""
+Workers that take tasks from a run journal shared between machines.
+
+A coordinator (run_pipeline_from_config with use_worker_queue: True) queues
+the direct impact, yearset and supply chain tasks of a run in its journal.
+Any number of workers, on any machines that can see the journal's
+filesystem, then claim and run them:
+
+    python -m nccs.pipeline.worker <path to run_journal.sqlite>
+
+Each worker holds a lease on the task it is running and renews it from a
+background thread. If a worker dies its tasks are claimed again once their
+leases run out. Workers exit when the coordinator closes the queue and no
+tasks are left.
+
+The journal relies on SQLite's file locking, so the shared filesystem must
+support POSIX locks reliably. Many NFS setups don't: a cluster filesystem
+(e.g. Lustre, GPFS or CephFS) is safer. Workers open the journal in
+rollback-journal mode, as SQLite's write-ahead log only works on one host.
+"""
+
+import argparse
+import importlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from nccs.pipeline.run_journal import RunJournal, get_worker_name
+from nccs.pipeline.scheduler import DONE, FAILED
+from nccs.pipeline.telemetry import set_metrics_path
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_POLL_SECONDS = 10
+DEFAULT_MAX_ATTEMPTS = 3
+# Outcome of a task whose lease ran out and was claimed by another worker while this one ran it
+LOST = 'lost'
+# Outcome of a task that failed and was queued again, having been attempted fewer than max_attempts times
+RETRIED = 'retried'
+QUEUE_CLOSED_KEY = 'queue_closed'
+METRICS_PATH_KEY = 'metrics_path'
+# Environment variables the coordinator sets for its workers' tasks, e.g. the impact function registry to use
+WORKER_ENV_KEY = 'worker_env'
+
+
+def import_func(func_name):
+    """Import a function from its 'module:function' name"""
+    module_name, _, qualname = func_name.partition(':')
+    obj = importlib.import_module(module_name)
+    for attr in qualname.split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+
+class _Heartbeat(threading.Thread):
+    """Renews a worker's lease on a task until stopped"""
+
+    def __init__(self, journal_path, task_id, worker, lease_seconds):
+        super().__init__(daemon=True)
+        self.journal_path = journal_path
+        self.task_id = task_id
+        self.worker = worker
+        self.lease_seconds = lease_seconds
+        self.stopped = threading.Event()
+
+    def run(self):
+        # SQLite connections belong to one thread, so the heartbeat opens its own
+        journal = RunJournal(self.journal_path, shared=True)
+        while not self.stopped.wait(self.lease_seconds / 3):
+            if not journal.heartbeat(self.task_id, self.worker, self.lease_seconds):
+                LOGGER.warning(f'Lost the lease on task {self.task_id}: another worker may be running it')
+                break
+        journal.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def set_worker_env(env):
+    """Set environment variables from a dictionary. None values unset them."""
+    for key, value in env.items():
+        if value is None:
+            os.environ.pop(key, None)
+        else:
+            os.environ[key] = str(value)
+
+
+def run_claimed_task(journal, task_id, worker, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """Run a task this worker has claimed, renewing its lease while it runs,
+    and record the outcome in the journal. A task that raises is queued again
+    until it has been attempted max_attempts times, and then marked failed.
+
+    Returns
+    -------
+    str
+        'done', 'retried' or 'failed', or 'lost' if another worker took over
+        the task meanwhile. Lost tasks are left in the state the other worker
+        gives them.
+    """
+    task = journal.get_task(task_id)
+    heartbeat = _Heartbeat(journal.path, task_id, worker, lease_seconds)
+    heartbeat.start()
+    try:
+        func = import_func(task['func'])
+        payload = json.loads(task['args'])
+        func(*payload['args'], **payload['kwargs'])
+    except Exception as e:
+        LOGGER.error(f'Error running task {task_id} (attempt {task["attempts"]} of {max_attempts})', exc_info=True)
+        retry = task['attempts'] < max_attempts
+        if not journal.mark_failed(task_id, e, worker=worker, retry=retry):
+            LOGGER.warning(f'Task {task_id} failed after this worker lost it. Not recording the failure')
+            return LOST
+        return RETRIED if retry else FAILED
+    finally:
+        heartbeat.stop()
+    if not journal.mark_done(task_id, worker=worker):
+        LOGGER.warning(f'Task {task_id} finished after this worker lost it. Not recording it as done')
+        return LOST
+    return DONE
+
+
+def run_worker(
+        journal_path,
+        worker=None,
+        lease_seconds=DEFAULT_LEASE_SECONDS,
+        poll_seconds=DEFAULT_POLL_SECONDS,
+        max_attempts=DEFAULT_MAX_ATTEMPTS,
+        exit_when_idle=False):
+    """Claim and run queued tasks from a run journal until there are none
+    left.
+
+    Parameters
+    ----------
+    journal_path : str or os.PathLike
+        Location of the run journal, on a filesystem shared by all workers
+    worker : str, optional
+        Name of this worker in the journal. Defaults to host:pid
+    lease_seconds : float
+        How long a task stays claimed without a heartbeat. Heartbeats are sent
+        every third of this.
+    poll_seconds : float
+        How long to wait before asking again when no task is ready
+    max_attempts : int
+        Number of times a task is claimed, after it raised or its worker's
+        lease ran out, before it is marked failed
+    exit_when_idle : bool
+        Exit as soon as no tasks are pending or running, rather than waiting
+        for the coordinator to close the queue
+
+    Returns
+    -------
+    dict
+        Number of tasks this worker finished in each state
+    """
+    journal = RunJournal(journal_path, shared=True)
+    worker = worker or get_worker_name()
+    counts = {DONE: 0, RETRIED: 0, FAILED: 0, LOST: 0}
+    LOGGER.info(f'Worker {worker} taking tasks from {journal.path}')
+    while True:
+        task_id = journal.claim_next(
+            worker=worker, lease_seconds=lease_seconds, queued=True, max_attempts=max_attempts
+        )
+        if task_id is None:
+            if journal.n_unfinished() == 0 and (exit_when_idle or journal.get_meta(QUEUE_CLOSED_KEY, False)):
+                break
+            time.sleep(poll_seconds)
+            continue
+        LOGGER.info(f'Worker {worker} running {task_id}')
+        # Write task metrics to the coordinator's metrics file
+        set_metrics_path(journal.get_meta(METRICS_PATH_KEY))
+        set_worker_env(journal.get_meta(WORKER_ENV_KEY, {}))
+        counts[run_claimed_task(journal, task_id, worker, lease_seconds, max_attempts)] += 1
+    LOGGER.info(f'Worker {worker} finished: {counts}')
+    journal.close()
+    return counts
+
+
+def wait_for_queue(journal, poll_seconds=DEFAULT_POLL_SECONDS):
+    """Block until no queued tasks are pending or running"""
+    n_logged = None
+    while True:
+        n = journal.n_unfinished()
+        if n == 0:
+            return
+        if n != n_logged:
+            LOGGER.info(f'Waiting for workers: {n} tasks pending or running')
+            n_logged = n
+        time.sleep(poll_seconds)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run tasks queued in an NCCS run journal')
+    parser.add_argument('journal_path', help='Path to the run journal (run_journal.sqlite) of the run')
+    parser.add_argument('--worker', default=None, help='Name of this worker. Defaults to host:pid')
+    parser.add_argument('--lease-seconds', type=float, default=DEFAULT_LEASE_SECONDS)
+    parser.add_argument('--poll-seconds', type=float, default=DEFAULT_POLL_SECONDS)
+    parser.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS)
+    parser.add_argument('--exit-when-idle', action='store_true',
+                        help='Exit when no tasks are left instead of waiting for the coordinator to close the queue')
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=args.log_level,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    counts = run_worker(
+        args.journal_path,
+        worker=args.worker,
+        lease_seconds=args.lease_seconds,
+        poll_seconds=args.poll_seconds,
+        max_attempts=args.max_attempts,
+        exit_when_idle=args.exit_when_idle
+    )
+    return 1 if counts[FAILED] > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
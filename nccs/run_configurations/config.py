@@ -14,6 +14,24 @@ CONFIG = {
     "io_approach": ["leontief", "ghosh"],   # Supply chain IO to use. One or more of "leontief", "ghosh"
     "force_recalculation": False,           # If an intermediate file or output already exists should it be recalculated?
     "use_s3": False,                        # Also load and save data from an S3 bucket
+    "use_artifact_store": True,             # Reuse direct impacts and yearsets calculated with the same inputs by any previous run
+    "use_run_journal": True,                # Record task progress in an SQLite journal so that a killed run resumes where it stopped
+    "record_metrics": True,                 # Record each task's run time, memory, I/O and data sizes in the report and task_metrics.jsonl
+    "exposure_cache_mb": 2048,              # Memory each process may use to keep loaded exposures for reuse between stages. 0 turns it off
+    "cache_centroid_assignments": True,     # Store each exposure's nearest hazard centroids and reuse them for hazards on the same grid
+    "batch_direct_sectors": True,           # Calculate the direct impacts of sectors sharing impact functions in one impact calculation
+    "use_impf_registry": True,              # Build each impact function set once per run and share it with all workers
+    "prune_zero_events": False,             # Drop events with no impact from direct impact files. Yearsets are sampled as from the full event set
+    "share_sampling_plans": True,           # Sample the years of all sectors of a hazard group from one shared plan, so they have the same years
+    "impact_dtype": "float64",              # Precision of stored impact and yearset matrices. "float32" halves their size; aggregates stay float64
+    "direct_chunk_size": None,              # Calculate direct impacts in chunks of at most this many exposure points, to bound memory. None for no chunks
+    "direct_chunk_workers": 1,              # Number of threads calculating chunks at the same time
+    "data_catalog_path": None,              # Catalog of data downloaded from the CLIMADA API. None for resources/data_catalog.jsonl
+    "build_data_catalog": False,            # Download and catalog all the API data the run needs before starting
+    "offline_data": False,                  # Only use data in the catalog, without contacting the CLIMADA API
+    "prefetch_inputs": True,                # Download hazard and exposure files from S3 in the background
+    "prefetch_workers": 4,                  # Number of files prefetched at the same time
+    "prefetch_max_mb_per_s": None,          # Limit on the prefetch download speed in MB/s. None for no limit
     "log_level": "INFO",
     "seed": 161,
 
@@ -31,6 +49,8 @@ CONFIG = {
     # Parallisation:
     "do_parallel": False,                # Parallelise some operations
     "ncpus": ncpus,
+    "use_task_graph": False,            # Run all stages as one dependency graph so analyses don't wait for each other between stages
+    "use_worker_queue": False,          # Queue tasks for workers on several machines (python -m nccs.pipeline.worker <journal>)
 
     # Run specifications:
     "runs": [
@@ -2,8 +2,14 @@
 Test the analysis pipeline runs
 """
 
+import os
+import tempfile
 import unittest
-from nccs.analysis import run_pipeline_from_config
+from unittest import mock
+
+from nccs import analysis
+from nccs.analysis import combine_agriculture_yearsets, run_pipeline_from_config, write_impact_to_file
+from nccs.pipeline.direct.test.create_test_impact import dummy_impact_yearly
 from nccs.run_configurations.test.test_config import CONFIG  # change here to test_config if needed
 from nccs.utils.folder_naming import get_direct_output_dir
 from nccs.utils.delete_results import delete_results_folder
@@ -17,5 +23,35 @@ class TestAnalysisPipeline(unittest.TestCase):
         _ = run_pipeline_from_config(CONFIG)
 
 
+class TestCombineYearsets(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        imp = dummy_impact_yearly()
+        imp.event_name = [str(name) for name in imp.event_name]
+        self.paths = [os.path.join(self.tmpdir.name, f'yearset_{i}.hdf5') for i in range(2)]
+        for path in self.paths:
+            write_impact_to_file(imp, path)
+        self.combined_path = os.path.join(self.tmpdir.name, 'yearset_combined.hdf5')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_combination_is_skipped_while_its_yearsets_are_unchanged(self):
+        with mock.patch.object(analysis, 'combine_yearsets', wraps=analysis.combine_yearsets) as combine:
+            self.assertTrue(combine_agriculture_yearsets(self.paths, self.combined_path))
+            self.assertTrue(combine_agriculture_yearsets(self.paths, self.combined_path))
+            self.assertEqual(combine.call_count, 1)
+            self.assertTrue(combine_agriculture_yearsets(self.paths, self.combined_path, force=True))
+            self.assertEqual(combine.call_count, 2)
+            # A yearset that was rewritten since the combination was made
+            os.utime(self.paths[0], ns=(0, 0))
+            self.assertTrue(combine_agriculture_yearsets(self.paths, self.combined_path))
+            self.assertEqual(combine.call_count, 3)
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), sorted(
+            [os.path.basename(p) for p in self.paths + [self.combined_path]]
+        ))
+
+
 if __name__ == '__main__':
     unittest.main()
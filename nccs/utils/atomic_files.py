@@ -0,0 +1,44 @@
+"""
+Write files so that readers see them either complete or not at all.
+
+Files shared by parallel workers (impact function registries, sampling plans,
+centroid assignments, stored artifacts, prefetched inputs and results) are
+written to a temporary file in the same directory and renamed over their
+final path when complete. A rename within a directory is atomic, so a reader
+never opens a partial file, even if the writer is killed, and when several
+processes write the same file the last complete one wins.
+"""
+
+import os
+import threading
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_path(path, suffix=''):
+    """A temporary path to write path's contents to. When the block exits
+    without an error the temporary file replaces path. Otherwise it is
+    deleted.
+
+    Parameters
+    ----------
+    path : str or os.PathLike
+    suffix : str
+        Appended to the temporary name, for writers that add an extension to
+        names that don't end with it (e.g. numpy.save adds '.npy')
+
+    Examples
+    --------
+        >>> with atomic_path(path, suffix='.npy') as tmp_path:
+        >>>     np.save(tmp_path, values)
+    """
+    path = os.fspath(path)
+    # Unique per process and thread, so that concurrent writers of the same file don't share a temporary file
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp{suffix}'
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -0,0 +1,236 @@
+"""
+A local catalog of the hazards and exposures used from the CLIMADA data API.
+
+Every Client().get_hazard or get_exposures call asks the API for the
+dataset's metadata before using the files it has already downloaded. The
+catalog records, for each data type and set of query properties, the files a
+query resolved to. Later queries load the files directly, without contacting
+the API, so a run whose data is catalogued works offline.
+
+The catalog is an append-only JSON lines file, so processes running in
+parallel can add to it. It is filled as datasets are first used, or in one go
+with build_data_catalog. The catalog file and offline mode are passed to
+worker processes through the environment.
+"""
+
+import json
+import logging
+import os
+
+import pycountry
+from climada.entity import Exposures
+from climada.hazard import Hazard
+from climada.util.api_client import Client
+
+from nccs.utils.folder_naming import get_resources_dir
+
+LOGGER = logging.getLogger(__name__)
+
+DATA_CATALOG_PATH_ENV = 'NCCS_DATA_CATALOG_PATH'
+OFFLINE_DATA_ENV = 'NCCS_OFFLINE_DATA'
+
+# In-process copy of the catalog: path -> (file size when read, entries)
+_CATALOGS = {}
+
+
+def get_default_data_catalog_path():
+    return os.path.join(get_resources_dir(), 'data_catalog.jsonl')
+
+
+def set_data_catalog(path=None, offline=False):
+    """Set the catalog file this process and the processes it starts use,
+    and whether they may query the CLIMADA API for data that isn't in it."""
+    if path is None:
+        os.environ.pop(DATA_CATALOG_PATH_ENV, None)
+    else:
+        os.environ[DATA_CATALOG_PATH_ENV] = os.fspath(path)
+    if offline:
+        os.environ[OFFLINE_DATA_ENV] = '1'
+    else:
+        os.environ.pop(OFFLINE_DATA_ENV, None)
+
+
+def get_data_catalog_path():
+    return os.environ.get(DATA_CATALOG_PATH_ENV, get_default_data_catalog_path())
+
+
+def is_offline():
+    return os.environ.get(OFFLINE_DATA_ENV) == '1'
+
+
+def get_catalog_key(data_type, properties):
+    """Identify a query by its data type and properties. Property values are
+    compared as strings, as the API does."""
+    return json.dumps([data_type, {str(k): str(v) for k, v in properties.items()}], sort_keys=True)
+
+
+def read_data_catalog(path=None):
+    """The catalog's entries by key. Re-read only when the file has grown."""
+    path = os.fspath(path or get_data_catalog_path())
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    cached = _CATALOGS.get(path)
+    if cached is not None and cached[0] == size:
+        return cached[1]
+    entries = {}
+    if size > 0:
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                entries[get_catalog_key(entry['data_type'], entry['properties'])] = entry
+    _CATALOGS[path] = (size, entries)
+    return entries
+
+
+def add_to_data_catalog(data_type, properties, files, path=None, dataset=None):
+    """Record the files a query resolves to, and the uuid and version of the
+    API dataset they were downloaded from if it is given"""
+    path = os.fspath(path or get_data_catalog_path())
+    entry = {
+        'data_type': data_type,
+        'properties': {str(k): str(v) for k, v in properties.items()},
+        'files': [os.path.abspath(os.fspath(f)) for f in files]
+    }
+    if dataset is not None:
+        entry['uuid'] = str(dataset.uuid)
+        entry['version'] = str(dataset.version)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    # A single write to a file opened for appending, so that lines from concurrent processes don't interleave
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(entry) + '\n').encode())
+    finally:
+        os.close(fd)
+    return entry
+
+
+def get_catalog_files(data_type, properties):
+    """The local files for a query: from the catalog if they're there, and
+    otherwise downloaded from the API and added to the catalog.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the query isn't catalogued (or its files are gone) and the data
+        can't be downloaded because the pipeline runs offline
+    """
+    entry = read_data_catalog().get(get_catalog_key(data_type, properties))
+    if entry is not None and all(os.path.exists(f) for f in entry['files']):
+        return entry['files']
+    if is_offline():
+        raise FileNotFoundError(
+            f'No local data for {data_type} with properties {properties} in the data catalog '
+            f'{get_data_catalog_path()}, and the pipeline is running offline'
+        )
+    client = Client()
+    dataset = client.get_dataset_info(data_type=data_type, properties=properties)
+    _, files = client.download_dataset(dataset)
+    add_to_data_catalog(data_type, properties, files, dataset=dataset)
+    return [os.fspath(f) for f in files]
+
+
+def get_dataset_fingerprint(data_type, properties):
+    """Identify the version of the data a query loads, e.g. to key results
+    calculated from it.
+
+    The uuid and version of the API dataset are taken from the catalog if it
+    recorded them, and otherwise asked from the API. Offline, queries
+    catalogued without them are identified by the size and modification time
+    of their files.
+
+    Returns
+    -------
+    dict or None
+        None if the query isn't catalogued and the pipeline is running
+        offline
+    """
+    entry = read_data_catalog().get(get_catalog_key(data_type, properties))
+    if entry is not None and 'uuid' in entry:
+        return {'uuid': entry['uuid'], 'version': entry['version']}
+    if is_offline():
+        if entry is None or not all(os.path.exists(f) for f in entry['files']):
+            return None
+        return {'files': [[os.path.getsize(f), os.stat(f).st_mtime_ns] for f in entry['files']]}
+    dataset = Client().get_dataset_info(data_type=data_type, properties=properties)
+    return {'uuid': str(dataset.uuid), 'version': str(dataset.version)}
+
+
+def get_dataset_size(data_type, properties):
+    """Total size in bytes of the files a query loads, without downloading
+    them: from the catalogued files if they're there, and otherwise from the
+    API dataset's metadata.
+
+    Returns
+    -------
+    int or None
+        None if the query isn't catalogued and the pipeline is running
+        offline
+    """
+    entry = read_data_catalog().get(get_catalog_key(data_type, properties))
+    if entry is not None and all(os.path.exists(f) for f in entry['files']):
+        return sum(os.path.getsize(f) for f in entry['files'])
+    if is_offline():
+        return None
+    dataset = Client().get_dataset_info(data_type=data_type, properties=properties)
+    return sum(f.file_size for f in dataset.files)
+
+
+def _get_hdf5_files(data_type, properties):
+    """The query's HDF5 files, the only ones the API client loads data from"""
+    files = [f for f in get_catalog_files(data_type, properties) if f.endswith('.hdf5')]
+    if not files:
+        raise ValueError(f"no hdf5 files found in dataset {data_type} with properties {properties}")
+    return files
+
+
+def get_api_hazard(data_type, properties):
+    """Load a hazard from the CLIMADA data API, through the data catalog.
+    Equivalent to Client().get_hazard(data_type, properties=properties),
+    including its clean-up of hazards concatenated from several files."""
+    hazards = [Hazard.from_hdf5(f) for f in _get_hdf5_files(data_type, properties)]
+    if len(hazards) == 1:
+        return hazards[0]
+    hazard = Hazard.concat(hazards)
+    hazard.sanitize_event_ids()
+    hazard.check()
+    return hazard
+
+
+def get_api_exposures(data_type, properties):
+    """Load exposures from the CLIMADA data API, through the data catalog.
+    Equivalent to Client().get_exposures(data_type, properties=properties),
+    including its check of exposures concatenated from several files."""
+    exposures = [Exposures.from_hdf5(f) for f in _get_hdf5_files(data_type, properties)]
+    if len(exposures) == 1:
+        return exposures[0]
+    exposures = Exposures.concat(exposures)
+    exposures.check()
+    return exposures
+
+
+def get_litpop_properties(country):
+    """API properties of the default LitPop exposure of a country, as queried
+    by Client().get_litpop"""
+    return {'exponents': '(1,1)', 'country_name': pycountry.countries.lookup(country).name}
+
+
+def build_data_catalog(queries):
+    """Download and catalog a list of (data_type, properties) queries, e.g.
+    before running offline. Queries already catalogued are skipped.
+
+    Returns
+    -------
+    int
+        Number of queries added to the catalog
+    """
+    n_added = 0
+    catalog = read_data_catalog()
+    for data_type, properties in queries:
+        if get_catalog_key(data_type, properties) in catalog:
+            continue
+        get_catalog_files(data_type, properties)
+        n_added += 1
+    LOGGER.info(f'Added {n_added} datasets to the data catalog {get_data_catalog_path()}')
+    return n_added
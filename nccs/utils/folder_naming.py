@@ -42,3 +42,19 @@ def get_direct_namestring(prefix, extension, haz_type, sector, scenario, ref_yea
            f"_{ref_year}" \
            f"_{country_iso3alpha}" \
            f".{extension}"
+
+
+def get_artifact_store_dir():
+    """
+    Returns the absolute path to the artifact store shared by all runs
+    :return:
+    """
+    return f"{OUTPUT_DIR}/artifact_store"
+
+
+def get_centroid_assignment_dir():
+    """
+    Returns the absolute path to the exposure-to-centroid assignments shared by all runs
+    :return:
+    """
+    return f"{get_resources_dir()}/centroid_assignments"
@@ -96,6 +96,34 @@ def file_exists_on_s3_bucket(s3_filename: str):
                 raise ClientError(f"Unexpected error in the S3 client: {e}")
 
 
+def get_s3_object_fingerprint(s3_filename: str, client=None):
+    """
+    Identifies the current version of a file in the S3 bucket by its ETag and size, with one HEAD request.
+
+    :param s3_filename: key of the file in the S3 bucket
+    :param client: boto3 S3 client to use. One is created if not given
+    :return: dict with 'etag' and 'size'
+    """
+    client = client or get_client()
+    response = client.head_object(Bucket=BUCKET_NAME, Key=s3_filename)
+    return {'etag': response['ETag'].strip('"'), 'size': response['ContentLength']}
+
+
+def list_s3_bucket_keys(prefix: str = ""):
+    """
+    Lists the keys in the S3 bucket starting with a prefix, using one paginated listing.
+
+    :param prefix: only keys starting with this are returned
+    :return: list of keys
+    """
+    client = get_client()
+    paginator = client.get_paginator('list_objects_v2')
+    keys = []
+    for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=prefix):
+        keys.extend(obj["Key"] for obj in page.get("Contents", []))
+    return keys
+
+
 def download_complete_csvs_to_results():
     """
     Downloads all indirect/complete.csv files from the S3 bucket.
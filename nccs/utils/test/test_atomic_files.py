@@ -0,0 +1,40 @@
+import os
+import tempfile
+import unittest
+
+from nccs.utils.atomic_files import atomic_path
+
+
+class TestAtomicPath(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'file.txt')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_file_appears_when_complete(self):
+        with open(self.path, 'w') as f:
+            f.write('old')
+        with atomic_path(self.path) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                f.write('new')
+            with open(self.path) as f:
+                self.assertEqual(f.read(), 'old')
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'new')
+        self.assertEqual(os.listdir(self.tmpdir.name), ['file.txt'])
+
+    def test_failed_writes_leave_nothing(self):
+        with self.assertRaises(RuntimeError):
+            with atomic_path(self.path, suffix='.npy') as tmp_path:
+                self.assertTrue(tmp_path.endswith('.npy'))
+                with open(tmp_path, 'w') as f:
+                    f.write('partial')
+                raise RuntimeError('Writer died')
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import json
+import os
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+from climada.hazard import Centroids, Hazard
+from scipy import sparse
+
+from nccs.utils import data_catalog
+from nccs.utils.data_catalog import add_to_data_catalog, build_data_catalog, get_catalog_files, \
+    get_api_hazard, get_dataset_fingerprint, get_dataset_size, read_data_catalog, set_data_catalog
+
+PROPERTIES = {'country_iso3alpha': 'CHE', 'climate_scenario': 'historical'}
+
+
+class FakeClient:
+    """Resolves queries to files it writes to a directory, like the CLIMADA
+    API client's get_dataset_info and download_dataset"""
+
+    def __init__(self, download_dir):
+        self.download_dir = download_dir
+        self.downloads = []
+
+    def get_dataset_info(self, data_type, properties):
+        return SimpleNamespace(data_type=data_type, properties=properties, uuid=f'uuid-{data_type}', version='v2',
+                               files=[SimpleNamespace(file_size=4)])
+
+    def download_dataset(self, dataset):
+        self.downloads.append(dataset.data_type)
+        path = os.path.join(self.download_dir, f'{dataset.data_type}_{len(self.downloads)}.hdf5')
+        with open(path, 'w') as f:
+            f.write('data')
+        return self.download_dir, [path]
+
+
+def add_entries(catalog_path, worker, n):
+    for i in range(n):
+        add_to_data_catalog('river_flood', {'worker': worker, 'i': i}, [f'/data/{worker}_{i}.hdf5'], path=catalog_path)
+
+
+class TestDataCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.catalog_path = os.path.join(self.tmpdir.name, 'data_catalog.jsonl')
+        self.client = FakeClient(self.tmpdir.name)
+        self.env = mock.patch.dict(os.environ)
+        self.env.start()
+        set_data_catalog(self.catalog_path)
+        self.client_patch = mock.patch.object(data_catalog, 'Client', return_value=self.client)
+        self.client_patch.start()
+
+    def tearDown(self):
+        self.client_patch.stop()
+        self.env.stop()
+        self.tmpdir.cleanup()
+
+    def test_queries_are_downloaded_once(self):
+        files = get_catalog_files('river_flood', PROPERTIES)
+        self.assertEqual(self.client.downloads, ['river_flood'])
+        # Properties are compared as strings, as the API does
+        self.assertEqual(get_catalog_files('river_flood', {**PROPERTIES, 'climate_scenario': 'historical'}), files)
+        self.assertEqual(self.client.downloads, ['river_flood'])
+        self.assertEqual(get_dataset_fingerprint('river_flood', PROPERTIES), {'uuid': 'uuid-river_flood',
+                                                                              'version': 'v2'})
+
+    def test_missing_queries_fail_offline(self):
+        get_catalog_files('river_flood', PROPERTIES)
+        set_data_catalog(self.catalog_path, offline=True)
+        with self.assertRaises(FileNotFoundError):
+            get_catalog_files('wildfire', PROPERTIES)
+        self.assertEqual(len(get_catalog_files('river_flood', PROPERTIES)), 1)
+        self.assertIsNone(get_dataset_fingerprint('wildfire', PROPERTIES))
+        self.assertEqual(self.client.downloads, ['river_flood'])
+
+    def test_dataset_size_needs_no_download(self):
+        self.assertEqual(get_dataset_size('river_flood', PROPERTIES), 4)
+        self.assertEqual(self.client.downloads, [])
+        set_data_catalog(self.catalog_path, offline=True)
+        self.assertIsNone(get_dataset_size('river_flood', PROPERTIES))
+
+    def test_catalog_is_reread_when_it_grows(self):
+        self.assertEqual(read_data_catalog(), {})
+        add_to_data_catalog('wildfire', PROPERTIES, ['/data/wildfire.hdf5'])
+        self.assertEqual(len(read_data_catalog()), 1)
+        self.assertEqual(build_data_catalog([('wildfire', PROPERTIES), ('river_flood', PROPERTIES)]), 1)
+        self.assertEqual(self.client.downloads, ['river_flood'])
+        self.assertEqual(len(read_data_catalog()), 2)
+
+    def test_hazards_from_several_files_get_unique_event_ids(self):
+        files = []
+        for i in range(2):
+            haz = Hazard('RF', centroids=Centroids(lat=np.array([0., 1.]), lon=np.array([0., 1.])),
+                         event_id=np.array([1, 2]), event_name=[f'{i}a', f'{i}b'], frequency=np.array([0.5, 0.5]),
+                         intensity=sparse.csr_matrix(np.ones((2, 2))), date=np.array([1, 2]), units='m')
+            files.append(os.path.join(self.tmpdir.name, f'river_flood_{i}.hdf5'))
+            haz.write_hdf5(files[-1])
+        add_to_data_catalog('river_flood', PROPERTIES, files + [os.path.join(self.tmpdir.name, 'README.txt')])
+        open(os.path.join(self.tmpdir.name, 'README.txt'), 'w').close()
+        haz = get_api_hazard('river_flood', PROPERTIES)
+        self.assertEqual(haz.size, 4)
+        self.assertEqual(len(np.unique(haz.event_id)), 4)
+
+    def test_concurrent_appends_keep_every_entry(self):
+        with ProcessPoolExecutor(4) as executor:
+            list(executor.map(add_entries, [self.catalog_path] * 4, range(4), [50] * 4))
+        with open(self.catalog_path) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(len(lines), 200)
+        self.assertEqual(len(read_data_catalog()), 200)
+
+
+if __name__ == '__main__':
+    unittest.main()